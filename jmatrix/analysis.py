@@ -0,0 +1,224 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Find rules which can never change a verdict of interceptor.should_block.
+
+Every finding is safe to remove on its own, and minimize removes all of them
+while checking each one again against what is left. With typed_only, verdicts
+are only kept for requests of a concrete type (not *), which qutebrowser always
+makes, so type * cells which every type overrides can go too.
+
+A cell lookup (see rule.MergedRow) gets the value of the most
+specific source which has the cell. For any context below a source, the
+sources above it are the same as the ones above the source itself, so a rule
+is redundant if its nearest ancestor source has the same value for that cell
+(INHERIT and a missing cell behave the same, once nothing more general is
+left)."""
+
+import argparse
+import enum
+import pathlib
+import sys
+import typing
+
+from jmatrix import interceptor, rule, umatrix_parser
+
+
+class Issue(enum.Enum):
+	"""Why a rule can be removed."""
+	# Gives the same result as the rule it would inherit from
+	REDUNDANT = 1
+	# Never looked at, because more specific rules always decide first (only
+	# with typed_only)
+	SHADOWED = 2
+	# Never has any effect, whatever the other rules are
+	DEAD = 3
+
+Finding = typing.NamedTuple('Finding', [
+	('issue', Issue),
+	('source', str),
+	# dest and type are set for matrix rules, flag for flags
+	('dest', typing.Optional[str]),
+	('type', typing.Optional[rule.Type]),
+	('flag', typing.Optional[rule.Flag]),
+	('reason', str),
+])
+
+_DECIDING_ACTIONS = (rule.Action.ALLOW, rule.Action.BLOCK)
+_CONCRETE_TYPES = tuple(t for t in rule.Type if t != rule.Type.ALL)
+
+
+def _effective(action: typing.Optional[rule.Action]) -> typing.Optional[rule.Action]:
+	return action if action in _DECIDING_ACTIONS else None
+
+def _ancestors(host: str) -> typing.Tuple[str, ...]:
+	"""The sources above host, most specific first."""
+	if host == '*':
+		return ()
+	return interceptor._hostname_widen_list(host)[1:]
+
+def _inherited_rule(
+		rules: rule.Rules, source: str, dest: str,
+		request_type: rule.Type) -> typing.Tuple[typing.Optional[str], typing.Optional[rule.Action]]:
+	"""The (source, action) of the cell lookups would get if source did not have it."""
+	for ancestor in _ancestors(source):
+		action = rules.matrix_rules.get(ancestor, {}).get(dest, {}).get(request_type)
+		if action is not None:
+			return ancestor, action
+	return None, None
+
+def _inherited_flag(rules: rule.Rules, host: str, flag: rule.Flag) -> typing.Tuple[typing.Optional[str], bool]:
+	for ancestor in _ancestors(host):
+		state = rules.matrix_flags.get(ancestor, {}).get(flag)
+		if state is not None:
+			return ancestor, state
+	return None, False
+
+def _dest_sources(rules: rule.Rules) -> typing.Dict[str, typing.List[str]]:
+	"""Map every dest to the sources which have rules for it."""
+	index = {}  # type: typing.Dict[str, typing.List[str]]
+	for source, dests in rules.matrix_rules.items():
+		for dest in dests:
+			index.setdefault(dest, []).append(source)
+	return index
+
+def _check_rule(rules: rule.Rules, source: str, dest: str, request_type: rule.Type,
+				dest_sources: typing.Dict[str, typing.List[str]], typed_only: bool) -> typing.Optional[Finding]:
+	types = rules.matrix_rules.get(source, {}).get(dest, {})
+	action = types.get(request_type)
+	if action is None:
+		return None
+
+	ancestor, inherited = _inherited_rule(rules, source, dest, request_type)
+	if _effective(action) == _effective(inherited):
+		if ancestor is None:
+			reason = "nothing to inherit {} from".format(str(action))
+		else:
+			reason = "same as {} {} {} {}".format(ancestor, dest, str(request_type), str(inherited))
+		return Finding(Issue.REDUNDANT, source, dest, request_type, None, reason)
+
+	# For requests of a concrete type, a type * cell is only used when the
+	# cell of the request type did not decide. If this source decides every
+	# type, and no more specific source has rules for dest, that never
+	# happens below this source. Requests of type * always use it.
+	if (typed_only and request_type == rule.Type.ALL and
+			all(types.get(t) in _DECIDING_ACTIONS for t in _CONCRETE_TYPES) and
+			not any(source in _ancestors(other) for other in dest_sources.get(dest, ()))):
+		return Finding(Issue.SHADOWED, source, dest, request_type, None,
+					   "every type of {} {} is set".format(source, dest))
+	return None
+
+def _check_flag(rules: rule.Rules, host: str, flag: rule.Flag) -> typing.Optional[Finding]:
+	state = rules.matrix_flags.get(host, {}).get(flag)
+	if state is None:
+		return None
+	if not state:
+		# interceptor only checks if any host (or the scheme) turns a flag on
+		return Finding(Issue.DEAD, host, None, None, flag, "flags are off by default")
+	ancestor, inherited = _inherited_flag(rules, host, flag)
+	if inherited:
+		return Finding(Issue.REDUNDANT, host, None, None, flag,
+					   "{} is already set on {}".format(str(flag), ancestor))
+	return None
+
+def analyze(rules: rule.Rules, typed_only: bool = False) -> typing.List[Finding]:
+	"""Find every rule and flag which could be removed without changing any verdict.
+
+	With typed_only, only verdicts on requests of a concrete type are kept."""
+	findings = []  # type: typing.List[Finding]
+	for host, flags in rules.matrix_flags.items():
+		for flag in flags:
+			finding = _check_flag(rules, host, flag)
+			if finding is not None:
+				findings.append(finding)
+	dest_sources = _dest_sources(rules)
+	for source, dests in rules.matrix_rules.items():
+		for dest, types in dests.items():
+			for request_type in types:
+				finding = _check_rule(rules, source, dest, request_type, dest_sources, typed_only)
+				if finding is not None:
+					findings.append(finding)
+	return findings
+
+def minimize(rules: rule.Rules, typed_only: bool = False) -> typing.Tuple[rule.Rules, typing.List[Finding]]:
+	"""Get a copy of rules without any of the findings of analyze (with typed_only).
+
+	Removing one rule can change the findings for others, so every finding is
+	checked again before removing it, until nothing is left to remove.
+
+	Returns the minimized rules and the findings which were removed."""
+	minimized = rule.Rules()
+	minimized.update_from(rules)
+	removed = []  # type: typing.List[Finding]
+	findings = analyze(minimized, typed_only)
+	while findings:
+		dest_sources = _dest_sources(minimized)
+		pass_removed = []
+		for finding in findings:
+			if finding.flag is not None:
+				current = _check_flag(minimized, finding.source, finding.flag)
+				if current is not None:
+					minimized.remove_flag(finding.source, finding.flag)
+			else:
+				assert finding.dest is not None and finding.type is not None
+				current = _check_rule(minimized, finding.source, finding.dest, finding.type,
+									  dest_sources, typed_only)
+				if current is not None:
+					minimized.remove_rule(finding.source, finding.dest, finding.type)
+			if current is not None:
+				pass_removed.append(current)
+		if not pass_removed:
+			break
+		removed.extend(pass_removed)
+		findings = analyze(minimized, typed_only)
+	return minimized, removed
+
+
+def format_finding(finding: Finding) -> str:
+	if finding.flag is not None:
+		text = "{}: {}".format(str(finding.flag), finding.source)
+	else:
+		text = "{} {} {}".format(finding.source, finding.dest, str(finding.type))
+	return "{}: {} ({})".format(finding.issue.name.lower(), text, finding.reason)
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+	parser = argparse.ArgumentParser(
+		prog="python3 -m jmatrix.analysis",
+		description="Report rules which can never change a verdict.")
+	parser.add_argument('rules', help="The rule file to check")
+	parser.add_argument('--minimize', metavar='FILE',
+						help="Write the rules without any of the findings to FILE")
+	parser.add_argument('--typed-only', action='store_true',
+						help="Only keep verdicts on requests of a concrete type, as made by "
+						"qutebrowser (not jmatrix-explain with type *)")
+	args = parser.parse_args(argv)
+
+	rules = rule.Rules()
+	with open(args.rules, "rb") as f:
+		for error in umatrix_parser.parse_rules(f, rules, collate_errors=True):
+			print("error: {}".format(error), file=sys.stderr)
+
+	if args.minimize is None:
+		findings = analyze(rules, args.typed_only)
+	else:
+		minimized, findings = minimize(rules, args.typed_only)
+		umatrix_parser.save_rules(minimized, pathlib.Path(args.minimize))
+	for finding in findings:
+		print(format_finding(finding))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,258 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Bounded caches which can be resized at runtime, and report statistics.
+
+Both caches are mappings from hashable keys to values which are never None,
+and are safe to share between threads."""
+
+import collections
+import enum
+import functools
+import threading
+import typing
+
+
+CacheInfo = typing.NamedTuple('CacheInfo', [
+	('hits', int), ('misses', int), ('maxsize', int), ('currsize', int)])
+
+K = typing.TypeVar('K')
+V = typing.TypeVar('V')
+
+
+class Policy(enum.Enum):
+	"""The eviction policy of a cache."""
+	LRU = 1
+	TWO_Q = 2
+
+
+class LRUCache(typing.Generic[K, V]):
+
+	"""A least recently used cache, like functools.lru_cache."""
+
+	__slots__ = ['maxsize', 'hits', 'misses', '_data']
+
+	policy = Policy.LRU
+
+	def __init__(self, maxsize: int = 2**12) -> None:
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._data = collections.OrderedDict()  # type: typing.OrderedDict[K, V]
+
+	def __len__(self) -> int:
+		return len(self._data)
+
+	def get(self, key: K) -> typing.Optional[V]:
+		value = self._data.get(key)
+		if value is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		try:
+			self._data.move_to_end(key)
+		except KeyError:
+			# Evicted by another thread in the meantime
+			pass
+		return value
+
+	def __setitem__(self, key: K, value: V) -> None:
+		data = self._data
+		data[key] = value
+		while len(data) > self.maxsize:
+			try:
+				data.popitem(last=False)
+			except KeyError:
+				break
+
+	def resize(self, maxsize: int) -> None:
+		"""Change the size of the cache, evicting entries if it shrinks."""
+		self.maxsize = maxsize
+		data = self._data
+		while len(data) > maxsize:
+			data.popitem(last=False)
+
+	def clear(self) -> None:
+		"""Drop all entries. Statistics are kept."""
+		self._data.clear()
+
+	def cache_info(self) -> CacheInfo:
+		return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+class TwoQCache(typing.Generic[K, V]):
+
+	"""A 2Q cache, which is not flushed by keys that are only used once.
+
+	New keys go into a small FIFO queue. Keys evicted from it are remembered
+	(without their value) for a while, and only get into the main LRU queue if
+	they are used again in that time. A stream of one-off keys (eg: tracker
+	hosts seen on a single page) can then only evict other new keys.
+
+	See "2Q: A Low Overhead High Performance Buffer Management Replacement
+	Algorithm" (Johnson, Shasha 1994)."""
+
+	__slots__ = ['maxsize', 'hits', 'misses', '_in', '_out', '_main', '_lock']
+
+	policy = Policy.TWO_Q
+
+	#: The share of maxsize used for new keys
+	IN_RATIO = 0.25
+	#: How many evicted new keys are remembered, as a share of maxsize
+	OUT_RATIO = 0.5
+
+	def __init__(self, maxsize: int = 2**12) -> None:
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._in = collections.OrderedDict()  # type: typing.OrderedDict[K, V]
+		self._out = collections.OrderedDict()  # type: typing.OrderedDict[K, None]
+		self._main = collections.OrderedDict()  # type: typing.OrderedDict[K, V]
+		self._lock = threading.Lock()
+
+	def __len__(self) -> int:
+		return len(self._in) + len(self._main)
+
+	def get(self, key: K) -> typing.Optional[V]:
+		with self._lock:
+			value = self._main.get(key)
+			if value is not None:
+				self._main.move_to_end(key)
+			else:
+				# Hits in the FIFO queue don't change its order
+				value = self._in.get(key)
+			if value is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+			return value
+
+	def __setitem__(self, key: K, value: V) -> None:
+		with self._lock:
+			if key in self._main:
+				self._main[key] = value
+				return
+			if key in self._in:
+				self._in[key] = value
+				return
+			self._reclaim(self.maxsize - 1)
+			if key in self._out:
+				# Used again after leaving the FIFO queue
+				del self._out[key]
+				self._main[key] = value
+			else:
+				self._in[key] = value
+
+	def _reclaim(self, size: int) -> None:
+		"""Evict entries until at most size are left."""
+		in_size = max(1, int(self.maxsize * self.IN_RATIO))
+		out_size = int(self.maxsize * self.OUT_RATIO)
+		while len(self._in) + len(self._main) > size:
+			if len(self._in) > in_size or not self._main:
+				key, _ = self._in.popitem(last=False)
+				self._out[key] = None
+				while len(self._out) > out_size:
+					self._out.popitem(last=False)
+			else:
+				self._main.popitem(last=False)
+
+	def resize(self, maxsize: int) -> None:
+		"""Change the size of the cache, evicting entries if it shrinks."""
+		with self._lock:
+			self.maxsize = maxsize
+			self._reclaim(maxsize)
+
+	def clear(self) -> None:
+		"""Drop all entries. Statistics are kept."""
+		with self._lock:
+			self._in.clear()
+			self._out.clear()
+			self._main.clear()
+
+	def cache_info(self) -> CacheInfo:
+		return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+
+def make_cache(maxsize: int, policy: Policy = Policy.LRU) -> 'typing.Union[LRUCache[K, V], TwoQCache[K, V]]':
+	if policy == Policy.TWO_Q:
+		return TwoQCache(maxsize)
+	return LRUCache(maxsize)
+
+
+R = typing.TypeVar('R')
+R_co = typing.TypeVar('R_co', covariant=True)
+
+MYPY = False
+if MYPY:
+	class CachedCallable(typing.Protocol[R_co]):
+		"""What cached returns: a CachedFunction or a functools.lru_cache wrapper."""
+
+		@property
+		def __wrapped__(self) -> typing.Callable[..., R_co]: ...
+		def __call__(self, *args: typing.Any) -> R_co: ...
+		# Either CacheInfo or functools.lru_cache's
+		def cache_info(self) -> typing.Tuple[int, int, typing.Optional[int], int]: ...
+		def cache_clear(self) -> None: ...
+
+
+class CachedFunction(typing.Generic[R]):
+
+	"""A function with its results cached in cache, like functools.lru_cache."""
+
+	__slots__ = ['cache', '__wrapped__', '__dict__']
+
+	def __init__(self, fn: typing.Callable[..., R],
+				 cache: 'typing.Union[LRUCache[typing.Any, R], TwoQCache[typing.Any, R]]') -> None:
+		self.cache = cache
+		self.__wrapped__ = fn
+		functools.update_wrapper(self, fn)
+
+	def __call__(self, *args: typing.Any) -> R:
+		# Most of these functions take a single argument
+		key = args[0] if len(args) == 1 else args
+		cache = self.cache
+		result = cache.get(key)
+		if result is None:
+			result = self.__wrapped__(*args)
+			cache[key] = result
+		return result
+
+	def cache_info(self) -> CacheInfo:
+		return self.cache.cache_info()
+
+	def cache_clear(self) -> None:
+		self.cache.clear()
+
+def cached(fn: typing.Callable[..., R], maxsize: int = 2**12,
+		   policy: Policy = Policy.LRU) -> 'CachedCallable[R]':
+	"""Cache the results of fn, which takes hashable positional arguments.
+
+	The result has cache_info() and cache_clear() methods, and __wrapped__ set
+	to fn. To resize a cached function, or change its policy, call cached on
+	its __wrapped__ again, which starts with an empty cache.
+
+	LRU caching uses functools.lru_cache, which is much faster than the caches
+	here when hits are cheap."""
+	if policy == Policy.TWO_Q:
+		return CachedFunction(fn, TwoQCache(maxsize))
+	return functools.lru_cache(maxsize=maxsize)(fn)
+
+def cached_with(maxsize: int = 2**12, policy: Policy = Policy.LRU
+				) -> typing.Callable[[typing.Callable[..., R]], 'CachedCallable[R]']:
+	"""A decorator version of cached."""
+	def decorator(fn: typing.Callable[..., R]) -> 'CachedCallable[R]':
+		return cached(fn, maxsize, policy)
+	return decorator
@@ -0,0 +1,223 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A memory efficient storage backend for rule.Rules.
+
+CompactRules stores the matrix as {source: {dest: packed cell}}, where a
+packed cell holds every (Type, Action) pair of a (source, dest) cell in a
+single int (see compiled.pack_cell). Hostnames are interned.
+
+matrix_rules is a view over that storage, which looks like the nested dicts
+of rule.Rules. Unlike those, reading a missing entry never creates it. Writes
+through the view go through set_rule.
+"""
+
+import copy
+import sys
+import typing
+
+from jmatrix import rule
+from jmatrix.compiled import CELL_MASK, type_shift
+
+CELLS_TYPE = typing.Dict[str, typing.Dict[str, int]]
+
+
+class _CellView(typing.MutableMapping[rule.Type, rule.Action]):
+	"""A view of the {Type: Action} cell at (source, dest)."""
+
+	__slots__ = ['_rules', '_source', '_dest']
+
+	def __init__(self, rules: 'CompactRules', source: str, dest: str) -> None:
+		self._rules = rules
+		self._source = source
+		self._dest = dest
+
+	def _packed(self) -> int:
+		return self._rules.cells.get(self._source, {}).get(self._dest, 0)
+
+	def get(self, request_type: rule.Type,  # type: ignore
+			default: typing.Optional[rule.Action] = None) -> typing.Optional[rule.Action]:
+		code = (self._packed() >> type_shift(request_type)) & CELL_MASK
+		return rule.Action(code) if code else default
+
+	def __getitem__(self, request_type: rule.Type) -> rule.Action:
+		# Missing types inherit, like the defaultdicts in rule.Rules (without storing anything)
+		code = (self._packed() >> type_shift(request_type)) & CELL_MASK
+		return rule.Action(code) if code else rule.Action.INHERIT
+
+	def __contains__(self, request_type: object) -> bool:
+		return (isinstance(request_type, rule.Type) and
+				bool((self._packed() >> type_shift(request_type)) & CELL_MASK))
+
+	def __setitem__(self, request_type: rule.Type, action: rule.Action) -> None:
+		self._rules.set_rule(self._source, self._dest, request_type, action)
+
+	def __delitem__(self, request_type: rule.Type) -> None:
+		if request_type not in self:
+			raise KeyError(request_type)
+		self._rules.remove_rule(self._source, self._dest, request_type)
+
+	def __iter__(self) -> typing.Iterator[rule.Type]:
+		packed = self._packed()
+		return (t for t in rule.Type if (packed >> type_shift(t)) & CELL_MASK)
+
+	def __len__(self) -> int:
+		return sum(1 for _ in self)
+
+	def __repr__(self) -> str:
+		return repr(dict(self.items()))
+
+
+class _RowView(typing.MutableMapping[str, typing.MutableMapping[rule.Type, rule.Action]]):
+	"""A view of the {dest: {Type: Action}} row of source."""
+
+	__slots__ = ['_rules', '_source']
+
+	def __init__(self, rules: 'CompactRules', source: str) -> None:
+		self._rules = rules
+		self._source = source
+
+	def _dests(self) -> typing.Dict[str, int]:
+		return self._rules.cells.get(self._source, {})
+
+	def get(self, dest: str,  # type: ignore
+			default: typing.Optional[_CellView] = None) -> typing.Optional[_CellView]:
+		if dest in self._dests():
+			return _CellView(self._rules, self._source, dest)
+		return default
+
+	def __getitem__(self, dest: str) -> _CellView:
+		return _CellView(self._rules, self._source, dest)
+
+	def __contains__(self, dest: object) -> bool:
+		return dest in self._dests()
+
+	def __setitem__(self, dest: str, types: typing.Mapping[rule.Type, rule.Action]) -> None:
+		if dest in self:
+			del self[dest]
+		for request_type, action in types.items():
+			self._rules.set_rule(self._source, dest, request_type, action)
+
+	def __delitem__(self, dest: str) -> None:
+		for request_type in list(self[dest]):
+			self._rules.remove_rule(self._source, dest, request_type)
+
+	def __iter__(self) -> typing.Iterator[str]:
+		return iter(self._dests())
+
+	def __len__(self) -> int:
+		return len(self._dests())
+
+	def __repr__(self) -> str:
+		return repr(dict(self.items()))
+
+
+class _MatrixView(typing.MutableMapping[str, typing.MutableMapping[str, typing.MutableMapping[rule.Type, rule.Action]]]):
+	"""A view of all rules, as {source: {dest: {Type: Action}}}."""
+
+	__slots__ = ['_rules']
+
+	def __init__(self, rules: 'CompactRules') -> None:
+		self._rules = rules
+
+	def get(self, source: str,  # type: ignore
+			default: typing.Optional[_RowView] = None) -> typing.Optional[_RowView]:
+		if source in self._rules.cells:
+			return _RowView(self._rules, source)
+		return default
+
+	def __getitem__(self, source: str) -> _RowView:
+		return _RowView(self._rules, source)
+
+	def __contains__(self, source: object) -> bool:
+		return source in self._rules.cells
+
+	def __setitem__(self, source: str, dests: typing.Mapping[str, typing.Mapping[rule.Type, rule.Action]]) -> None:
+		if source in self:
+			del self[source]
+		row = self[source]
+		for dest, types in dests.items():
+			row[dest] = types
+
+	def __delitem__(self, source: str) -> None:
+		row = self[source]
+		for dest in list(row):
+			del row[dest]
+
+	def __iter__(self) -> typing.Iterator[str]:
+		return iter(self._rules.cells)
+
+	def __len__(self) -> int:
+		return len(self._rules.cells)
+
+	def __repr__(self) -> str:
+		return repr(dict(self.items()))
+
+
+class CompactRules(rule.Rules):
+
+	"""A drop in replacement for rule.Rules, using much less memory.
+
+	Lookups through matrix_rules are slower than with rule.Rules, so this is
+	best used along with compiled.compile_rules."""
+
+	def __init__(self) -> None:
+		super().__init__()
+		#: The actual storage of the matrix, {source: {dest: packed cell}}
+		self.cells = {}  # type: CELLS_TYPE
+		self.matrix_rules = _MatrixView(self)  # type: ignore
+
+	def copy(self) -> 'CompactRules':
+		new = typing.cast(CompactRules, super().copy())
+		new.cells = copy.copy(self.cells)
+		new.matrix_rules = _MatrixView(new)  # type: ignore
+		return new
+
+	def _row(self, source: str) -> typing.Optional[typing.Dict[str, int]]:
+		"""Get the dests of source for changing them, copying them first if they are shared."""
+		dests = self.cells.get(source)
+		owned = self._owned
+		if dests is not None and owned is not None and id(dests) not in owned:
+			dests = self.cells[source] = dict(dests)
+			owned[id(dests)] = dests
+		return dests
+
+	def set_rule(self, source: str, dest: str, request_type: rule.Type, action: rule.Action) -> None:
+		dests = self._row(source)
+		if dests is None:
+			dests = self.cells[sys.intern(source)] = {}
+			if self._owned is not None:
+				self._owned[id(dests)] = dests
+		shift = type_shift(request_type)
+		dests[sys.intern(dest)] = (dests.get(dest, 0) & ~(CELL_MASK << shift)) | (action.value << shift)
+		self._drop_merged(source, dest)
+		self.generation += 1
+
+	def remove_rule(self, source: str, dest: str, request_type: rule.Type) -> None:
+		packed = self.cells.get(source, {}).get(dest, 0)
+		shift = type_shift(request_type)
+		if not (packed >> shift) & CELL_MASK:
+			return
+		dests = typing.cast(typing.Dict[str, int], self._row(source))
+		packed &= ~(CELL_MASK << shift)
+		if packed:
+			dests[dest] = packed
+		else:
+			del dests[dest]
+			if not dests:
+				del self.cells[source]
+		self._drop_merged(source, dest)
+		self.generation += 1
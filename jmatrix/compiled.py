@@ -0,0 +1,226 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A compiled, flat form of rule.Rules for fast lookups.
+
+Compiling a Rules object interns every source hostname to a small integer id,
+and packs all the actions of a (source, dest) cell into a single int, using 2
+bits per rule.Type (the bits hold the rule.Action value, 0 meaning no rule).
+
+This lets us answer both the 'exact type' and the '*' type question of a cell
+with a single dict lookup per source, instead of 3 levels of nested dicts.
+"""
+
+import typing
+
+from jmatrix import interceptor, rule
+
+_BLOCK = rule.Action.BLOCK.value
+_ALLOW = rule.Action.ALLOW.value
+
+#: Bits used per request type in a packed cell.
+CELL_BITS = 2
+CELL_MASK = (1 << CELL_BITS) - 1
+
+#: The shift of the '*' request type in a packed cell.
+_ALL_SHIFT = rule.Type.ALL.value * CELL_BITS
+
+
+def type_shift(request_type: rule.Type) -> int:
+	"""Get the offset of request_type in a packed cell."""
+	return request_type.value * CELL_BITS
+
+
+def pack_cell(types: typing.Mapping[rule.Type, rule.Action]) -> int:
+	"""Pack a {Type: Action} mapping into a single int."""
+	packed = 0
+	for request_type, action in types.items():
+		packed |= action.value << type_shift(request_type)
+	return packed
+
+
+def unpack_cell(packed: int) -> typing.Dict[rule.Type, rule.Action]:
+	"""The inverse of pack_cell."""
+	return {
+		request_type: rule.Action((packed >> type_shift(request_type)) & CELL_MASK)
+		for request_type in rule.Type
+		if (packed >> type_shift(request_type)) & CELL_MASK
+	}
+
+
+class CompiledRules():
+
+	"""An immutable, compiled version of a rule.Rules object.
+
+	Create these with compile_rules. Changes to the source Rules are not
+	reflected here, so it must be recompiled after every change."""
+
+	__slots__ = ['source_ids', 'cells', 'matrix_off', 'https_strict']
+
+	def __init__(
+			self, source_ids: typing.Dict[str, int],
+			cells: typing.Dict[str, typing.Dict[int, int]],
+			matrix_off: typing.FrozenSet[str],
+			https_strict: typing.FrozenSet[str]) -> None:
+		#: Interned ids of every source hostname with at least one rule.
+		self.source_ids = source_ids
+		#: {dest: {source id: packed cell}}
+		self.cells = cells
+		#: Hosts (and schemes) that have matrix-off enabled.
+		self.matrix_off = matrix_off
+		#: Hosts (and schemes) that have https-strict enabled.
+		self.https_strict = https_strict
+
+	def context_ids(self, context_hostname: str) -> typing.Tuple[int, ...]:
+		"""Get the source ids that apply to context_hostname, most specific first."""
+		source_ids = self.source_ids
+		return tuple(
+			source_ids[host] for host in interceptor._hostname_widen_list(context_hostname)
+			if host in source_ids)
+
+	def _probe(
+			self, context_ids: typing.Tuple[int, ...],
+			dest: str, shift: int) -> typing.Tuple[int, int]:
+		"""Index into a cell, for both the request type at shift and the '*' type.
+
+		Returns the (type action, '*' action) values, 0 if there is no rule."""
+		column = self.cells.get(dest)
+		if column is None:
+			return 0, 0
+		r_type = r_all = 0
+		for source_id in context_ids:
+			packed = column.get(source_id)
+			if packed is None:
+				continue
+			if not r_type:
+				r_type = (packed >> shift) & CELL_MASK
+			if not r_all:
+				r_all = (packed >> _ALL_SHIFT) & CELL_MASK
+			if r_type and r_all:
+				break
+		return r_type, r_all
+
+	def should_block(
+			self, context_hostname: str, context_scheme: str,
+			request_hostname: str, request_scheme: str,
+			request_type: rule.Type, fpdomain_fn: typing.Callable[[str], str]) -> bool:
+		"""Check if we should block a certain url.
+
+		This gives exactly the same results as interceptor.should_block on the
+		rules this was compiled from."""
+		widened_context = interceptor._hostname_widen_list(context_hostname)
+		context_scheme_host = context_scheme + "-scheme"
+
+		matrix_off = self.matrix_off
+		if matrix_off and (context_scheme_host in matrix_off or
+						   not matrix_off.isdisjoint(widened_context)):
+			return False
+
+		https_strict = self.https_strict
+		if https_strict and (context_scheme_host in https_strict or
+							 not https_strict.isdisjoint(widened_context)):
+			if context_scheme == "https" and request_scheme != "https":
+				return True
+
+		context_ids = self.context_ids(context_hostname)
+		shift = type_shift(request_type)
+		probe = self._probe
+
+		# See interceptor.should_block for the reasoning behind this ordering
+
+		# Exact hostname, exact type and any type
+		r, r_override = probe(context_ids, request_hostname, shift)
+		if r == _ALLOW: return False
+		elif r == _BLOCK: return True
+
+		request = interceptor.host_info(request_hostname, fpdomain_fn)
+		widened_request = request.widened
+		dest = request_hostname
+		first_party_domain = request.fp_domain
+		if interceptor.host_info(context_hostname, fpdomain_fn).fp_domain != first_party_domain:
+			first_party_domain = ""
+
+		# Ancestor cells up to 1st-party request domain
+		if first_party_domain:
+			for domain in widened_request:
+				dest = domain
+				if domain == first_party_domain:
+					break
+				r, r_all = probe(context_ids, domain, shift)
+				if r == _ALLOW: return False
+				elif r == _BLOCK: return True
+
+				if r_override != _ALLOW:
+					r_override = r_all
+					if r_override == _BLOCK: return True
+
+			# First party special case cell
+			r, r_all = probe(context_ids, '1st-party', shift)
+			if r == _ALLOW: return False
+			elif r == _BLOCK: return True
+
+			if r_override != _ALLOW:
+				r_override = r_all
+				if r_override == _BLOCK: return True
+			search_domains = interceptor._hostname_widen_list(dest)
+		else:
+			search_domains = widened_request
+
+		# Go up to root
+		for domain in search_domains:
+			if domain == '*':
+				break
+			r, r_all = probe(context_ids, domain, shift)
+			if r == _ALLOW: return False
+			elif r == _BLOCK: return True
+
+			if r_override != _ALLOW:
+				r_override = r_all
+				if r_override == _BLOCK: return True
+
+		# Hostname specific type cells, then the hostname type api call
+		r, r_all = probe(context_ids, '*', shift)
+		if r == _BLOCK: return True
+		if r_override == _ALLOW: return False
+		if r == _ALLOW: return False
+
+		if r_all == _BLOCK: return True
+		if r_all == _ALLOW: return False
+
+		# No rules, block
+		return True
+
+
+def compile_rules(rules: rule.Rules) -> CompiledRules:
+	"""Compile rules into a CompiledRules object."""
+	source_ids = {}  # type: typing.Dict[str, int]
+	cells = {}  # type: typing.Dict[str, typing.Dict[int, int]]
+	for source, dests in rules.matrix_rules.items():
+		for dest, types in dests.items():
+			packed = pack_cell(types)
+			if not packed:
+				continue
+			source_id = source_ids.setdefault(source, len(source_ids))
+			cells.setdefault(dest, {})[source_id] = packed
+
+	def enabled(flag: rule.Flag) -> typing.FrozenSet[str]:
+		return frozenset(
+			host for host, flags in rules.matrix_flags.items()
+			if flags.get(flag, False))
+
+	return CompiledRules(
+		source_ids, cells,
+		enabled(rule.Flag.MATRIX_OFF), enabled(rule.Flag.HTTPS_STRICT))
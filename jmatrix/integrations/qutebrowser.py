@@ -16,9 +16,9 @@
 
 ## TODO FIXME make config-source not be super painful
 
-import sys, os, time
+import atexit, sys, os, threading, time, typing
 
-import jmatrix.rule, jmatrix.umatrix_parser, jmatrix.interceptor
+import jmatrix.rule, jmatrix.umatrix_parser, jmatrix.interceptor, jmatrix.rule_cache, jmatrix.seen_requests, jmatrix.stats, jmatrix.loader, jmatrix.cache, jmatrix.request_log
 from jmatrix.vendor.fpdomain import fpdomain
 
 from qutebrowser.api import interceptor, cmdutils, message, apitypes
@@ -30,6 +30,12 @@ from qutebrowser.config.config import ConfigContainer # noqa: F401
 
 from qutebrowser.misc import editor
 
+try:
+	from qutebrowser.qt.core import QObject, pyqtSignal, pyqtSlot  # type: ignore[import-not-found]
+except ImportError:
+	# qutebrowser < 3
+	from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot  # type: ignore[import-not-found]
+
 config = config  # type: ConfigAPI # noqa: F821 pylint: disable=E0602,C0103
 c = c  # type: ConfigContainer # noqa: F821 pylint: disable=E0602,C0103
 
@@ -40,43 +46,202 @@ if MYPY:
 # If false, disable blocking. Usually changed via the jmatrix-toggle command
 JMATRIX_ENABLED = True
 
-# Used to actually decide if we should block a rule or not
-JMATRIX_RULES = jmatrix.rule.Rules()
-
-# Used to track requests that we have seen for purposes of completion
-SEEN_REQUESTS = jmatrix.rule.Rules()
+# Used to actually decide if we should block a rule or not. Requests are
+# intercepted on another thread, so this is never changed in place: take
+# JMATRIX_RULES.rules once, and change it with JMATRIX_RULES.edit()
+JMATRIX_RULES = jmatrix.rule.RulesRef()
+
+# Used to track requests that we have seen for purposes of completion. Bounded
+# to SEEN_REQUESTS_MAX_ENTRIES (context host, request host) pairs in total, and
+# SEEN_REQUESTS_MAX_PER_HOST per context host.
+SEEN_REQUESTS_MAX_ENTRIES = 2**16
+SEEN_REQUESTS_MAX_PER_HOST = 2**10
+SEEN_REQUESTS = jmatrix.seen_requests.SeenRequests(
+	SEEN_REQUESTS_MAX_ENTRIES, SEEN_REQUESTS_MAX_PER_HOST)
+
+# Used to avoid re-evaluating requests we have already made a decision on
+VERDICT_CACHE = jmatrix.interceptor.VerdictCache()
+
+# Instrumentation of the request interceptor, only set while enabled (see
+# :jmatrix-stats). Set this to True to enable it from startup.
+JMATRIX_STATS_ENABLED = False
+STATS = None  # type: typing.Optional[jmatrix.stats.Stats]
+
+# Every verdict of the request interceptor is appended to
+# JMATRIX_REQUEST_LOG_FILE while this is set (see :jmatrix-log). Set
+# JMATRIX_REQUEST_LOG_ENABLED to True to enable it once the config is read,
+# at startup and on jmatrix-read-config. The log can be read with
+# jmatrix.request_log, or replayed with jmatrix.replay.
+JMATRIX_REQUEST_LOG_ENABLED = False
+REQUEST_LOG = None  # type: typing.Optional[jmatrix.request_log.RequestLog]
 
 # Used to handle first party domains
 PSL = None
+# What requests are checked with: the fp_domain of PSL, or a fallback ignoring
+# public suffixes while the PSL can't be loaded (see _publish_psl). None
+# until the rules are loaded for the first time.
+FP_DOMAIN = None  # type: typing.Optional[typing.Callable[[str], str]]
+# If the PSL fails to load, it's loaded again after this many seconds,
+# doubling up to PSL_RETRY_MAX_DELAY after every failure
+PSL_RETRY_DELAY = 30
+PSL_RETRY_MAX_DELAY = 60 * 60
+_PSL_RETRY = None  # type: typing.Optional[threading.Timer]
+_psl_retry_delay = PSL_RETRY_DELAY
+
+# Size and eviction policy of the caches of the PSL, and of everything else
+# computed per hostname. These are applied on jmatrix-read-config, and changing
+# them starts over with empty caches. With jmatrix.cache.Policy.TWO_Q, hosts
+# only seen once (eg: trackers on a single page) can't evict the hosts seen on
+# every page.
+JMATRIX_HOST_CACHE_SIZE = jmatrix.interceptor.HOST_CACHE_SIZE
+JMATRIX_HOST_CACHE_POLICY = jmatrix.cache.Policy.LRU
+
+# The (size, mtime) of PSL_FILE when PSL was loaded
+PSL_STAMP = None
+
+# Rules and the PSL are loaded on a worker thread. Until they are loaded for
+# the first time, requests are allowed (fail open) or blocked (fail closed)
+# according to this.
+JMATRIX_LOADING_POLICY = jmatrix.loader.LoadPolicy.BLOCK
 
 JMATRIX_CONFIG = config.configdir / "jmatrix-rules"
 PSL_FILE = config.datadir / "psl"
+# Where to download the PSL from when PSL_FILE is missing
+PSL_URL = fpdomain.PSL.PSL_URL
+# Parsed version of JMATRIX_CONFIG, to speed up startup
+JMATRIX_CONFIG_CACHE = config.datadir / "jmatrix-rules.cache"  # type: ignore[name-defined]
+JMATRIX_REQUEST_LOG_FILE = config.datadir / "jmatrix-requests.jmlog"  # type: ignore[name-defined]
 
 if not JMATRIX_CONFIG.exists():
 	# Create the file with the default config
 	with open(JMATRIX_CONFIG, "w", encoding="utf-8") as f:
 		f.write(jmatrix.rule.JMATRIX_HEADER + jmatrix.rule.DEFAULT_RULES)
 
+def _psl_stamp() -> typing.Optional[typing.Tuple[int, int]]:
+	try:
+		stat = PSL_FILE.stat()
+	except OSError:
+		return None
+	return (stat.st_size, stat.st_mtime_ns)
+
+def _report_errors(errors: typing.Iterable[jmatrix.umatrix_parser.JMatrixParserError]) -> None:
+	tuple(map(message.error, map("!!!!!!!!! Error parsing umatrix rule: {} !!!!!!!".format, errors)))
+
+def _on_load_error(e: BaseException) -> None:
+	message.error("jmatrix failed to load rules: {}".format(e))
+
+class _MainThread(QObject):  # type: ignore[misc]
+
+	"""Runs functions on the thread it was created on, the GUI thread."""
+
+	call = pyqtSignal(object)
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.call.connect(self._run)
+
+	@pyqtSlot(object)  # type: ignore[untyped-decorator]
+	def _run(self, fn: typing.Callable[[], None]) -> None:
+		fn()
+
+_MAIN_THREAD = _MainThread()
+
+# Loads run on a worker thread, one at a time. What they loaded is published
+# (and errors reported) on the GUI thread.
+LOADER = jmatrix.loader.BackgroundLoader(_on_load_error, _MAIN_THREAD.call.emit)
+
+PSL_RESULT_TYPE = typing.Tuple[typing.Optional[fpdomain.PSL], typing.Optional[Exception]]
+
+def _load_psl() -> PSL_RESULT_TYPE:
+	return jmatrix.loader.try_load_psl(PSL_FILE, PSL_URL, JMATRIX_HOST_CACHE_SIZE, JMATRIX_HOST_CACHE_POLICY)
+
+def _fp_domain_without_psl(host: str) -> str:
+	# Through the module, see configure_host_caches
+	return jmatrix.interceptor._get_first_party_domain(host)
+
+def _publish_psl(result: PSL_RESULT_TYPE) -> None:
+	"""Swap a loaded PSL in, or fall back and retry later if it failed to load."""
+	global PSL, PSL_STAMP, FP_DOMAIN, _PSL_RETRY, _psl_retry_delay
+	psl, error = result
+	if _PSL_RETRY is not None:
+		_PSL_RETRY.cancel()
+		_PSL_RETRY = None
+	if psl is not None:
+		PSL_STAMP = _psl_stamp()
+		PSL = psl
+		FP_DOMAIN = psl.fp_domain
+		# Also releases the previous PSL from the host caches
+		jmatrix.interceptor.set_suffix_index(psl.fp_domain)
+		_psl_retry_delay = PSL_RETRY_DELAY
+		return
+	if PSL is not None:
+		# Keep the one we have
+		message.error("jmatrix failed to reload the public suffix list: {}".format(error))
+		return
+	message.error("jmatrix failed to load the public suffix list, retrying in {}s: {}".format(
+		_psl_retry_delay, error))
+	jmatrix.interceptor.set_suffix_index(None)
+	FP_DOMAIN = _fp_domain_without_psl
+	_PSL_RETRY = threading.Timer(_psl_retry_delay, LOADER.start, (_load_psl, _publish_psl))
+	_PSL_RETRY.daemon = True
+	_PSL_RETRY.start()
+	_psl_retry_delay = min(2 * _psl_retry_delay, PSL_RETRY_MAX_DELAY)
+
+def _load() -> jmatrix.loader.Loaded:
+	return jmatrix.loader.load(JMATRIX_CONFIG, JMATRIX_CONFIG_CACHE, PSL_FILE, PSL_URL,
+							   JMATRIX_HOST_CACHE_SIZE, JMATRIX_HOST_CACHE_POLICY)
+
+def _publish(loaded: jmatrix.loader.Loaded) -> None:
+	"""Swap freshly loaded rules and PSL in, called on the GUI thread."""
+	SEEN_REQUESTS.clear()
+	VERDICT_CACHE.clear()
+	JMATRIX_RULES.publish(loaded.rules)
+	# The request hook treats a missing FP_DOMAIN as still loading, so set it last
+	_publish_psl((loaded.psl, loaded.psl_error))
+	# Read here, not when this file is sourced, so it can be set afterwards
+	if JMATRIX_REQUEST_LOG_ENABLED:
+		_set_request_log_enabled(True)
+	_report_errors(loaded.errors)
+
+RELOAD_TYPE = typing.Tuple[jmatrix.rule.Rules, typing.List[jmatrix.umatrix_parser.JMatrixParserError], PSL_RESULT_TYPE]
+
+def _load_changes() -> RELOAD_TYPE:
+	rules, errors = jmatrix.rule_cache.load_rules(JMATRIX_CONFIG, JMATRIX_CONFIG_CACHE)
+	psl_result = (None, None)  # type: PSL_RESULT_TYPE
+	if PSL is None or _psl_stamp() != PSL_STAMP:
+		psl_result = _load_psl()
+	return rules, errors, psl_result
+
+def _publish_changes(changes: RELOAD_TYPE) -> None:
+	"""Apply reloaded rules to the live ones, called on the GUI thread."""
+	rules, errors, psl_result = changes
+	with JMATRIX_RULES.edit() as live:
+		live.update_from(rules)
+	if psl_result != (None, None):
+		_publish_psl(psl_result)
+	_report_errors(errors)
+
 @cmdutils.register()
 def jmatrix_read_config() -> None:
-	"""Overwrite internal config with the one in the jmatrix config file."""
-	global JMATRIX_RULES
-	global SEEN_REQUESTS
-	global PSL
-	JMATRIX_RULES = jmatrix.rule.Rules()
-	SEEN_REQUESTS = jmatrix.rule.Rules()
-	with open(JMATRIX_CONFIG, "r", encoding="utf-8") as f:
-		errors = jmatrix.umatrix_parser.rules_to_map(f, JMATRIX_RULES, collate_errors=True)
-		tuple(map(message.error, map("!!!!!!!!! Error parsing umatrix rule: {} !!!!!!!".format, errors)))
-	PSL = fpdomain.PSL(PSL_FILE)
+	"""Overwrite internal config with the one in the jmatrix config file.
+
+	The file is read in the background, the current rules stay in use until
+	it's done."""
+	jmatrix.interceptor.configure_host_caches(JMATRIX_HOST_CACHE_SIZE, JMATRIX_HOST_CACHE_POLICY)
+	LOADER.start(_load, _publish)
+
+def _reload_config() -> None:
+	"""Apply changes made to the jmatrix config file to the current rules.
+
+	Unlike jmatrix_read_config, only the rules that changed are touched, seen
+	requests are kept, and the PSL is only reloaded if it changed on disk."""
+	LOADER.start(_load_changes, _publish_changes)
 
 @cmdutils.register()
 def jmatrix_write_config() -> None:
 	"""Write out current rules."""
 	# This will strip out the "ignored" values in the default config.
-	text = jmatrix.umatrix_parser.map_to_rules(JMATRIX_RULES)
-	with open(JMATRIX_CONFIG, "w", encoding="utf-8") as f:
-		f.write(jmatrix.rule.JMATRIX_HEADER + text)
+	jmatrix.umatrix_parser.save_rules(JMATRIX_RULES.rules, JMATRIX_CONFIG, jmatrix.rule.JMATRIX_HEADER)
 
 @cmdutils.register(instance='config-commands')
 def jmatrix_edit_config(self, no_source: bool = False) -> None:
@@ -89,10 +254,7 @@ def jmatrix_edit_config(self, no_source: bool = False) -> None:
 		"""Source the new config when editing finished.
 
 		"""
-		try:
-			jmatrix_read_config()
-		except:
-			message.error("Unexpected error while reloading rules file. Check syntax?")
+		_reload_config()
 
 	ed = editor.ExternalEditor(watch=True, parent=self._config)
 	if not no_source:
@@ -125,11 +287,30 @@ QUTEBROWSER_JMATRIX_RESOURCE_WHITELIST = frozenset({
 	interceptor.ResourceType.favicon})
 
 def _jmatrix_intercept_request(info: interceptor.Request) -> None:
+	stats = STATS
+	if stats is None:
+		_jmatrix_intercept(info)
+		return
+	blocks = sys.getallocatedblocks()
+	start = time.perf_counter_ns()
+	_jmatrix_intercept(info)
+	elapsed = time.perf_counter_ns() - start
+	stats.record_request(
+		QUTEBROWSER_JMATRIX_MAPPING.get(info.resource_type, jmatrix.rule.Type.OTHER),
+		elapsed, sys.getallocatedblocks() - blocks)
+
+def _jmatrix_intercept(info: interceptor.Request) -> None:
 	request_type = info.resource_type
 	# If we are already blocked or whitelisted, don't waste our time here.
 	if (not JMATRIX_ENABLED or
 		info.is_blocked or
 		request_type in QUTEBROWSER_JMATRIX_RESOURCE_WHITELIST): return
+	fp_domain = FP_DOMAIN
+	if fp_domain is None:
+		# Still loading
+		if JMATRIX_LOADING_POLICY == jmatrix.loader.LoadPolicy.BLOCK:
+			info.block()
+		return
 	first_party_url = info.first_party_url
 	if first_party_url.isEmpty():
 		# This case occurs when downloading URLs. Ideally we would hard-block
@@ -149,15 +330,19 @@ def _jmatrix_intercept_request(info: interceptor.Request) -> None:
 	request_host = info.request_url.host()
 
 	jmatrix_type = QUTEBROWSER_JMATRIX_MAPPING.get(request_type, jmatrix.rule.Type.OTHER)
-	block = jmatrix.interceptor.should_block(
+	block = VERDICT_CACHE.should_block(
 		context_host, context_scheme,
 		request_host, request_scheme,
-		jmatrix_type, PSL.fp_domain, JMATRIX_RULES)
+		jmatrix_type, fp_domain, JMATRIX_RULES.rules)
 	if block:
 		info.block()
 
-	SEEN_REQUESTS.matrix_rules[context_host][request_host][jmatrix_type] = \
-		jmatrix.rule.Action.BLOCK if block else jmatrix.rule.Action.ALLOW
+	SEEN_REQUESTS.record(
+		context_host, request_host, jmatrix_type,
+		jmatrix.rule.Action.BLOCK if block else jmatrix.rule.Action.ALLOW)
+	log = REQUEST_LOG
+	if log is not None:
+		log.record(context_host, context_scheme, request_host, request_scheme, jmatrix_type, block)
 
 interceptor.register(_jmatrix_intercept_request)
 
@@ -166,22 +351,14 @@ def _get_rules_completion(*args, info):
 	model = completionmodel.CompletionModel(column_widths=(100,))
 	entries = [
 		("{:10}{:10}{}".format(action.name, res_type.name.lower(), dest),) for
-		dest, types in SEEN_REQUESTS.matrix_rules[tab.url().host()].items() for
-		res_type, action in types.items()
+		dest, res_type, action in SEEN_REQUESTS.entries(tab.url().host())
 	]
 	cat = listcategory.ListCategory("Requests", entries)
 	model.add_category(cat)
 	return model
 
-@cmdutils.register()
-@cmdutils.argument("rule", completion=_get_rules_completion)
-@cmdutils.argument("tab", value=cmdutils.Value.cur_tab)
-def jmatrix_toggle_rule(tab: apitypes.Tab, rule: str):
-	"""View request types made on this host and block/allow them.
-
-	Requests are collated based on the host of the URL, so you may see requests from other pages on the same host.
-
-	"""
+def _parse_completion(rule: str) -> typing.Tuple[str, jmatrix.rule.Type, str]:
+	"""Split a rule from _get_rules_completion into its action, type and destination."""
 	try:
 		action, res_type, dest = rule.split()
 	except ValueError:
@@ -189,21 +366,109 @@ def jmatrix_toggle_rule(tab: apitypes.Tab, rule: str):
 			"Expected input of the form \"block/allow request_type "
 			"destination_host\""
 		)
-	if action.upper() == "BLOCK":
-		action = jmatrix.rule.Action.ALLOW
-	else:
-		action = jmatrix.rule.Action.BLOCK
 	if res_type == '*':
 		res_type = "ALL"
 	try:
-		res_type = jmatrix.rule.Type[res_type.upper()]
+		return action, jmatrix.rule.Type[res_type.upper()], dest
 	except KeyError:
-		message.error("Type '{}' not recognized".format(res_type))
+		raise cmdutils.CommandError("Type '{}' not recognized".format(res_type))
+
+@cmdutils.register()  # type: ignore[untyped-decorator]
+@cmdutils.argument("rule", completion=_get_rules_completion)  # type: ignore[untyped-decorator]
+@cmdutils.argument("tab", value=cmdutils.Value.cur_tab)  # type: ignore[untyped-decorator]
+def jmatrix_explain(tab: apitypes.Tab, rule: str) -> None:
+	"""Show which rule decides if a request made on this host is blocked.
+
+	The request is assumed to use the same scheme as the current page.
+
+	"""
+	_, res_type, dest = _parse_completion(rule)
+	fp_domain = FP_DOMAIN
+	if fp_domain is None:
+		raise cmdutils.CommandError("jmatrix is still loading")
+	url = tab.url()
+	decision = jmatrix.interceptor.decide(
+		url.host(), url.scheme(), dest, url.scheme(), res_type, fp_domain, JMATRIX_RULES.rules)
+	message.info("{} {}: {}".format(
+		str(res_type), dest, jmatrix.interceptor.format_decision(decision)))
+
+@cmdutils.register()
+@cmdutils.argument("rule", completion=_get_rules_completion)
+@cmdutils.argument("tab", value=cmdutils.Value.cur_tab)
+def jmatrix_toggle_rule(tab: apitypes.Tab, rule: str) -> None:
+	"""View request types made on this host and block/allow them.
+
+	Requests are collated based on the host of the URL, so you may see requests from other pages on the same host.
+
+	"""
+	action_name, res_type, dest = _parse_completion(rule)
+	if action_name.upper() == "BLOCK":
+		action = jmatrix.rule.Action.ALLOW
+	else:
+		action = jmatrix.rule.Action.BLOCK
 	origin = tab.url().host()
-	JMATRIX_RULES.matrix_rules[origin][dest][res_type] = action
+	with JMATRIX_RULES.edit() as rules:
+		rules.set_rule(origin, dest, res_type, action)
 	# Change our seen requests to match so it'll show up in the completion
 	# without having to reload the page.
-	SEEN_REQUESTS.matrix_rules[origin][dest][res_type] = action
+	SEEN_REQUESTS.record(origin, dest, res_type, action)
+
+def _set_stats_enabled(enabled: bool) -> None:
+	global STATS
+	if enabled and STATS is None:
+		STATS = jmatrix.stats.Stats(VERDICT_CACHE)
+	elif not enabled:
+		STATS = None
+	VERDICT_CACHE.stats = STATS
+
+_set_stats_enabled(JMATRIX_STATS_ENABLED)
+
+@cmdutils.register()  # type: ignore[untyped-decorator]
+def jmatrix_stats(reset: bool = False, disable: bool = False) -> None:
+	"""Show statistics about request interception, enabling them if needed.
+
+	Collecting statistics makes every request slightly slower, so it's off
+	until this command is first run.
+
+	Args:
+		reset: Clear the statistics collected so far.
+		disable: Stop collecting statistics.
+	"""
+	if disable:
+		_set_stats_enabled(False)
+		message.info("jmatrix statistics have been disabled")
+		return
+	if STATS is None:
+		_set_stats_enabled(True)
+		message.info("jmatrix statistics have been enabled")
+		return
+	if reset:
+		STATS.reset()
+		return
+	message.info(jmatrix.stats.format_snapshot(STATS.snapshot()))
+
+def _set_request_log_enabled(enabled: bool) -> None:
+	global REQUEST_LOG
+	log = REQUEST_LOG
+	if enabled and log is None:
+		# Readable, so a block cut short by a crash can be dropped
+		REQUEST_LOG = jmatrix.request_log.RequestLog(open(JMATRIX_REQUEST_LOG_FILE, "a+b"))
+	elif not enabled and log is not None:
+		REQUEST_LOG = None
+		log.close()
+
+atexit.register(_set_request_log_enabled, False)
+
+@cmdutils.register()  # type: ignore[untyped-decorator]
+def jmatrix_log(disable: bool = False) -> None:
+	"""Append the verdict on every request to the jmatrix request log.
+
+	Args:
+		disable: Stop logging requests.
+	"""
+	_set_request_log_enabled(not disable)
+	message.info("jmatrix request log {}: {}".format(
+		"disabled" if disable else "enabled", JMATRIX_REQUEST_LOG_FILE))
 
 @cmdutils.register()
 def jmatrix_toggle(quiet=False):
@@ -16,13 +16,21 @@
 
 """Functions to determine if a request should be blocked or not."""
 
+import array
+import collections
+import collections.abc
+import enum
 import functools
 import itertools
 import typing
 import re
 import operator
 
-from jmatrix import rule
+from jmatrix import cache, rule
+
+MYPY = False
+if MYPY:
+	from jmatrix import stats
 
 def _generate_widened_hostnames(hostname: str) -> typing.Iterator[str]:
 	"""A generator for widening hostnames."""
@@ -31,7 +39,10 @@ def _generate_widened_hostnames(hostname: str) -> typing.Iterator[str]:
 		hostname = hostname.partition(".")[-1]
 	yield '*'
 
-@functools.lru_cache(maxsize=2**8)
+#: The default size of the caches of hostname functions, see configure_host_caches
+HOST_CACHE_SIZE = 2**12
+
+@cache.cached_with(HOST_CACHE_SIZE)
 def _hostname_widen_list(hostname: str) -> typing.Tuple[str, ...]:
 	"""An list generator which widens a hostname.
 
@@ -41,30 +52,144 @@ def _hostname_widen_list(hostname: str) -> typing.Tuple[str, ...]:
 
 IP_ADDR_NAIVE = re.compile(r'^\d+\.\d+\.\d+\.\d+$|^\[[\da-zA-Z:]+\]$')
 
-@functools.lru_cache(maxsize=2**8)
+#: The fp_domain of a PSL used by _get_first_party_domain, see set_suffix_index
+_SUFFIX_INDEX = None  # type: typing.Optional[typing.Callable[[str], str]]
+
+def set_suffix_index(fp_domain: typing.Optional[typing.Callable[[str], str]]) -> None:
+	"""Make _get_first_party_domain use fp_domain (eg: PSL.fp_domain).
+
+	If fp_domain is None, the TLD is assumed to be the last label. Call this
+	whenever another PSL is used: it also empties the cache of host_info,
+	which is keyed on fpdomain_fn and would keep older PSLs alive."""
+	global _SUFFIX_INDEX
+	_SUFFIX_INDEX = fp_domain
+	_get_first_party_domain.cache_clear()
+	host_info.cache_clear()
+
+@cache.cached_with(HOST_CACHE_SIZE)
 def _get_first_party_domain(host: str) -> str:
 	"""Get the part of a url to compare 'first party' domains."""
-	# TODO we should probably use the public suffix list here, instead of assuming TLD is 1 block
-	if not IP_ADDR_NAIVE.search(host):
-		return ".".join(host.rsplit('.', 2)[-2:])
-	return host
-
-def _evaluate_cell_z(
-		src_hostname_map: typing.Iterable[typing.Dict[str, typing.Dict[rule.Type, rule.Action]]],
-		request_hostname: str,
-		request_type: rule.Type, rules: rule.Rules) -> typing.Optional[rule.Action]:
-	"""Index into a cell in the matrix.
-
-	src_hostname_map are 1st level entries present in rules.matrix_rules
-	(this helps improve performance)"""
-	for hostname_map in src_hostname_map:
-		r2 = hostname_map.get(request_hostname)
-		if r2 is None:
-			continue
-		r3 = r2.get(request_type)
-		if r3 is not None:
-			return r3
-	return None
+	if IP_ADDR_NAIVE.search(host):
+		return host
+	suffix_index = _SUFFIX_INDEX
+	if suffix_index is not None:
+		return suffix_index(host)
+	return ".".join(host.rsplit('.', 2)[-2:])
+
+HostInfo = typing.NamedTuple('HostInfo', [
+	('hostname', str),
+	# The hostname, widened up to '*' (see _hostname_widen_list)
+	('widened', typing.Tuple[str, ...]),
+	# The 'first party' domain, as given by fpdomain_fn
+	('fp_domain', str),
+	('is_ip', bool),
+])
+
+@cache.cached_with(HOST_CACHE_SIZE)
+def host_info(hostname: str, fpdomain_fn: typing.Callable[[str], str]) -> HostInfo:
+	"""Get everything should_block needs to know about hostname.
+
+	IP addresses are their own first party domain, fpdomain_fn is not called for them."""
+	is_ip = IP_ADDR_NAIVE.search(hostname) is not None
+	return HostInfo(hostname, _hostname_widen_list(hostname),
+					hostname if is_ip else fpdomain_fn(hostname), is_ip)
+
+# The (maxsize, policy) of the host caches, see configure_host_caches
+_host_cache_config = (HOST_CACHE_SIZE, cache.Policy.LRU)
+
+def configure_host_caches(maxsize: int = HOST_CACHE_SIZE, policy: cache.Policy = cache.Policy.LRU) -> None:
+	"""Replace the caches of the functions analyzing hostnames with empty ones.
+
+	The caches are not resized in place (functools.lru_cache can't be), so
+	this flushes them, unless maxsize and policy are the ones in use already.
+	Other modules must call these functions through this module (not import
+	them by name) to see the new caches."""
+	global _hostname_widen_list, _get_first_party_domain, host_info, _host_cache_config
+	if (maxsize, policy) == _host_cache_config:
+		return
+	_host_cache_config = (maxsize, policy)
+	_hostname_widen_list = cache.cached(_hostname_widen_list.__wrapped__, maxsize, policy)
+	_get_first_party_domain = cache.cached(_get_first_party_domain.__wrapped__, maxsize, policy)
+	host_info = cache.cached(host_info.__wrapped__, maxsize, policy)
+
+ContextInfo = typing.NamedTuple('ContextInfo', [
+	('hostname', str),
+	# If the matrix is off for this context, nothing is blocked
+	('matrix_off', bool),
+	# If https-strict is on and the context is https, non-https requests are blocked
+	('https_only', bool),
+	# The entries of rules.matrix_rules that apply, merged. Looking up a cell
+	# there gives the action of the most specific source that has it.
+	('merged_row', rule.MergedRow),
+])
+
+def _prepare_context(context_hostname: str, context_scheme: str, rules: rule.Rules) -> ContextInfo:
+	"""Compute everything in should_block that only depends on the context."""
+	widened = _hostname_widen_list(context_hostname)
+	# Only using context against matrix_flags, remove irrelevant entries
+	widened_context = tuple(filter(
+		functools.partial(operator.contains, rules.matrix_flags), widened))
+	is_https = context_scheme == "https"
+
+	# First check if we have a matrix-off rule
+	context_scheme += "-scheme"
+	matrix_off = any(map(
+		lambda host: rules.matrix_flags.get(host, {}).get(rule.Flag.MATRIX_OFF, False),
+		itertools.chain(widened_context, [context_scheme])))
+
+	https_strict = any(map(
+		lambda host: rules.matrix_flags.get(host, {}).get(rule.Flag.HTTPS_STRICT, False),
+		itertools.chain(widened_context, [context_scheme])))
+
+	return ContextInfo(
+		context_hostname, matrix_off, https_strict and is_https, rules.merged_row(widened))
+
+#: How many prepared contexts are kept in a rules object, see prepare_context
+MAX_CONTEXTS = 2**10
+
+def prepare_context(context_hostname: str, context_scheme: str, rules: rule.Rules) -> ContextInfo:
+	"""Get the context dependent part of should_block, cached in rules.contexts.
+
+	All requests made by a page share their context, so only the request
+	dependent part of should_block (see _decide_context) is left to do
+	for each of them. The cache is dropped whenever the generation of rules
+	changes, so changes made without its setters must call rules.touch().
+	A context is prepared again once its merged row is full."""
+	contexts = rules.contexts
+	if rules.contexts_generation != rules.generation:
+		# Not cleared in place, readers may be using it (see rule.Rules.copy)
+		contexts = rules.contexts = {}
+		rules.contexts_generation = rules.generation
+	key = (context_hostname, context_scheme)
+	context = contexts.get(key)
+	if context is None or len(context.merged_row) >= rule.MAX_MERGED_CELLS:
+		if len(contexts) >= MAX_CONTEXTS:
+			contexts = rules.contexts = {}
+		context = contexts[key] = _prepare_context(context_hostname, context_scheme, rules)
+	return context
+
+
+class Step(enum.Enum):
+	"""The step of should_block that decided a verdict."""
+	MATRIX_OFF = 0  # A matrix-off flag
+	HTTPS_STRICT = 1  # An https-strict flag
+	EXACT = 2  # The cell of the request hostname
+	ANCESTOR = 3  # The cell of a parent domain of the request hostname
+	FIRST_PARTY = 4  # The 1st-party cell
+	ANY_HOST = 5  # The * cell
+	DEFAULT = 6  # Nothing matched, so the request is blocked
+
+Decision = typing.NamedTuple('Decision', [
+	('blocked', bool),
+	('step', Step),
+	# The rule that decided: for cells the (source, dest, type) of the cell,
+	# for flags only the source (a host, or a scheme like 'https-scheme')
+	('source', typing.Optional[str]),
+	('dest', typing.Optional[str]),
+	('type', typing.Optional[rule.Type]),
+])
+
+_DECIDING_ACTIONS = (rule.Action.ALLOW, rule.Action.BLOCK)
 
 def should_block(
 		context_hostname: str, context_scheme: str,
@@ -74,51 +199,47 @@ def should_block(
 	"""Check if we should block a certain url.
 
 	fpdomain_fn: A function that will take hostnames and return a 'first party' version of them."""
+	return _should_block_context(
+		prepare_context(context_hostname, context_scheme, rules),
+		request_hostname, request_scheme, request_type, fpdomain_fn, rules)
 
-	# Only using context against matrix_flags, remove irrelevant entries
-	widened_context = tuple(filter(
-		functools.partial(operator.contains, rules.matrix_flags),
-		_hostname_widen_list(context_hostname)))
-	widened_request = _hostname_widen_list(request_hostname)
-	is_https = context_scheme == "https"
+def _should_block_context(
+		context: ContextInfo,
+		request_hostname: str, request_scheme: str,
+		request_type: rule.Type, fpdomain_fn: typing.Callable[[str], str],
+		rules: rule.Rules) -> bool:
+	"""The request dependent part of should_block.
 
-	# First check if we have a matrix-off rule
-	context_scheme += "-scheme"
-	if (any(map(
-			lambda host: rules.matrix_flags.get(host, {}).get(rule.Flag.MATRIX_OFF, False),
-			itertools.chain(widened_context, [context_scheme])))):
+	This is the same walk as _decide_context, keep them in sync. It is kept
+	apart so verdicts don't pay for building a Decision."""
+	if context.matrix_off:
 		# We should be off for this context
 		return False
 
-	if (any(map(
-			lambda host: rules.matrix_flags.get(host, {}).get(rule.Flag.HTTPS_STRICT, False),
-			itertools.chain(widened_context, [context_scheme])))):
+	if context.https_only and request_scheme != "https":
 		# We are being strict on https, block if needed
-		if is_https and request_scheme != "https":
-			return True
+		return True
 
-	# Only using context against matrix_rules, remove irrelevant entries
-	widened_context = tuple(filter(
-		None,
-		map(rules.matrix_rules.get,
-			_hostname_widen_list(context_hostname))))
+	merged_row = context.merged_row
+	request = host_info(request_hostname, fpdomain_fn)
+	widened_request = request.widened
 
 	# uMatrix dosen't have any simple rules to it's precedence. Because of this, we just follow the algorithm defined in:
 	#
 	# https://github.com/gorhill/uMatrix/blob/054935d025c32f62b8dc35a27fbf7fa07d9f9589/src/js/matrix.js#L416
 
 	# Exact hostname, exact type
-	r = _evaluate_cell_z(widened_context, request_hostname, request_type, rules)
+	r = merged_row[request_hostname].get(request_type)
 	if r == rule.Action.ALLOW: return False
 	elif r == rule.Action.BLOCK: return True
 
 	# Exact hostname, any type
-	r_override = _evaluate_cell_z(widened_context, request_hostname, rule.Type.ALL, rules)
+	r_override = merged_row[request_hostname].get(rule.Type.ALL)
 	if r == rule.Action.BLOCK: return True
 
 	dest = request_hostname
-	first_party_domain = fpdomain_fn(request_hostname)
-	if (fpdomain_fn(context_hostname) != first_party_domain):
+	first_party_domain = request.fp_domain
+	if host_info(context.hostname, fpdomain_fn).fp_domain != first_party_domain:
 		first_party_domain = ""
 
 	# Ancestor cells up to 1st-party request domain
@@ -127,23 +248,23 @@ def should_block(
 			dest = domain
 			if domain == first_party_domain:
 				break
-			r = _evaluate_cell_z(widened_context, domain, request_type, rules)
+			r = merged_row[domain].get(request_type)
 			if r == rule.Action.ALLOW: return False
 			elif r == rule.Action.BLOCK: return True
 
 			# Don't override a more specific allow rule (??)
 			if r_override != rule.Action.ALLOW:
-				r_override = _evaluate_cell_z(widened_context, domain, rule.Type.ALL, rules)
+				r_override = merged_row[domain].get(rule.Type.ALL)
 				if r_override == rule.Action.BLOCK: return True
 
 		# First party special case cell
-		r = _evaluate_cell_z(widened_context, '1st-party', request_type, rules)
+		r = merged_row['1st-party'].get(request_type)
 		if r == rule.Action.ALLOW: return False
 		elif r == rule.Action.BLOCK: return True
 
 		# Don't override a more specific allow rule (??)
 		if r_override != rule.Action.ALLOW:
-			r_override = _evaluate_cell_z(widened_context, '1st-party', rule.Type.ALL, rules)
+			r_override = merged_row['1st-party'].get(rule.Type.ALL)
 			if r_override == rule.Action.BLOCK: return True
 		search_domains = _hostname_widen_list(dest)
 	else:
@@ -153,25 +274,295 @@ def should_block(
 	for domain in search_domains:
 		if domain == '*':
 			break
-		r = _evaluate_cell_z(widened_context, domain, request_type, rules)
+		r = merged_row[domain].get(request_type)
 		if r == rule.Action.ALLOW: return False
 		elif r == rule.Action.BLOCK: return True
 
 		# Don't override a more specific allow rule (??)
 		if r_override != rule.Action.ALLOW:
-			r_override = _evaluate_cell_z(widened_context, domain, rule.Type.ALL, rules)
+			r_override = merged_row[domain].get(rule.Type.ALL)
 			if r_override == rule.Action.BLOCK: return True
 
 	# Hostname specific type cells
-	r = _evaluate_cell_z(widened_context, '*', request_type, rules)
+	r = merged_row['*'].get(request_type)
 	if r == rule.Action.BLOCK: return True
 	if r_override == rule.Action.ALLOW: return False
 	if r == rule.Action.ALLOW: return False
 
 	# Hostname type api call
-	r = _evaluate_cell_z(widened_context, '*', rule.Type.ALL, rules)
+	r = merged_row['*'].get(rule.Type.ALL)
 	if r == rule.Action.BLOCK: return True
 	if r == rule.Action.ALLOW: return False
 
 	# No rules, block
 	return True
+
+def _decide_context(
+		context: ContextInfo,
+		request_hostname: str, request_scheme: str,
+		request_type: rule.Type, fpdomain_fn: typing.Callable[[str], str],
+		rules: rule.Rules) -> Decision:
+	"""The request dependent part of decide, leaving out the source of the deciding rule.
+
+	This is the same walk as _should_block_context, keep them in sync."""
+	if context.matrix_off:
+		return Decision(False, Step.MATRIX_OFF, None, None, None)
+	if context.https_only and request_scheme != "https":
+		return Decision(True, Step.HTTPS_STRICT, None, None, None)
+
+	merged_row = context.merged_row
+	request = host_info(request_hostname, fpdomain_fn)
+	widened_request = request.widened
+
+	# uMatrix dosen't have any simple rules to it's precedence. Because of this, we just follow the algorithm defined in:
+	#
+	# https://github.com/gorhill/uMatrix/blob/054935d025c32f62b8dc35a27fbf7fa07d9f9589/src/js/matrix.js#L416
+
+	# Exact hostname, exact type
+	r = merged_row[request_hostname].get(request_type)
+	if r in _DECIDING_ACTIONS:
+		return Decision(r == rule.Action.BLOCK, Step.EXACT, None, request_hostname, request_type)
+
+	# Exact hostname, any type. Where a type * allow came from is remembered
+	# for the * cell
+	r_override = merged_row[request_hostname].get(rule.Type.ALL)
+	override_step, override_dest = Step.EXACT, request_hostname
+
+	dest = request_hostname
+	first_party_domain = request.fp_domain
+	if host_info(context.hostname, fpdomain_fn).fp_domain != first_party_domain:
+		first_party_domain = ""
+
+	# Ancestor cells up to 1st-party request domain
+	if first_party_domain:
+		for domain in widened_request:
+			dest = domain
+			if domain == first_party_domain:
+				break
+			step = Step.EXACT if domain == request_hostname else Step.ANCESTOR
+			r = merged_row[domain].get(request_type)
+			if r in _DECIDING_ACTIONS:
+				return Decision(r == rule.Action.BLOCK, step, None, domain, request_type)
+			# Don't override a more specific allow rule (??)
+			if r_override != rule.Action.ALLOW:
+				r_override = merged_row[domain].get(rule.Type.ALL)
+				override_step, override_dest = step, domain
+				if r_override == rule.Action.BLOCK:
+					return Decision(True, step, None, domain, rule.Type.ALL)
+
+		# First party special case cell
+		r = merged_row['1st-party'].get(request_type)
+		if r in _DECIDING_ACTIONS:
+			return Decision(r == rule.Action.BLOCK, Step.FIRST_PARTY, None, '1st-party', request_type)
+		# Don't override a more specific allow rule (??)
+		if r_override != rule.Action.ALLOW:
+			r_override = merged_row['1st-party'].get(rule.Type.ALL)
+			override_step, override_dest = Step.FIRST_PARTY, '1st-party'
+			if r_override == rule.Action.BLOCK:
+				return Decision(True, Step.FIRST_PARTY, None, '1st-party', rule.Type.ALL)
+		search_domains = _hostname_widen_list(dest)
+	else:
+		search_domains = widened_request
+
+	# Go up to root
+	for domain in search_domains:
+		if domain == '*':
+			break
+		step = Step.EXACT if domain == request_hostname else Step.ANCESTOR
+		r = merged_row[domain].get(request_type)
+		if r in _DECIDING_ACTIONS:
+			return Decision(r == rule.Action.BLOCK, step, None, domain, request_type)
+		# Don't override a more specific allow rule (??)
+		if r_override != rule.Action.ALLOW:
+			r_override = merged_row[domain].get(rule.Type.ALL)
+			override_step, override_dest = step, domain
+			if r_override == rule.Action.BLOCK:
+				return Decision(True, step, None, domain, rule.Type.ALL)
+
+	# Hostname specific type cells
+	r = merged_row['*'].get(request_type)
+	if r == rule.Action.BLOCK:
+		return Decision(True, Step.ANY_HOST, None, '*', request_type)
+	if r_override == rule.Action.ALLOW:
+		return Decision(False, override_step, None, override_dest, rule.Type.ALL)
+	if r == rule.Action.ALLOW:
+		return Decision(False, Step.ANY_HOST, None, '*', request_type)
+
+	# Hostname type api call
+	r = merged_row['*'].get(rule.Type.ALL)
+	if r in _DECIDING_ACTIONS:
+		return Decision(r == rule.Action.BLOCK, Step.ANY_HOST, None, '*', rule.Type.ALL)
+
+	# No rules, block
+	return Decision(True, Step.DEFAULT, None, None, None)
+
+
+def decide(
+		context_hostname: str, context_scheme: str,
+		request_hostname: str, request_scheme: str,
+		request_type: rule.Type, fpdomain_fn: typing.Callable[[str], str],
+		rules: rule.Rules) -> Decision:
+	"""Like should_block, but also report the rule that decided the verdict.
+
+	This is a bit slower than should_block (it does the same walk, then looks
+	up the source of the deciding rule), and is meant for instrumentation and
+	debugging."""
+	decision = _decide_context(
+		prepare_context(context_hostname, context_scheme, rules),
+		request_hostname, request_scheme, request_type, fpdomain_fn, rules)
+	step = decision.step
+	if step == Step.MATRIX_OFF or step == Step.HTTPS_STRICT:
+		flag = rule.Flag.MATRIX_OFF if step == Step.MATRIX_OFF else rule.Flag.HTTPS_STRICT
+		hosts = itertools.chain(_hostname_widen_list(context_hostname), [context_scheme + "-scheme"])
+		source = next(host for host in hosts if rules.matrix_flags.get(host, {}).get(flag, False))
+		return decision._replace(source=source)
+	if decision.dest is not None:
+		for source in _hostname_widen_list(context_hostname):
+			cell = rules.matrix_rules.get(source, {}).get(decision.dest)
+			if cell is not None and cell.get(typing.cast(rule.Type, decision.type)) is not None:
+				return decision._replace(source=source)
+	return decision
+
+def format_decision(decision: Decision) -> str:
+	"""Describe decision for humans, in rule file syntax."""
+	verdict = "blocked" if decision.blocked else "allowed"
+	step = decision.step.name.lower().replace('_', '-')
+	if decision.step == Step.DEFAULT:
+		return "{} as no rule matched".format(verdict)
+	if decision.dest is None:
+		return "{} by {}: {} true".format(verdict, step, decision.source)
+	return "{} by {} {} {} {} ({})".format(
+		verdict, decision.source, decision.dest, str(decision.type),
+		"block" if decision.blocked else "allow", step)
+
+REQUEST_TUPLE = typing.Tuple[str, str, str, str, rule.Type]
+
+#: How many prepared contexts should_block_many keeps around at once.
+MAX_BATCH_CONTEXTS = 2**14
+
+def should_block_many(
+		requests: typing.Iterable[REQUEST_TUPLE],
+		fpdomain_fn: typing.Callable[[str], str],
+		rules: rule.Rules) -> 'array.array[int]':
+	"""Check many requests at once.
+
+	requests: An iterable of (context_hostname, context_scheme, request_hostname,
+request_scheme, request_type) tuples, the same as the arguments to should_block.
+
+	Returns an array of verdicts in the same order as requests, 1 meaning the
+	request should be blocked. The context dependent work of should_block is
+	only done once per (context_hostname, context_scheme) pair."""
+	contexts = {}  # type: typing.Dict[typing.Tuple[str, str], ContextInfo]
+	verdicts = array.array('B')
+	append = verdicts.append
+	for context_hostname, context_scheme, request_hostname, request_scheme, request_type in requests:
+		context = contexts.get((context_hostname, context_scheme))
+		if context is None:
+			if len(contexts) >= MAX_BATCH_CONTEXTS:
+				contexts.clear()
+			context = contexts[(context_hostname, context_scheme)] = _prepare_context(
+				context_hostname, context_scheme, rules)
+		append(_should_block_context(
+			context, request_hostname, request_scheme, request_type, fpdomain_fn, rules))
+	return verdicts
+
+def should_block_columns(
+		context_hostnames: typing.Iterable[str], context_schemes: typing.Iterable[str],
+		request_hostnames: typing.Iterable[str], request_schemes: typing.Iterable[str],
+		request_types: typing.Iterable[rule.Type], fpdomain_fn: typing.Callable[[str], str],
+		rules: rule.Rules) -> 'array.array[int]':
+	"""A columnar version of should_block_many.
+
+	Every column must have the same length, or ValueError is raised. Columns
+	which are not sequences are read into lists first."""
+	columns = [
+		column if isinstance(column, collections.abc.Sized) else list(column)
+		for column in (context_hostnames, context_schemes, request_hostnames, request_schemes, request_types)
+	]  # type: typing.List[typing.Any]
+	if len(set(map(len, columns))) > 1:
+		raise ValueError("Columns of different lengths")
+	return should_block_many(zip(*columns), fpdomain_fn, rules)
+
+
+CacheInfo = cache.CacheInfo
+
+VERDICT_CACHE_KEY = typing.Tuple[str, str, str, bool, rule.Type]
+
+class VerdictCache():
+
+	"""A bounded LRU cache in front of should_block.
+
+	The cache is tied to a single rules object and fpdomain_fn. Whenever a
+	different rules object is passed in, or its generation changes, all cached
+	verdicts are dropped. Changes made to rules without going through its
+	setters must be followed by rules.touch() or clear().
+
+	If stats is set, the step deciding every uncached verdict is recorded there."""
+
+	__slots__ = ['maxsize', 'hits', 'misses', 'stats', '_cache', '_rules', '_generation', '_fpdomain_fn']
+
+	def __init__(self, maxsize: int = 2**12) -> None:
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self.stats = None  # type: typing.Optional[stats.Stats]
+		self._cache = collections.OrderedDict()  # type: typing.OrderedDict[VERDICT_CACHE_KEY, bool]
+		self._rules = None  # type: typing.Optional[rule.Rules]
+		self._generation = -1
+		self._fpdomain_fn = None  # type: typing.Optional[typing.Callable[[str], str]]
+
+	def clear(self) -> None:
+		"""Drop all cached verdicts. Statistics are kept."""
+		self._cache.clear()
+		self._rules = None
+
+	def cache_info(self) -> CacheInfo:
+		"""Report cache statistics, like functools.lru_cache."""
+		return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+	def should_block(
+			self, context_hostname: str, context_scheme: str,
+			request_hostname: str, request_scheme: str,
+			request_type: rule.Type, fpdomain_fn: typing.Callable[[str], str],
+			rules: rule.Rules) -> bool:
+		"""A cached version of should_block, taking the same arguments."""
+		if (rules is not self._rules or rules.generation != self._generation or
+				fpdomain_fn != self._fpdomain_fn):
+			self._cache.clear()
+			self._rules = rules
+			self._generation = rules.generation
+			self._fpdomain_fn = fpdomain_fn
+
+		# The request scheme only matters for https-strict
+		key = (context_hostname, context_scheme, request_hostname,
+			   request_scheme == "https", request_type)
+		cache = self._cache
+		verdict = cache.get(key)
+		if verdict is not None:
+			self.hits += 1
+			try:
+				cache.move_to_end(key)
+			except KeyError:
+				# Evicted by another thread in the meantime
+				pass
+			return verdict
+
+		self.misses += 1
+		if self.stats is None:
+			verdict = should_block(
+				context_hostname, context_scheme, request_hostname, request_scheme,
+				request_type, fpdomain_fn, rules)
+		else:
+			decision = decide(
+				context_hostname, context_scheme, request_hostname, request_scheme,
+				request_type, fpdomain_fn, rules)
+			verdict = decision.blocked
+			self.stats.record_step(decision.step)
+		cache[key] = verdict
+		while len(cache) > self.maxsize:
+			try:
+				cache.popitem(last=False)
+			except KeyError:
+				# Cleared by another thread in the meantime
+				break
+		return verdict
@@ -0,0 +1,147 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Load rules and the PSL off the main thread."""
+
+import collections
+import enum
+import functools
+import pathlib
+import threading
+import typing
+
+from jmatrix import cache, rule, rule_cache, umatrix_parser
+from jmatrix.vendor.fpdomain import fpdomain
+
+
+class LoadPolicy(enum.Enum):
+	"""What to do with requests while nothing is loaded yet."""
+	ALLOW = 1  # Let everything through (fail open)
+	BLOCK = 2  # Block everything (fail closed)
+
+Loaded = typing.NamedTuple('Loaded', [
+	('rules', rule.Rules),
+	('errors', typing.List[umatrix_parser.JMatrixParserError]),
+	# None if the PSL could not be loaded, with the reason in psl_error
+	('psl', typing.Optional[fpdomain.PSL]),
+	('psl_error', typing.Optional[Exception]),
+])
+
+#: The default size of the cache of PSL.fp_domain
+PSL_CACHE_SIZE = 2**12
+
+def load_psl(psl_path: pathlib.Path, psl_url: str = fpdomain.PSL.PSL_URL,
+			 cache_size: int = PSL_CACHE_SIZE, policy: cache.Policy = cache.Policy.LRU) -> fpdomain.PSL:
+	"""Load the PSL at psl_path, with its own cache of cache_size hosts.
+
+	The PSL is downloaded from psl_url if psl_path does not exist."""
+	return fpdomain.PSL(psl_path, url=psl_url, cache=cache.make_cache(cache_size, policy))
+
+def try_load_psl(psl_path: pathlib.Path, psl_url: str = fpdomain.PSL.PSL_URL,
+				 cache_size: int = PSL_CACHE_SIZE, policy: cache.Policy = cache.Policy.LRU
+				 ) -> typing.Tuple[typing.Optional[fpdomain.PSL], typing.Optional[Exception]]:
+	"""Like load_psl, but return (None, the error) if it fails, eg: when offline."""
+	try:
+		return load_psl(psl_path, psl_url, cache_size, policy), None
+	except Exception as e:
+		return None, e
+
+def load(rules_path: pathlib.Path, rules_cache: typing.Optional[pathlib.Path],
+		 psl_path: pathlib.Path, psl_url: str = fpdomain.PSL.PSL_URL,
+		 cache_size: int = PSL_CACHE_SIZE, policy: cache.Policy = cache.Policy.LRU) -> Loaded:
+	"""Load the rules at rules_path (through rule_cache) and the PSL at psl_path.
+
+	Failing to load the PSL doesn't fail the load, see Loaded.psl_error. See
+	load_psl for the other arguments."""
+	rules, errors = rule_cache.load_rules(rules_path, rules_cache)
+	return Loaded(rules, errors, *try_load_psl(psl_path, psl_url, cache_size, policy))
+
+
+T = typing.TypeVar('T')
+
+# A load and what to do with its result
+_JOB_TYPE = typing.Tuple[typing.Callable[[], typing.Any], typing.Callable[[typing.Any], None]]
+
+def _call(fn: typing.Callable[[], None]) -> None:
+	fn()
+
+
+class BackgroundLoader():
+
+	"""Run load functions on a worker thread, and hand their results to publish.
+
+	Loads run one at a time, in the order they were started, so results are
+	published in that order too. publish (or on_error, if the load raised) is
+	passed to dispatch, which should run it on the thread owning what is
+	published (eg: the GUI thread). By default, it is run on the worker."""
+
+	__slots__ = ['_on_error', '_dispatch', '_lock', '_jobs', '_running', '_started', '_done', '_idle']
+
+	def __init__(self, on_error: typing.Callable[[BaseException], None],
+				 dispatch: typing.Callable[[typing.Callable[[], None]], None] = _call) -> None:
+		self._on_error = on_error
+		self._dispatch = dispatch
+		self._lock = threading.Lock()
+		self._jobs = collections.deque()  # type: typing.Deque[_JOB_TYPE]
+		self._running = False
+		# Number of loads started and published
+		self._started = 0
+		self._done = 0
+		self._idle = threading.Condition(self._lock)
+
+	@property
+	def loading(self) -> bool:
+		"""If a load is in progress, or its result is not published yet."""
+		return self._done != self._started
+
+	def start(self, load: typing.Callable[[], T], publish: typing.Callable[[T], None]) -> None:
+		"""Load in the background, after the loads started before."""
+		with self._lock:
+			self._started += 1
+			self._jobs.append((load, publish))
+			if self._running:
+				return
+			self._running = True
+		threading.Thread(target=self._run, daemon=True, name="jmatrix-loader").start()
+
+	def _run(self) -> None:
+		while True:
+			with self._lock:
+				if not self._jobs:
+					self._running = False
+					return
+				load, publish = self._jobs.popleft()
+			try:
+				result = load()
+			except Exception as e:
+				self._dispatch(functools.partial(self._finish, self._on_error, e))
+			else:
+				self._dispatch(functools.partial(self._finish, publish, result))
+
+	def _finish(self, publish: typing.Callable[[typing.Any], None], result: typing.Any) -> None:
+		try:
+			publish(result)
+		finally:
+			with self._lock:
+				self._done += 1
+				self._idle.notify_all()
+
+	def wait(self, timeout: typing.Optional[float] = None) -> bool:
+		"""Wait for every started load to be published. Returns False on timeout.
+
+		Don't call this on the thread loads are dispatched to."""
+		with self._idle:
+			return self._idle.wait_for(lambda: self._done == self._started, timeout)
@@ -0,0 +1,397 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Replay logged requests against rule files, to see what changing rules would do.
+
+Three log formats are read, and all are streamed:
+
+- HAR files, as saved by browser devtools. The context of a request is its
+  Referer, or the request itself if it has none. Documents are skipped: HAR
+  can't tell frames from pages, and pages are never blocked.
+- TSV files, with the context url, the request url and the request type (as
+  in rule files) on every line. Empty lines and lines starting with # are
+  skipped.
+- Binary logs of jmatrix.request_log, with the name ending in .jmlog. The
+  verdicts in them are ignored."""
+
+import argparse
+import collections
+import enum
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import re
+import sys
+import typing
+import urllib.parse
+
+from jmatrix import interceptor, request_log, rule, umatrix_parser
+from jmatrix.vendor.fpdomain import fpdomain
+
+
+class Format(enum.Enum):
+	"""The format of a request log."""
+	HAR = 1
+	TSV = 2
+	BINARY = 3
+
+	@staticmethod
+	def from_path(path: pathlib.Path) -> 'Format':
+		suffix = path.suffix.lower()
+		if suffix == ".har":
+			return Format.HAR
+		return Format.BINARY if suffix == ".jmlog" else Format.TSV
+
+#: Requests in a log, None for entries which are not requests we would check.
+RECORD_TYPE = typing.Optional[interceptor.REQUEST_TUPLE]
+
+#: Schemes of requests which are never checked (see the qutebrowser integration)
+IGNORED_SCHEMES = frozenset({"blob", "data"})
+
+def _record(context_url: str, request_url: str, request_type: rule.Type) -> RECORD_TYPE:
+	context = urllib.parse.urlsplit(context_url)
+	request = urllib.parse.urlsplit(request_url)
+	if context.scheme in IGNORED_SCHEMES or request.scheme in IGNORED_SCHEMES:
+		return None
+	if not context.hostname or not request.hostname:
+		return None
+	return (context.hostname, context.scheme, request.hostname, request.scheme, request_type)
+
+
+# TSV logs
+
+def iter_tsv(f: typing.Iterable[str]) -> typing.Iterator[RECORD_TYPE]:
+	"""Read the requests in a TSV log, one line at a time."""
+	for line in f:
+		line = line.rstrip("\r\n")
+		if not line or line.startswith("#"):
+			continue
+		fields = line.split("\t")
+		request_type = rule.Type.from_str(fields[2]) if len(fields) == 3 else None
+		if request_type is None:
+			yield None
+			continue
+		yield _record(fields[0], fields[1], request_type)
+
+
+# HAR logs
+
+#: Request types of Chrome's _resourceType, None for documents
+HAR_RESOURCE_TYPES = {
+	"document": None,
+	"stylesheet": rule.Type.CSS,
+	"image": rule.Type.IMAGE,
+	"media": rule.Type.MEDIA,
+	"script": rule.Type.SCRIPT,
+	"xhr": rule.Type.XHR,
+	"fetch": rule.Type.XHR,
+}  # type: typing.Dict[str, typing.Optional[rule.Type]]
+
+#: Request types by the start of the response mime type, for HARs without _resourceType
+HAR_MIME_TYPES = (
+	("text/html", None),
+	("text/css", rule.Type.CSS),
+	("image/", rule.Type.IMAGE),
+	("audio/", rule.Type.MEDIA),
+	("video/", rule.Type.MEDIA),
+	("application/javascript", rule.Type.SCRIPT),
+	("application/x-javascript", rule.Type.SCRIPT),
+	("text/javascript", rule.Type.SCRIPT),
+)  # type: typing.Tuple[typing.Tuple[str, typing.Optional[rule.Type]], ...]
+
+def _har_type(entry: typing.Dict[str, typing.Any]) -> typing.Optional[rule.Type]:
+	resource_type = entry.get("_resourceType")
+	if resource_type is not None:
+		return HAR_RESOURCE_TYPES.get(resource_type, rule.Type.OTHER)
+	mime_type = entry.get("response", {}).get("content", {}).get("mimeType", "")
+	for prefix, request_type in HAR_MIME_TYPES:
+		if mime_type.startswith(prefix):
+			return request_type
+	return rule.Type.OTHER
+
+def _har_record(entry: typing.Dict[str, typing.Any]) -> RECORD_TYPE:
+	request_type = _har_type(entry)
+	request = entry.get("request", {})
+	request_url = request.get("url")
+	if request_type is None or not request_url:
+		return None
+	context_url = next(
+		(header.get("value") for header in request.get("headers", ())
+		 if header.get("name", "").lower() == "referer"),
+		None) or request_url
+	return _record(context_url, request_url, request_type)
+
+_JSON_SEPARATOR = re.compile(r'[\s,]*')
+# The longest JSON value which is not a string or a container
+_MAX_TOKEN = len("-Infinity")
+
+def _incomplete(error: json.JSONDecodeError) -> bool:
+	"""If decoding failed only because the text ends too early."""
+	# Values other than strings and containers are short, so they can only
+	# have been cut if the error is near the end
+	return error.msg.startswith("Unterminated string") or len(error.doc) - error.pos <= _MAX_TOKEN
+
+def _iter_json_array(f: typing.TextIO, key: str, chunk_size: int = 2**16) -> typing.Iterator[typing.Any]:
+	"""Decode the items of the first array under key in the JSON text of f, one at a time.
+
+	Only one item (and a chunk of text) is kept in memory at once. key is
+	found by a text search, so it must not appear in a string before the array.
+
+	Raises ValueError, with the offset in the text, for malformed items."""
+	start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+	buf = ""
+	# The offset of buf in the text
+	offset = 0
+	while True:
+		match = start.search(buf)
+		if match is not None:
+			break
+		chunk = f.read(chunk_size)
+		if not chunk:
+			return
+		# Keep enough to find the key if it was split between chunks
+		offset += max(len(buf) - 256, 0)
+		buf = buf[-256:] + chunk
+	offset += match.end()
+	buf = buf[match.end():]
+
+	decoder = json.JSONDecoder()
+	pos = 0
+	read_size = chunk_size
+	while True:
+		separator = _JSON_SEPARATOR.match(buf, pos)
+		assert separator is not None
+		pos = separator.end()
+		if pos < len(buf):
+			if buf[pos] == "]":
+				return
+			try:
+				item, end = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError as e:
+				if not _incomplete(e):
+					raise ValueError("Malformed JSON in {} array at offset {}: {}".format(
+						key, offset + e.pos, e.msg)) from e
+			else:
+				yield item
+				pos = end
+				read_size = chunk_size
+				continue
+		# The next item is not all there yet
+		chunk = f.read(read_size)
+		if not chunk:
+			raise ValueError("Unexpected end of JSON in {} array".format(key))
+		offset += pos
+		buf = buf[pos:] + chunk
+		pos = 0
+		# Big items are decoded again on every read, so read more each time
+		read_size *= 2
+
+def iter_har(f: typing.TextIO) -> typing.Iterator[RECORD_TYPE]:
+	"""Read the requests in a HAR log, one entry at a time."""
+	return map(_har_record, _iter_json_array(f, "entries"))
+
+def iter_log(path: pathlib.Path, log_format: typing.Optional[Format] = None) -> typing.Iterator[RECORD_TYPE]:
+	"""Read the requests in the log at path, guessing its format from its name if not given."""
+	if log_format is None:
+		log_format = Format.from_path(path)
+	if log_format == Format.BINARY:
+		with open(path, "rb") as binary:
+			for record in request_log.iter_records(binary):
+				yield record[1:6]
+		return
+	with open(path, "r", encoding="utf-8", errors="replace") as f:
+		if log_format == Format.HAR:
+			yield from iter_har(f)
+		else:
+			yield from iter_tsv(f)
+
+
+# Replaying
+
+#: A change of verdict: (context host, request host, request type, blocked by the new rules)
+CHANGE_TYPE = typing.Tuple[str, str, rule.Type, bool]
+
+class Summary():
+
+	"""Verdicts of a replayed log."""
+
+	__slots__ = ['requests', 'skipped', 'by_type', 'blocked_by_type', 'changes']
+
+	def __init__(self) -> None:
+		#: Requests checked, and log entries which were not
+		self.requests = 0
+		self.skipped = 0
+		self.by_type = collections.Counter()  # type: typing.Counter[rule.Type]
+		self.blocked_by_type = collections.Counter()  # type: typing.Counter[rule.Type]
+		#: Requests which got another verdict with the rules compared against
+		self.changes = collections.Counter()  # type: typing.Counter[CHANGE_TYPE]
+
+	@property
+	def blocked(self) -> int:
+		return sum(self.blocked_by_type.values())
+
+	def merge(self, other: 'Summary') -> None:
+		self.requests += other.requests
+		self.skipped += other.skipped
+		self.by_type.update(other.by_type)
+		self.blocked_by_type.update(other.blocked_by_type)
+		self.changes.update(other.changes)
+
+def _batches(records: typing.Iterable[RECORD_TYPE], size: int) -> typing.Iterator[typing.List[RECORD_TYPE]]:
+	records = iter(records)
+	while True:
+		batch = list(itertools.islice(records, size))
+		if not batch:
+			return
+		yield batch
+
+#: How many records are checked at once
+BATCH_SIZE = 2**14
+
+def replay(records: typing.Iterable[RECORD_TYPE], fpdomain_fn: typing.Callable[[str], str],
+		   rules: rule.Rules, compare: typing.Optional[rule.Rules] = None) -> Summary:
+	"""Check every record against rules, and against compare if given.
+
+	Changes are from the verdicts of compare to the ones of rules. Records are
+	checked BATCH_SIZE at a time."""
+	summary = Summary()
+	for batch in _batches(records, BATCH_SIZE):
+		summary.merge(_replay_batch(batch, fpdomain_fn, rules, compare))
+	return summary
+
+def _replay_batch(records: typing.List[RECORD_TYPE], fpdomain_fn: typing.Callable[[str], str],
+				  rules: rule.Rules, compare: typing.Optional[rule.Rules]) -> Summary:
+	summary = Summary()
+	requests = []  # type: typing.List[interceptor.REQUEST_TUPLE]
+	for record in records:
+		if record is None:
+			summary.skipped += 1
+		else:
+			requests.append(record)
+	summary.requests = len(requests)
+	verdicts = interceptor.should_block_many(requests, fpdomain_fn, rules)
+	summary.by_type.update(request[4] for request in requests)
+	summary.blocked_by_type.update(
+		request[4] for request, blocked in zip(requests, verdicts) if blocked)
+	if compare is not None:
+		old_verdicts = interceptor.should_block_many(requests, fpdomain_fn, compare)
+		summary.changes.update(
+			(request[0], request[2], request[4], bool(blocked))
+			for request, blocked, old in zip(requests, verdicts, old_verdicts)
+			if blocked != old)
+	return summary
+
+def load_rules(path: pathlib.Path) -> typing.Tuple[rule.Rules, typing.List[umatrix_parser.JMatrixParserError]]:
+	rules = rule.Rules()
+	with open(path, "rb") as f:
+		errors = umatrix_parser.parse_rules(f, rules, collate_errors=True)
+	return rules, errors
+
+WORKER_TYPE = typing.Tuple[typing.Callable[[str], str], rule.Rules, typing.Optional[rule.Rules]]
+
+# What a worker process checks against, see _init_worker
+_WORKER = None  # type: typing.Optional[WORKER_TYPE]
+
+def _init_worker(psl_path: pathlib.Path, rules: rule.Rules, compare: typing.Optional[rule.Rules]) -> None:
+	global _WORKER
+	_WORKER = fpdomain.PSL(psl_path).fp_domain, rules, compare
+
+def _worker_replay(records: typing.List[RECORD_TYPE]) -> Summary:
+	assert _WORKER is not None
+	return _replay_batch(records, *_WORKER)
+
+def replay_log(log: pathlib.Path, psl_path: pathlib.Path, rules: rule.Rules,
+			   compare: typing.Optional[rule.Rules] = None,
+			   log_format: typing.Optional[Format] = None, jobs: int = 1) -> Summary:
+	"""Replay the log at log against rules (and compare), see load_rules.
+
+	With more than one job, the log is read here and checked in batches by
+	jobs worker processes, which get a copy of the rules. The PSL at
+	psl_path is never downloaded."""
+	if not psl_path.exists():
+		raise FileNotFoundError("No PSL at {}".format(psl_path))
+	records = iter_log(log, log_format)
+	if jobs <= 1:
+		return replay(records, fpdomain.PSL(psl_path).fp_domain, rules, compare)
+
+	summary = Summary()
+	with multiprocessing.Pool(jobs, _init_worker, (psl_path, rules, compare)) as pool:
+		for batch_summary in pool.imap_unordered(_worker_replay, _batches(records, BATCH_SIZE)):
+			summary.merge(batch_summary)
+	return summary
+
+
+def format_summary(summary: Summary, limit: int = 50) -> str:
+	"""Describe summary for humans, listing at most limit changes."""
+	def percent(part: int, whole: int) -> str:
+		return "{:.1%}".format(part / whole) if whole else "-"
+	lines = [
+		"requests: {} ({} skipped)".format(summary.requests, summary.skipped),
+		"blocked: {} ({})".format(summary.blocked, percent(summary.blocked, summary.requests)),
+	]
+	for request_type in rule.Type:
+		total = summary.by_type[request_type]
+		if total:
+			blocked = summary.blocked_by_type[request_type]
+			lines.append("  {:7}{} of {} blocked ({})".format(
+				str(request_type), blocked, total, percent(blocked, total)))
+	if summary.changes:
+		now_blocked = sum(count for change, count in summary.changes.items() if change[3])
+		lines.append("changed: {} (now blocked {}, now allowed {})".format(
+			sum(summary.changes.values()), now_blocked, sum(summary.changes.values()) - now_blocked))
+		for (context, request, request_type, blocked), count in summary.changes.most_common(limit):
+			lines.append("  {} {} {} {} ({})".format(
+				"block" if blocked else "allow", context, request, str(request_type), count))
+	return "\n".join(lines)
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+	parser = argparse.ArgumentParser(
+		prog="python3 -m jmatrix.replay",
+		description="Check the requests in a HAR, TSV or binary log against a rule file.")
+	parser.add_argument('log', help="The request log (.har for HAR, .jmlog for binary logs, TSV otherwise)")
+	parser.add_argument('rules', help="The rule file to check against")
+	parser.add_argument('--psl', required=True, help="A local copy of the public suffix list")
+	parser.add_argument('--compare', metavar='FILE',
+						help="Report requests which get another verdict with the rules in FILE")
+	parser.add_argument('--format', choices=[f.name.lower() for f in Format],
+						help="The format of the log, guessed from its name if not given")
+	parser.add_argument('--jobs', '-j', type=int, default=1,
+						help="Worker processes to use, 0 for one per cpu")
+	parser.add_argument('--limit', type=int, default=50, help="How many changes to list")
+	args = parser.parse_args(argv)
+
+	loaded = []  # type: typing.List[typing.Optional[rule.Rules]]
+	for path in (args.rules, args.compare):
+		if path is None:
+			loaded.append(None)
+			continue
+		rules, errors = load_rules(pathlib.Path(path))
+		for error in errors:
+			print("error: {}: {}".format(path, error), file=sys.stderr)
+		loaded.append(rules)
+	rules, compare = loaded
+	assert rules is not None
+	summary = replay_log(
+		pathlib.Path(args.log), pathlib.Path(args.psl), rules, compare,
+		Format[args.format.upper()] if args.format else None,
+		args.jobs or os.cpu_count() or 1)
+	print(format_summary(summary, args.limit))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,314 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""An append-only binary log of the verdicts of the request interceptor.
+
+A log is a sequence of chunks, each starting with a _CHUNK header:
+
+- b'JMRL' (version, 0) starts a session: every RequestLog appends one when
+  it's created, so a file can hold many sessions. Hosts and schemes are
+  interned to ids counting from 0 in every session.
+- b'JMRB' (strings, records) is a block of records, written on every flush:
+  first the strings interned since the last block (a uint16 length and
+  utf-8), then the records (see _RECORD).
+
+Blocks are written whole, so a log cut short (eg: by a crash) is only missing
+its last block. A RequestLog given a readable file drops such a partial block
+before appending its session, which would otherwise be read as part of it."""
+
+import io
+import struct
+import threading
+import time
+import typing
+
+from jmatrix import rule
+
+try:
+	import numpy
+except ImportError:
+	numpy = None  # type: ignore
+
+VERSION = 1
+
+_CHUNK = struct.Struct('<4sII')
+_SESSION_TAG = b'JMRL'
+_BLOCK_TAG = b'JMRB'
+_STRING_LENGTH = struct.Struct('<H')
+# time.time(), the ids of the context host and scheme and of the request host
+# and scheme, and the request type value shifted left once, ored with 1 if the
+# request was blocked
+_RECORD = struct.Struct('<dIIIIB')
+
+# Type.value is slow, see rule.Type.__hash__
+_TYPE_CODES = {request_type: request_type.value << 1 for request_type in rule.Type}
+
+LogRecord = typing.NamedTuple('LogRecord', [
+	('time', float),
+	('context_host', str),
+	('context_scheme', str),
+	('request_host', str),
+	('request_scheme', str),
+	('request_type', rule.Type),
+	('blocked', bool),
+])
+
+MYPY = False
+if MYPY:
+	# pylint: disable=unused-import,useless-suppression
+	import numpy.typing
+	FLOAT_ARRAY = numpy.typing.NDArray[numpy.float64]
+	INT_ARRAY = numpy.typing.NDArray[numpy.int64]
+	BOOL_ARRAY = numpy.typing.NDArray[numpy.bool_]
+
+LogColumns = typing.NamedTuple('LogColumns', [
+	# Hosts and schemes of all sessions, indexed by the id columns
+	('strings', typing.List[str]),
+	('time', 'FLOAT_ARRAY'),
+	('context_host', 'INT_ARRAY'),
+	('context_scheme', 'INT_ARRAY'),
+	('request_host', 'INT_ARRAY'),
+	('request_scheme', 'INT_ARRAY'),
+	# rule.Type values
+	('request_type', 'INT_ARRAY'),
+	('blocked', 'BOOL_ARRAY'),
+])
+
+# A full buffer waiting to be written: (buffer, records, strings interned for it)
+_PENDING_TYPE = typing.Tuple[bytearray, int, typing.List[bytes]]
+
+
+class RequestLog():
+
+	"""Buffered writer of a request log to a binary file opened for appending.
+
+	Records go to a fixed size buffer. Full buffers are handed to a background
+	thread, which also writes the current buffer every flush_interval seconds
+	(never, if None: call flush()). The lock taken by record is only held by
+	the other side to swap buffers, never while writing. If max_pending full
+	buffers are already waiting to be written, records are dropped rather than
+	waiting, and counted in dropped.
+
+	If f is also readable and seekable (eg: opened with 'a+b'), a last block
+	cut short is truncated away first, see _end_of_chunks."""
+
+	__slots__ = ['flush_interval', 'max_pending', 'dropped', '_file', '_ids', '_strings',
+				 '_buffer', '_pos', '_end', '_pending', '_spares', '_lock', '_write_lock',
+				 '_wake', '_closed', '_thread']
+
+	def __init__(self, f: typing.BinaryIO, buffer_records: int = 2**12,
+				 flush_interval: typing.Optional[float] = 1.0, max_pending: int = 2**4) -> None:
+		self.flush_interval = flush_interval
+		self.max_pending = max_pending
+		self.dropped = 0
+		self._file = f
+		self._ids = {}  # type: typing.Dict[str, int]
+		self._strings = []  # type: typing.List[bytes]
+		self._buffer = bytearray(buffer_records * _RECORD.size)
+		self._pos = 0
+		self._end = len(self._buffer)
+		self._pending = []  # type: typing.List[_PENDING_TYPE]
+		self._spares = []  # type: typing.List[bytearray]
+		self._lock = threading.Lock()
+		self._write_lock = threading.Lock()
+		self._wake = threading.Event()
+		self._closed = False
+		if f.readable() and f.seekable():
+			f.truncate(_end_of_chunks(f))
+			f.seek(0, io.SEEK_END)
+		f.write(_CHUNK.pack(_SESSION_TAG, VERSION, 0))
+		f.flush()
+		self._thread = None  # type: typing.Optional[threading.Thread]
+		if flush_interval is not None:
+			self._thread = threading.Thread(target=self._run, name="jmatrix-request-log", daemon=True)
+			self._thread.start()
+
+	def record(self, context_host: str, context_scheme: str, request_host: str,
+			   request_scheme: str, request_type: rule.Type, blocked: bool) -> None:
+		"""Log a verdict of the interceptor."""
+		with self._lock:
+			ids = self._ids
+			context_id = ids.get(context_host)
+			if context_id is None:
+				context_id = self._intern(context_host)
+			context_scheme_id = ids.get(context_scheme)
+			if context_scheme_id is None:
+				context_scheme_id = self._intern(context_scheme)
+			request_id = ids.get(request_host)
+			if request_id is None:
+				request_id = self._intern(request_host)
+			request_scheme_id = ids.get(request_scheme)
+			if request_scheme_id is None:
+				request_scheme_id = self._intern(request_scheme)
+
+			pos = self._pos
+			if pos == self._end:
+				if len(self._pending) >= self.max_pending:
+					self.dropped += 1
+					return
+				self._rotate()
+				self._wake.set()
+				pos = 0
+			_RECORD.pack_into(
+				self._buffer, pos, time.time(), context_id, context_scheme_id,
+				request_id, request_scheme_id, _TYPE_CODES[request_type] | blocked)
+			self._pos = pos + _RECORD.size
+
+	def _intern(self, s: str) -> int:
+		string_id = self._ids[s] = len(self._ids)
+		# Hosts are at most 253 characters, but don't corrupt the log if not
+		self._strings.append(s.encode('utf-8', 'replace')[:2**16 - 1])
+		return string_id
+
+	def _rotate(self) -> None:
+		"""Queue the current buffer for writing, and start another. Needs _lock."""
+		self._pending.append((self._buffer, self._pos // _RECORD.size, self._strings))
+		self._buffer = self._spares.pop() if self._spares else bytearray(self._end)
+		self._pos = 0
+		self._strings = []
+
+	def flush(self) -> None:
+		"""Write everything recorded so far."""
+		with self._write_lock:
+			with self._lock:
+				if self._pos or self._strings:
+					self._rotate()
+				pending = self._pending
+				self._pending = []
+			f = self._file
+			for buffer, records, strings in pending:
+				f.write(_CHUNK.pack(_BLOCK_TAG, len(strings), records))
+				for s in strings:
+					f.write(_STRING_LENGTH.pack(len(s)))
+					f.write(s)
+				f.write(memoryview(buffer)[:records * _RECORD.size])
+			f.flush()
+			with self._lock:
+				self._spares.extend(buffer for buffer, _, _ in pending)
+
+	def _run(self) -> None:
+		while not self._closed:
+			self._wake.wait(self.flush_interval)
+			self._wake.clear()
+			self.flush()
+
+	def close(self) -> None:
+		"""Write everything recorded so far, and close the file."""
+		self._closed = True
+		if self._thread is not None:
+			self._wake.set()
+			self._thread.join()
+		self.flush()
+		self._file.close()
+
+
+# Reading
+
+def _read(f: typing.BinaryIO, size: int) -> typing.Optional[bytes]:
+	data = f.read(size)
+	return data if len(data) == size else None
+
+def _end_of_chunks(f: typing.BinaryIO) -> int:
+	"""Get the offset in the log in f after its last whole chunk."""
+	size = f.seek(0, io.SEEK_END)
+	end = f.seek(0)
+	while True:
+		header = _read(f, _CHUNK.size)
+		if header is None:
+			return end
+		tag, first_field, second_field = _CHUNK.unpack(header)
+		if tag == _BLOCK_TAG:
+			for _ in range(first_field):
+				length = _read(f, _STRING_LENGTH.size)
+				if length is None:
+					return end
+				f.seek(_STRING_LENGTH.unpack(length)[0], io.SEEK_CUR)
+			if f.seek(second_field * _RECORD.size, io.SEEK_CUR) > size:
+				return end
+		elif tag != _SESSION_TAG:
+			raise ValueError("Not a request log")
+		end = f.tell()
+
+def _iter_blocks(f: typing.BinaryIO) -> typing.Iterator[typing.Tuple[typing.List[str], int, bytes]]:
+	"""Read the blocks of the log in f, as (strings, id offset, records).
+
+	strings are the strings of all sessions so far, and the ids in records
+	must be offset by id offset to index them."""
+	strings = []  # type: typing.List[str]
+	offset = 0
+	first = True
+	while True:
+		header = _read(f, _CHUNK.size)
+		if header is None:
+			return
+		tag, first_field, second_field = _CHUNK.unpack(header)
+		if tag == _SESSION_TAG:
+			if first_field != VERSION:
+				raise ValueError("Unsupported request log version {}".format(first_field))
+			offset = len(strings)
+		elif tag == _BLOCK_TAG and not first:
+			for _ in range(first_field):
+				length = _read(f, _STRING_LENGTH.size)
+				data = _read(f, _STRING_LENGTH.unpack(length)[0]) if length is not None else None
+				if data is None:
+					return
+				strings.append(data.decode('utf-8', 'replace'))
+			records = _read(f, second_field * _RECORD.size)
+			if records is None:
+				return
+			yield strings, offset, records
+		else:
+			raise ValueError("Not a request log")
+		first = False
+
+def iter_records(f: typing.BinaryIO) -> typing.Iterator[LogRecord]:
+	"""Read the records of the log in f, one block at a time."""
+	types = {request_type.value: request_type for request_type in rule.Type}
+	for strings, offset, records in _iter_blocks(f):
+		for (timestamp, context_id, context_scheme_id, request_id,
+			 request_scheme_id, code) in _RECORD.iter_unpack(records):
+			yield LogRecord(
+				timestamp, strings[offset + context_id], strings[offset + context_scheme_id],
+				strings[offset + request_id], strings[offset + request_scheme_id],
+				types[code >> 1], bool(code & 1))
+
+def read_columns(f: typing.BinaryIO) -> LogColumns:
+	"""Read the log in f as NumPy arrays, raising ImportError without NumPy."""
+	if numpy is None:
+		raise ImportError("Reading request logs as columns needs NumPy")
+	dtype = numpy.dtype([
+		('time', '<f8'), ('context_host', '<u4'), ('context_scheme', '<u4'),
+		('request_host', '<u4'), ('request_scheme', '<u4'), ('code', 'u1')])
+	assert dtype.itemsize == _RECORD.size
+	strings = []  # type: typing.List[str]
+	blocks = []
+	for strings, offset, records in _iter_blocks(f):
+		block = numpy.frombuffer(records, dtype=dtype)
+		blocks.append((block, offset))
+
+	def ids(field: str) -> 'INT_ARRAY':
+		return numpy.concatenate(
+			[block[field].astype(numpy.int64) + offset for block, offset in blocks] or
+			[numpy.zeros(0, dtype=numpy.int64)])
+
+	codes = numpy.concatenate(
+		[block['code'] for block, _ in blocks] or [numpy.zeros(0, dtype=numpy.uint8)]).astype(numpy.int64)
+	return LogColumns(
+		strings,
+		numpy.concatenate([block['time'] for block, _ in blocks] or [numpy.zeros(0)]),
+		ids('context_host'), ids('context_scheme'),
+		ids('request_host'), ids('request_scheme'),
+		codes >> 1, (codes & 1).astype(numpy.bool_))
@@ -16,7 +16,14 @@
 import enum
 import typing
 import collections
+import contextlib
+import copy
 import functools
+import threading
+
+MYPY = False
+if MYPY:
+	from jmatrix import interceptor
 
 JMATRIX_HEADER = """# WARNING: This file can be overwritten easily with the :jmatrix-write-rules command
 # When data is overwritten, formatting and comments will be lost.
@@ -87,6 +94,11 @@ https://github.com/gorhill/uMatrix/wiki/Rules-syntax
 	FRAME = 8
 	OTHER = 9
 
+	# Members are singletons compared by identity, hash them the same way.
+	# Enum's own __hash__ is written in python, and types are hashed for every
+	# cell looked up.
+	__hash__ = object.__hash__
+
 	def __str__(self) -> str:
 		if self == Type.ALL:
 			return '*'
@@ -130,6 +142,47 @@ https://github.com/gorhill/uMatrix/wiki/Rules-syntax
 RULE_MATRIX_TYPE = typing.Dict[str, typing.Dict[str, typing.Dict[Type, Action]]]
 RULE_MATRIX_FLAGS_TYPE = typing.Dict[str, typing.Dict[Flag, bool]]
 
+RulesDiff = typing.NamedTuple('RulesDiff', [('added', int), ('removed', int), ('changed', int)])
+
+#: How many merged rows are kept in a rules object, see Rules.merged_row
+MAX_MERGED_ROWS = 2**10
+#: How many cells are kept in a merged row
+MAX_MERGED_CELLS = 2**12
+
+class MergedRow(typing.Dict[str, typing.Dict[Type, Action]]):
+
+	"""The rows of rules.matrix_rules for sources, merged into one {dest: {Type: Action}}.
+
+	sources is a hostname widened up to '*' (see
+	interceptor._hostname_widen_list). Every type of a cell has the action of
+	the first source that has it, so looking up a cell here gives the same
+	result as going through every source. Cells are merged the first time they
+	are looked up with [], and dropped by the setters of rules when they change.
+
+	Rows are shared with copies of rules, so they are never cleared in place:
+	once a row holds MAX_MERGED_CELLS cells, new cells are merged without being
+	kept, until Rules.merged_row replaces it."""
+
+	__slots__ = ['rules', 'sources']
+
+	def __init__(self, rules: 'Rules', sources: typing.Tuple[str, ...]) -> None:
+		super().__init__()
+		self.rules = rules
+		self.sources = sources
+
+	def __missing__(self, dest: str) -> typing.Dict[Type, Action]:
+		cell = {}  # type: typing.Dict[Type, Action]
+		matrix_rules = self.rules.matrix_rules
+		for source in reversed(self.sources):
+			dests = matrix_rules.get(source)
+			if dests is not None:
+				types = dests.get(dest)
+				if types is not None:
+					cell.update(types)
+		if len(self) < MAX_MERGED_CELLS:
+			self[dest] = cell
+		return cell
+
 class Rules():
 
 	"""All rules for the interceptor."""
@@ -149,3 +202,207 @@ class Rules():
 						functools.partial(
 							# Inherit by default
 							Action, 3)))))  # type: RULE_MATRIX_TYPE
+		#: Incremented on every change made through this class.
+		#: Used by caches to detect stale entries.
+		self.generation = 0
+		#: For copies (see copy), the nested dicts which are not shared with
+		#: the original, by id. None if nothing is shared.
+		self._owned = None  # type: typing.Optional[typing.Dict[int, typing.Any]]
+		#: Prepared contexts by (hostname, scheme), see interceptor.prepare_context.
+		#: They are only valid while generation is contexts_generation.
+		self.contexts = {}  # type: typing.Dict[typing.Tuple[str, str], interceptor.ContextInfo]
+		self.contexts_generation = 0
+		#: Merged rows by hostname, see merged_row
+		self.merged_rows = {}  # type: typing.Dict[str, MergedRow]
+
+	def copy(self) -> 'Rules':
+		"""Get a copy-on-write copy of these rules.
+
+		Only the top level dicts are copied. The copy shares the nested dicts
+		with self, and only copies the ones along the way when it is changed
+		through its own setters. So self must not be changed anymore, and the
+		copy must only be changed through its setters (see RulesRef).
+
+		Readers still fill the caches of rules they don't own (contexts,
+		merged_rows and the cells of merged rows), including ones shared
+		with copies. This is safe without a lock: every entry is computed
+		from rules which don't change anymore, so racing readers store the
+		same value, and single dict operations are atomic under the GIL."""
+		new = copy.copy(self)
+		new.matrix_rules = copy.copy(self.matrix_rules)
+		new.matrix_flags = copy.copy(self.matrix_flags)
+		new._owned = {}
+		new.contexts = {}
+		# Merged rows are shared too, and copied before their cells are dropped
+		new.merged_rows = dict(self.merged_rows)
+		return new
+
+	def _child(self, parent: typing.Dict[typing.Any, typing.Any], key: typing.Any) -> typing.Any:
+		"""Get parent[key] (creating it if needed), copying it first if it is shared."""
+		child = parent[key]
+		owned = self._owned
+		if owned is not None and id(child) not in owned:
+			child = parent[key] = copy.copy(child)
+			owned[id(child)] = child
+		return child
+
+	def merged_row(self, sources: typing.Tuple[str, ...]) -> MergedRow:
+		"""Get the MergedRow of sources, a hostname widened up to '*'."""
+		row = self.merged_rows.get(sources[0])
+		if row is None or len(row) >= MAX_MERGED_CELLS:
+			if len(self.merged_rows) >= MAX_MERGED_ROWS:
+				# Not cleared in place, copies may share it
+				self.merged_rows = {}
+			row = self.merged_rows[sources[0]] = MergedRow(self, sources)
+			if self._owned is not None:
+				self._owned[id(row)] = row
+		return row
+
+	def _drop_merged(self, source: str, dest: str) -> None:
+		"""Drop the merged cells of dest which source is a part of.
+
+		Call this whenever the cell at (source, dest) changes. Copies take
+		their own version of every merged row source is a part of, as cells
+		merged from now on differ from the original's."""
+		merged_rows = self.merged_rows
+		if not merged_rows:
+			return
+		owned = self._owned
+		for host, row in list(merged_rows.items()):
+			if source not in row.sources:
+				continue
+			if owned is not None and id(row) not in owned:
+				new_row = MergedRow(self, row.sources)
+				new_row.update(row)
+				row = merged_rows[host] = owned[id(new_row)] = new_row
+			row.pop(dest, None)
+
+	def set_rule(self, source: str, dest: str, request_type: Type, action: Action) -> None:
+		"""Set the action of a single cell in the matrix."""
+		if self._owned is None:
+			self.matrix_rules[source][dest][request_type] = action
+		else:
+			self._child(self._child(self.matrix_rules, source), dest)[request_type] = action
+		self._drop_merged(source, dest)
+		self.generation += 1
+
+	def set_flag(self, host: str, flag: Flag, state: bool) -> None:
+		"""Set a flag (matrix-off, https-strict) for host."""
+		self._child(self.matrix_flags, host)[flag] = state
+		self.generation += 1
+
+	def remove_rule(self, source: str, dest: str, request_type: Type) -> None:
+		"""Remove a single cell from the matrix, if it exists."""
+		dests = self.matrix_rules.get(source)
+		if dests is None:
+			return
+		types = dests.get(dest)
+		if types is None or request_type not in types:
+			return
+		dests = self._child(self.matrix_rules, source)
+		types = self._child(dests, dest)
+		del types[request_type]
+		if not types:
+			del dests[dest]
+			if not dests:
+				del self.matrix_rules[source]
+		self._drop_merged(source, dest)
+		self.generation += 1
+
+	def remove_flag(self, host: str, flag: Flag) -> None:
+		"""Remove a flag for host, if it is set."""
+		flags = self.matrix_flags.get(host)
+		if flags is None or flag not in flags:
+			return
+		flags = self._child(self.matrix_flags, host)
+		del flags[flag]
+		if not flags:
+			del self.matrix_flags[host]
+		self.generation += 1
+
+	def update_from(self, other: 'Rules') -> RulesDiff:
+		"""Make this contain the same rules and flags as other.
+
+		Only the rules and flags which differ are touched, which is much
+		cheaper than replacing everything when few rules changed."""
+		added = removed = changed = 0
+		for host, other_flags in other.matrix_flags.items():
+			flags = self.matrix_flags.get(host, {})
+			for flag, state in other_flags.items():
+				current = flags.get(flag)
+				if current is None:
+					added += 1
+				elif current != state:
+					changed += 1
+				else:
+					continue
+				self.set_flag(host, flag, state)
+		for host, flags in list(self.matrix_flags.items()):
+			other_flags = other.matrix_flags.get(host, {})
+			for flag in [flag for flag in flags if flag not in other_flags]:
+				self.remove_flag(host, flag)
+				removed += 1
+
+		for source, other_dests in other.matrix_rules.items():
+			dests = self.matrix_rules.get(source, {})
+			for dest, other_types in other_dests.items():
+				types = dests.get(dest, {})
+				for request_type, action in other_types.items():
+					current = types.get(request_type)
+					if current is None:
+						added += 1
+					elif current != action:
+						changed += 1
+					else:
+						continue
+					self.set_rule(source, dest, request_type, action)
+		for source, dests in list(self.matrix_rules.items()):
+			other_dests = other.matrix_rules.get(source, {})
+			for dest, types in list(dests.items()):
+				other_types = other_dests.get(dest, {})
+				for request_type in [t for t in types if t not in other_types]:
+					self.remove_rule(source, dest, request_type)
+					removed += 1
+		return RulesDiff(added, removed, changed)
+
+	def touch(self) -> None:
+		"""Mark this object as changed.
+
+		Call this after modifying matrix_rules or matrix_flags directly."""
+		self.merged_rows = {}
+		self.generation += 1
+
+
+class RulesRef():
+
+	"""The current version of a set of rules, which is never changed in place.
+
+	Readers take rules once (eg: per request) and get a consistent view of
+	it, however long they hold on to it, without any locking. Writers change
+	a copy-on-write copy in edit, which is then published in one assignment.
+	Writers are serialized with a lock. Readers do fill the caches of the
+	published rules, which is safe, see Rules.copy."""
+
+	__slots__ = ['rules', '_lock']
+
+	def __init__(self, rules: typing.Optional[Rules] = None) -> None:
+		#: The current version. Do not change it in place.
+		self.rules = Rules() if rules is None else rules
+		self._lock = threading.Lock()
+
+	def publish(self, rules: Rules) -> None:
+		"""Replace the current version with rules, which must not be changed afterwards."""
+		with self._lock:
+			self.rules = rules
+
+	@contextlib.contextmanager
+	def edit(self) -> typing.Iterator[Rules]:
+		"""Change the rules, publishing the changes at the end of the with block.
+
+		If the block raises, nothing is published."""
+		with self._lock:
+			current = self.rules
+			new = current.copy()
+			yield new
+			if new.generation != current.generation:
+				self.rules = new
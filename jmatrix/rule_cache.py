@@ -0,0 +1,128 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A binary cache of parsed rule files, to skip parsing on startup.
+
+The cache is a marshal dump of the parsed rules (with every cell packed into
+an int by compiled.pack_cell) and the parse errors, keyed on the size, mtime
+and hash of the rule file it was parsed from.
+"""
+
+import hashlib
+import marshal
+import os
+import pathlib
+import typing
+
+from jmatrix import compiled, rule, umatrix_parser
+
+CACHE_MAGIC = b'JMXRULES'
+CACHE_VERSION = 2
+
+# (size, mtime_ns, sha256) of a rule file
+CACHE_KEY_TYPE = typing.Tuple[int, int, bytes]
+
+RULES_ERRORS_TYPE = typing.Tuple[rule.Rules, typing.List[umatrix_parser.JMatrixParserError]]
+
+
+def cache_path(path: pathlib.Path) -> pathlib.Path:
+	"""Get the default cache location for the rule file at path."""
+	return path.with_name(path.name + ".cache")
+
+
+def _header() -> bytes:
+	# marshal's format may change between python versions
+	return CACHE_MAGIC + bytes((CACHE_VERSION, marshal.version))
+
+
+def _dump(key: CACHE_KEY_TYPE, rules: rule.Rules,
+		  errors: typing.Iterable[umatrix_parser.JMatrixParserError]) -> bytes:
+	flags = {
+		host: {flag.value: state for flag, state in host_flags.items()}
+		for host, host_flags in rules.matrix_flags.items()}
+	cells = {
+		source: {dest: compiled.pack_cell(types) for dest, types in dests.items()}
+		for source, dests in rules.matrix_rules.items()}
+	return _header() + marshal.dumps((key, flags, cells, [(e.args[0], e.line) for e in errors]))
+
+
+def _load(data: bytes, key: CACHE_KEY_TYPE) -> typing.Optional[RULES_ERRORS_TYPE]:
+	header = _header()
+	if not data.startswith(header):
+		return None
+	try:
+		cached_key, flags, cells, errors = marshal.loads(data[len(header):])
+	except (EOFError, ValueError, TypeError):
+		return None
+	if tuple(cached_key) != key:
+		return None
+
+	rules = rule.Rules()
+	for host, host_flags in flags.items():
+		rules.matrix_flags[host].update(
+			(rule.Flag(flag), state) for flag, state in host_flags.items())
+	# There are very few distinct cells, so only unpack each one once
+	unpacked = {}  # type: typing.Dict[int, typing.Dict[rule.Type, rule.Action]]
+	for source, dests in cells.items():
+		source_rules = rules.matrix_rules[source]
+		for dest, packed in dests.items():
+			types = unpacked.get(packed)
+			if types is None:
+				types = unpacked[packed] = compiled.unpack_cell(packed)
+			source_rules[dest].update(types)
+	rules.touch()
+	return rules, [umatrix_parser.JMatrixParserError(message, line) for message, line in errors]
+
+
+def _write(path: pathlib.Path, data: bytes) -> None:
+	tmp = path.with_name(path.name + ".tmp")
+	with open(tmp, "wb") as f:
+		f.write(data)
+	os.replace(tmp, path)
+
+
+def load_rules(path: pathlib.Path, cache: typing.Optional[pathlib.Path] = None,
+			   jobs: int = 1) -> RULES_ERRORS_TYPE:
+	"""Parse the rule file at path, going through a binary cache.
+
+	cache: Where to keep the cache, defaults to cache_path(path).
+	jobs: Parse with this many processes (see parse_rules_parallel).
+
+	Returns the parsed rules, and the errors found while parsing them (as
+	with parse_rules(..., collate_errors=True)). If the cache is missing or
+	out of date, the file is parsed and the cache is rewritten."""
+	if cache is None:
+		cache = cache_path(path)
+	with open(path, "rb") as f:
+		stat = os.fstat(f.fileno())
+		text = f.read()
+	key = (stat.st_size, stat.st_mtime_ns, hashlib.sha256(text).digest())
+
+	try:
+		cached = _load(cache.read_bytes(), key)
+	except OSError:
+		cached = None
+	if cached is not None:
+		return cached
+
+	rules = rule.Rules()
+	errors = umatrix_parser.parse_rules_parallel(text, rules, jobs=jobs, collate_errors=True)
+	try:
+		_write(cache, _dump(key, rules, errors))
+	except OSError:
+		# The cache is only an optimization
+		pass
+	return rules, errors
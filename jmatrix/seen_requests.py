@@ -0,0 +1,101 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A bounded store of the requests we have made decisions on."""
+
+import collections
+import threading
+import typing
+
+from jmatrix import rule
+from jmatrix.compiled import CELL_MASK, type_shift
+
+SEEN_ENTRY_TYPE = typing.Tuple[str, rule.Type, rule.Action]
+
+
+class SeenRequests():
+
+	"""Requests seen per context host, for completion purposes.
+
+	Every (context host, request host) pair is a single entry, holding the
+	last action for every request type packed into an int (like
+	compiled.pack_cell). Once there are more than max_entries entries, whole
+	context hosts are evicted, least recently used first. Every context host
+	also keeps at most max_per_host entries, dropping its least recently used
+	request hosts.
+
+	record and clear can be called from different threads (eg: the request
+	interceptor and the GUI thread)."""
+
+	__slots__ = ['max_entries', 'max_per_host', '_hosts', '_size', '_lock']
+
+	def __init__(self, max_entries: int = 2**16, max_per_host: int = 2**10) -> None:
+		self.max_entries = max_entries
+		self.max_per_host = min(max_per_host, max_entries)
+		self._hosts = collections.OrderedDict()  # type: typing.OrderedDict[str, typing.OrderedDict[str, int]]
+		self._size = 0
+		self._lock = threading.Lock()
+
+	def __len__(self) -> int:
+		return self._size
+
+	def __contains__(self, context_host: object) -> bool:
+		return context_host in self._hosts
+
+	def clear(self) -> None:
+		with self._lock:
+			self._hosts.clear()
+			self._size = 0
+
+	def record(self, context_host: str, request_host: str,
+			   request_type: rule.Type, action: rule.Action) -> None:
+		"""Remember that action was taken for a request."""
+		with self._lock:
+			hosts = self._hosts
+			row = hosts.get(context_host)
+			if row is None:
+				row = hosts[context_host] = collections.OrderedDict()
+			else:
+				hosts.move_to_end(context_host)
+
+			shift = type_shift(request_type)
+			packed = row.get(request_host)
+			if packed is None:
+				packed = 0
+				self._size += 1
+				if len(row) >= self.max_per_host:
+					row.popitem(last=False)
+					self._size -= 1
+			else:
+				row.move_to_end(request_host)
+			row[request_host] = (packed & ~(CELL_MASK << shift)) | (action.value << shift)
+
+			while self._size > self.max_entries:
+				_, evicted = hosts.popitem(last=False)
+				self._size -= len(evicted)
+
+	def entries(self, context_host: str) -> typing.List[SEEN_ENTRY_TYPE]:
+		"""Get the (request host, type, action) of every request seen on context_host."""
+		row = self._hosts.get(context_host)
+		if row is None:
+			return []
+		return [
+			(request_host, request_type, rule.Action(code))
+			for request_host, packed in list(row.items())
+			for request_type in rule.Type
+			for code in ((packed >> type_shift(request_type)) & CELL_MASK,)
+			if code
+		]
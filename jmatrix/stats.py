@@ -0,0 +1,119 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Opt-in instrumentation of request interception.
+
+Nothing in here is used unless a Stats object is created and handed to the
+places that record into it (eg: VerdictCache.stats)."""
+
+import bisect
+import typing
+
+from jmatrix import interceptor, rule
+
+#: Upper bounds (in nanoseconds) of the latency histogram buckets: 1us to 65ms.
+#: The last bucket counts everything slower than that.
+LATENCY_BUCKETS_NS = tuple(1000 * 2**i for i in range(17))
+
+StatsSnapshot = typing.NamedTuple('StatsSnapshot', [
+	('requests', int),
+	# Request counts in every LATENCY_BUCKETS_NS bucket (plus the overflow bucket), per type
+	('latency', typing.Dict[rule.Type, typing.Tuple[int, ...]]),
+	('latency_total_ns', typing.Dict[rule.Type, int]),
+	# How often each step of should_block decided a verdict (only for cache misses)
+	('steps', typing.Dict[interceptor.Step, int]),
+	('cache', typing.Optional[interceptor.CacheInfo]),
+	# Net change of sys.getallocatedblocks() over all requests. It is process
+	# wide, so it includes other threads, and misses blocks freed before the
+	# request was handled: it shows growth, not allocations.
+	('block_growth', int),
+])
+
+
+class Stats():
+
+	"""Latency, precedence step and memory growth counters for intercepted requests."""
+
+	__slots__ = ['cache', 'requests', 'block_growth', '_latency', '_latency_total', '_steps']
+
+	def __init__(self, cache: typing.Optional[interceptor.VerdictCache] = None) -> None:
+		#: A cache to report hit rates of, if any
+		self.cache = cache
+		self.reset()
+
+	def reset(self) -> None:
+		self.requests = 0
+		self.block_growth = 0
+		# Indexed by Type.value, to avoid hashing enums in the hot path
+		self._latency = [[0] * (len(LATENCY_BUCKETS_NS) + 1) for _ in range(max(t.value for t in rule.Type) + 1)]
+		self._latency_total = [0] * len(self._latency)
+		self._steps = [0] * len(interceptor.Step)
+
+	def record_request(self, request_type: rule.Type, elapsed_ns: int, block_growth: int = 0) -> None:
+		"""Record a request that took elapsed_ns to handle, see StatsSnapshot.block_growth."""
+		self.requests += 1
+		self.block_growth += block_growth
+		self._latency[request_type.value][bisect.bisect_left(LATENCY_BUCKETS_NS, elapsed_ns)] += 1
+		self._latency_total[request_type.value] += elapsed_ns
+
+	def record_step(self, step: interceptor.Step) -> None:
+		"""Record the step that decided a verdict."""
+		self._steps[step.value] += 1
+
+	def snapshot(self) -> StatsSnapshot:
+		"""Get a copy of the current statistics."""
+		return StatsSnapshot(
+			self.requests,
+			{t: tuple(self._latency[t.value]) for t in rule.Type if self._latency_total[t.value]},
+			{t: self._latency_total[t.value] for t in rule.Type if self._latency_total[t.value]},
+			{step: self._steps[step.value] for step in interceptor.Step},
+			self.cache.cache_info() if self.cache is not None else None,
+			self.block_growth)
+
+
+def _format_ns(ns: float) -> str:
+	if ns >= 10**6:
+		return "{:.1f}ms".format(ns / 10**6)
+	return "{:.1f}us".format(ns / 10**3)
+
+def _percentile(buckets: typing.Sequence[int], fraction: float) -> str:
+	"""The upper bound of the bucket holding the given fraction of requests."""
+	wanted = fraction * sum(buckets)
+	seen = 0
+	for i, count in enumerate(buckets):
+		seen += count
+		if seen >= wanted:
+			break
+	if i >= len(LATENCY_BUCKETS_NS):
+		return ">" + _format_ns(LATENCY_BUCKETS_NS[-1])
+	return "<" + _format_ns(LATENCY_BUCKETS_NS[i])
+
+def format_snapshot(snapshot: StatsSnapshot) -> str:
+	"""Format snapshot for humans."""
+	lines = ["{} requests, net block growth {}".format(snapshot.requests, snapshot.block_growth)]
+	if snapshot.cache is not None:
+		cache = snapshot.cache
+		lookups = cache.hits + cache.misses
+		lines.append("cache: {:.1%} hits ({}/{}), {}/{} entries".format(
+			cache.hits / lookups if lookups else 0, cache.hits, lookups, cache.currsize, cache.maxsize))
+	for request_type, buckets in snapshot.latency.items():
+		count = sum(buckets)
+		lines.append("{:8} {:6} requests, mean {}, p50 {}, p99 {}".format(
+			str(request_type), count, _format_ns(snapshot.latency_total_ns[request_type] / count),
+			_percentile(buckets, 0.5), _percentile(buckets, 0.99)))
+	lines.append("decided by: " + ", ".join(
+		"{} {}".format(step.name.lower(), count) for step, count in snapshot.steps.items()))
+	return "\n".join(lines)
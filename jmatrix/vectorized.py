@@ -0,0 +1,331 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check whole columns of requests at once with NumPy, for audits of large logs.
+
+Hosts are interned into integer ids, and the rules are compiled (see
+compiled.compile_rules) into a sorted array of (source id, dest id) keys and
+their packed cells. Requests are deduplicated, and every step of
+interceptor.should_block then runs on all the requests it has not decided yet
+at once.
+
+NumPy is optional. Without it, should_block_columns falls back on
+interceptor.should_block_columns."""
+
+import array
+import itertools
+import typing
+
+from jmatrix import compiled, interceptor, rule
+
+try:
+	import numpy
+except ImportError:
+	numpy = None  # type: ignore
+
+HAVE_NUMPY = numpy is not None
+
+_BLOCK = rule.Action.BLOCK.value
+_ALLOW = rule.Action.ALLOW.value
+_MASK = compiled.CELL_MASK
+_ALL_SHIFT = compiled.type_shift(rule.Type.ALL)
+#: The lowest bit of every type in a packed cell
+_LOW_BITS = sum(1 << compiled.type_shift(t) for t in rule.Type)
+#: Keys of cells are source id << _KEY_SHIFT | dest id
+_KEY_SHIFT = 32
+
+MYPY = False
+if MYPY:
+	import numpy.typing
+	BOOL_ARRAY = numpy.typing.NDArray[numpy.bool_]
+	INT_ARRAY = numpy.typing.NDArray[numpy.int64]
+
+
+ContextPlan = typing.NamedTuple('ContextPlan', [
+	('matrix_off', bool),
+	('https_only', bool),
+	# The host id of the 'first party' domain
+	('fp_domain', int),
+	# The compiled source ids that apply, most specific first
+	('source_ids', typing.Tuple[int, ...]),
+])
+
+RequestPlan = typing.NamedTuple('RequestPlan', [
+	# The host id of the 'first party' domain
+	('fp_domain', int),
+	# Host ids of the cells looked up after the exact hostname, when the
+	# context is a third party and when it is the first party
+	('third_party_steps', typing.Tuple[int, ...]),
+	('first_party_steps', typing.Tuple[int, ...]),
+])
+
+
+class HostIds(typing.Dict[str, int]):
+
+	"""Interned ids of hosts, new hosts get the next id when they are looked up with []."""
+
+	__slots__ = ['hosts']
+
+	def __init__(self) -> None:
+		super().__init__()
+		#: Hosts by id
+		self.hosts = []  # type: typing.List[str]
+
+	def __missing__(self, host: str) -> int:
+		host_id = self[host] = len(self.hosts)
+		self.hosts.append(host)
+		return host_id
+
+
+#: The value of every type, looked up faster than Type.value
+_TYPE_VALUES = {request_type: request_type.value for request_type in rule.Type}
+
+
+class BulkChecker():
+
+	"""Checks columns of requests against rules, see should_block_columns.
+
+	Like compiled.CompiledRules, changes made to rules afterwards are not seen.
+	Host ids, and what was found out about every host, are kept between calls."""
+
+	def __init__(self, rules: rule.Rules, fpdomain_fn: typing.Callable[[str], str]) -> None:
+		if numpy is None:
+			raise ImportError("BulkChecker needs NumPy")
+		self.compiled = compiled.compile_rules(rules)
+		self.fpdomain_fn = fpdomain_fn
+		#: Interned ids of every host (and scheme) seen
+		self.host_ids = HostIds()
+		self.hosts = self.host_ids.hosts
+		self._star = self.host_ids['*']
+		self._no_domain = self.host_ids['']
+		self._contexts = {}  # type: typing.Dict[typing.Tuple[int, int], ContextPlan]
+		self._requests = {}  # type: typing.Dict[int, RequestPlan]
+
+		keys = []  # type: typing.List[int]
+		cells = []  # type: typing.List[int]
+		for dest, column in self.compiled.cells.items():
+			dest_id = self.host_ids[dest]
+			for source_id, packed in column.items():
+				keys.append(source_id << _KEY_SHIFT | dest_id)
+				cells.append(packed)
+		order = numpy.argsort(numpy.array(keys, dtype=numpy.int64))
+		self._keys = numpy.array(keys, dtype=numpy.int64)[order]  # type: INT_ARRAY
+		self._cells = numpy.array(cells, dtype=numpy.int64)[order]  # type: INT_ARRAY
+		self._shifts = numpy.zeros(max(t.value for t in rule.Type) + 1, dtype=numpy.int64)  # type: INT_ARRAY
+		for request_type in rule.Type:
+			self._shifts[request_type.value] = compiled.type_shift(request_type)
+
+	def _context(self, host_id: int, scheme_id: int) -> ContextPlan:
+		plan = self._contexts.get((host_id, scheme_id))
+		if plan is None:
+			hostname, scheme = self.hosts[host_id], self.hosts[scheme_id]
+			rules = self.compiled
+			widened = interceptor._hostname_widen_list(hostname)
+			scheme_host = scheme + "-scheme"
+			matrix_off = scheme_host in rules.matrix_off or not rules.matrix_off.isdisjoint(widened)
+			https_strict = scheme_host in rules.https_strict or not rules.https_strict.isdisjoint(widened)
+			plan = self._contexts[(host_id, scheme_id)] = ContextPlan(
+				matrix_off, https_strict and scheme == "https",
+				self.host_ids[interceptor.host_info(hostname, self.fpdomain_fn).fp_domain],
+				rules.context_ids(hostname))
+		return plan
+
+	def _request(self, host_id: int) -> RequestPlan:
+		plan = self._requests.get(host_id)
+		if plan is None:
+			request = interceptor.host_info(self.hosts[host_id], self.fpdomain_fn)
+			not_star = '*'.__ne__
+			# See interceptor.should_block for the order of the cells
+			first_party_steps = []
+			dest = request.hostname
+			for domain in request.widened:
+				dest = domain
+				if domain == request.fp_domain:
+					break
+				first_party_steps.append(domain)
+			first_party_steps.append('1st-party')
+			first_party_steps.extend(itertools.takewhile(not_star, interceptor._hostname_widen_list(dest)))
+			intern = self.host_ids.__getitem__
+			plan = self._requests[host_id] = RequestPlan(
+				intern(request.fp_domain),
+				tuple(map(intern, itertools.takewhile(not_star, request.widened))),
+				tuple(map(intern, first_party_steps)))
+		return plan
+
+	def _lookup(self, source_ids: 'INT_ARRAY', dests: 'INT_ARRAY') -> 'INT_ARRAY':
+		"""Get the cells at dests, merged over the rows of source_ids.
+
+		Every row of source_ids has the source ids of a context, most
+		specific first and padded with -1 (see ContextPlan.source_ids)."""
+		merged = numpy.zeros(len(dests), dtype=numpy.int64)
+		keys = self._keys
+		if not len(keys):
+			return merged
+		for level in range(source_ids.shape[1]):
+			sources = source_ids[:, level]
+			wanted = (sources << _KEY_SHIFT) | dests
+			found = numpy.minimum(numpy.searchsorted(keys, wanted), len(keys) - 1)
+			hit = (keys[found] == wanted) & (sources >= 0)
+			cells = numpy.where(hit, self._cells[found], 0)
+			# The more specific sources win, type by type
+			taken = (merged | (merged >> 1)) & _LOW_BITS
+			merged |= cells & ~(taken | (taken << 1))
+		return merged
+
+	def should_block_columns(
+			self, context_hostnames: typing.Iterable[str], context_schemes: typing.Iterable[str],
+			request_hostnames: typing.Iterable[str], request_schemes: typing.Iterable[str],
+			request_types: typing.Iterable[rule.Type]) -> 'BOOL_ARRAY':
+		"""Check the requests in the given columns, which must have the same length.
+
+		Returns an array of verdicts in the same order as the requests, True
+		meaning the request should be blocked. These are exactly the verdicts
+		of interceptor.should_block."""
+		intern = self.host_ids.__getitem__
+		columns = [
+			numpy.fromiter(map(intern, context_hostnames), dtype=numpy.int64),
+			numpy.fromiter(map(intern, context_schemes), dtype=numpy.int64),
+			numpy.fromiter(map(intern, request_hostnames), dtype=numpy.int64),
+			# The request scheme only matters for https-strict
+			numpy.fromiter(map("https".__eq__, request_schemes), dtype=numpy.int64),
+			numpy.fromiter(map(_TYPE_VALUES.__getitem__, request_types), dtype=numpy.int64),
+		]
+		if len(set(map(len, columns))) != 1:
+			raise ValueError("Columns of different lengths")
+		if not len(columns[0]):
+			return numpy.zeros(0, dtype=numpy.bool_)
+
+		# Only check distinct requests, keyed on a single int when it fits
+		context_hosts, schemes, request_hosts, https, types = columns
+		n_hosts = len(self.hosts)
+		n_types = len(self._shifts)
+		contexts, context_index = numpy.unique(context_hosts * n_hosts + schemes, return_inverse=True)
+		if len(contexts) * n_hosts * 2 * n_types >= 2**63:
+			requests, inverse = numpy.unique(numpy.stack(columns, axis=1), axis=0, return_inverse=True)
+		else:
+			keys = ((context_index.reshape(-1) * n_hosts + request_hosts) * 2 + https) * n_types + types
+			unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+			unique_contexts = contexts[unique_keys // (n_hosts * 2 * n_types)]
+			requests = numpy.stack([
+				unique_contexts // n_hosts,
+				unique_contexts % n_hosts,
+				unique_keys // (2 * n_types) % n_hosts,
+				unique_keys // n_types % 2,
+				unique_keys % n_types,
+			], axis=1)
+		return self._check(requests)[inverse.reshape(-1)]
+
+	def _check(self, requests: 'INT_ARRAY') -> 'BOOL_ARRAY':
+		"""Check distinct requests, given as rows of encoded columns."""
+		contexts, context_index = numpy.unique(requests[:, :2], axis=0, return_inverse=True)
+		context_plans = [self._context(int(host_id), int(scheme_id)) for host_id, scheme_id in contexts]
+		request_hosts, request_index = numpy.unique(requests[:, 2], return_inverse=True)
+		request_plans = [self._request(int(host_id)) for host_id in request_hosts]
+		context_index = context_index.reshape(-1)
+		request_index = request_index.reshape(-1)
+
+		def column(values: typing.Iterable[int]) -> 'INT_ARRAY':
+			return numpy.fromiter(values, dtype=numpy.int64)
+
+		def padded(rows: typing.Sequence[typing.Tuple[int, ...]], width: int) -> 'INT_ARRAY':
+			table = numpy.full((len(rows), width), -1, dtype=numpy.int64)
+			for i, row in enumerate(rows):
+				table[i, :len(row)] = row
+			return table
+
+		n = len(requests)
+		request_host = requests[:, 2]
+		https = requests[:, 3].astype(numpy.bool_)
+		shift = self._shifts[requests[:, 4]]
+
+		blocked = numpy.ones(n, dtype=numpy.bool_)
+		undecided = numpy.ones(n, dtype=numpy.bool_)
+		# Set when the '*' type of a cell allowed the request (r_override in should_block)
+		override = numpy.zeros(n, dtype=numpy.bool_)
+
+		matrix_off = numpy.array([plan.matrix_off for plan in context_plans], dtype=numpy.bool_)[context_index]
+		blocked[matrix_off] = False
+		undecided &= ~matrix_off
+		https_only = numpy.array([plan.https_only for plan in context_plans], dtype=numpy.bool_)[context_index]
+		undecided &= ~(https_only & ~https)
+
+		source_ids = padded(
+			[plan.source_ids for plan in context_plans],
+			max(len(plan.source_ids) for plan in context_plans))[context_index]
+		request_fp_domain = column(plan.fp_domain for plan in request_plans)[request_index]
+		first_party = (
+			(column(plan.fp_domain for plan in context_plans)[context_index] == request_fp_domain) &
+			(request_fp_domain != self._no_domain))
+		width = max(max(len(plan.first_party_steps), len(plan.third_party_steps)) for plan in request_plans)
+		steps = numpy.where(
+			first_party[:, None],
+			padded([plan.first_party_steps for plan in request_plans], width)[request_index],
+			padded([plan.third_party_steps for plan in request_plans], width)[request_index])
+
+		def decide(index: 'INT_ARRAY', cells: 'INT_ARRAY') -> 'BOOL_ARRAY':
+			"""Apply the exact type of cells, returning where it did not decide."""
+			action = (cells >> shift[index]) & _MASK
+			deciding = (action == _BLOCK) | (action == _ALLOW)  # type: BOOL_ARRAY
+			blocked[index[deciding]] = action[deciding] == _BLOCK
+			undecided[index[deciding]] = False
+			return numpy.logical_not(deciding)
+
+		# Exact hostname, exact type and any type
+		index = numpy.flatnonzero(undecided)
+		cells = self._lookup(source_ids[index], request_host[index])
+		decide(index, cells)
+		override[index] = ((cells >> _ALL_SHIFT) & _MASK) == _ALLOW
+
+		# Ancestor cells (and the 1st-party cell) up to the root
+		for step in range(steps.shape[1]):
+			dests = steps[:, step]
+			index = numpy.flatnonzero(undecided & (dests >= 0))
+			if not len(index):
+				break
+			cells = self._lookup(source_ids[index], dests[index])
+			# Don't override a more specific allow rule
+			update = decide(index, cells) & ~override[index]
+			action = (cells >> _ALL_SHIFT) & _MASK
+			block = update & (action == _BLOCK)
+			undecided[index[block]] = False
+			override[index[update]] = action[update] == _ALLOW
+
+		# Hostname specific type cells, then the hostname type api call
+		index = numpy.flatnonzero(undecided)
+		cells = self._lookup(source_ids[index], numpy.full(len(index), self._star, dtype=numpy.int64))
+		action = (cells >> shift[index]) & _MASK
+		blocked[index] = numpy.where(
+			action == _BLOCK, True,
+			numpy.where(override[index] | (action == _ALLOW), False,
+						((cells >> _ALL_SHIFT) & _MASK) != _ALLOW))
+		return blocked
+
+
+def should_block_columns(
+		context_hostnames: typing.Iterable[str], context_schemes: typing.Iterable[str],
+		request_hostnames: typing.Iterable[str], request_schemes: typing.Iterable[str],
+		request_types: typing.Iterable[rule.Type], fpdomain_fn: typing.Callable[[str], str],
+		rules: rule.Rules) -> 'typing.Union[BOOL_ARRAY, array.array[int]]':
+	"""Like interceptor.should_block_columns, but vectorized with NumPy if it is installed.
+
+	Without NumPy, this returns the array of interceptor.should_block_columns.
+	To check more columns against the same rules, use a BulkChecker."""
+	if numpy is None:
+		return interceptor.should_block_columns(
+			context_hostnames, context_schemes, request_hostnames, request_schemes,
+			request_types, fpdomain_fn, rules)
+	return BulkChecker(rules, fpdomain_fn).should_block_columns(
+		context_hostnames, context_schemes, request_hostnames, request_schemes, request_types)
@@ -0,0 +1,108 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+import pytest
+
+from jmatrix import analysis, interceptor, rule, umatrix_parser
+from tests.test_compiled import _random_host, _random_rules
+from tests.test_interceptor import stock_rules  # noqa: F401
+
+Issue = analysis.Issue
+
+
+def _rules(lines):
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(lines, rule_obj)
+	return rule_obj
+
+def _found(findings):
+	return {(f.issue, f.source, f.dest, f.type, f.flag) for f in findings}
+
+
+SHADOWED_ALL = ["a.com c.com * allow"] + [
+	"a.com c.com {} block".format(str(t)) for t in analysis._CONCRETE_TYPES]
+
+ANALYZE_TESTS = [
+	(["* * * block", "a.com * * block"],
+	 {(Issue.REDUNDANT, "a.com", "*", rule.Type.ALL, None)}),
+	(["* * * block", "b.a.com c.com css allow", "a.com c.com css allow"],
+	 {(Issue.REDUNDANT, "b.a.com", "c.com", rule.Type.CSS, None)}),
+	# Inherit only matters if there is something to inherit from
+	(["a.com c.com css inherit"],
+	 {(Issue.REDUNDANT, "a.com", "c.com", rule.Type.CSS, None)}),
+	(["* c.com css allow", "a.com c.com css inherit"], set()),
+	(["matrix-off: a.com false", "https-strict: * true", "https-strict: a.com true"],
+	 {(Issue.DEAD, "a.com", None, None, rule.Flag.MATRIX_OFF),
+	  (Issue.REDUNDANT, "a.com", None, None, rule.Flag.HTTPS_STRICT)}),
+	# Requests of type * still get to the type * cell
+	(SHADOWED_ALL, set()),
+]
+
+@pytest.mark.parametrize(('lines', 'found'), ANALYZE_TESTS)
+def test_analyze(lines, found):
+	assert _found(analysis.analyze(_rules(lines))) == found
+
+def test_analyze_typed_only():
+	assert _found(analysis.analyze(_rules(SHADOWED_ALL), typed_only=True)) == {
+		(Issue.SHADOWED, "a.com", "c.com", rule.Type.ALL, None)}
+	# A more specific source can still get to the type * cell
+	assert not analysis.analyze(_rules(SHADOWED_ALL + ["b.a.com c.com css inherit"]), typed_only=True)
+
+def test_minimize_chain():
+	rule_obj = _rules(["* * * block", "a.com * * block", "b.a.com * * block", "c.com d.com css allow"])
+	minimized, removed = analysis.minimize(rule_obj)
+	assert umatrix_parser.map_to_rules(minimized).splitlines() == ["* * * block", "c.com d.com css allow"]
+	assert len(removed) == 2
+	# The original is left alone
+	assert "b.a.com" in rule_obj.matrix_rules
+
+@pytest.mark.parametrize('typed_only', [False, True])
+@pytest.mark.parametrize('seed', range(20))
+def test_minimize_random(seed, typed_only):
+	"""Minimized rules give the same verdicts."""
+	rng = random.Random(seed)
+	fpdomain_fn = interceptor._get_first_party_domain
+	request_types = analysis._CONCRETE_TYPES if typed_only else tuple(rule.Type)
+	for _ in range(10):
+		rule_obj = _random_rules(rng)
+		umatrix_parser.parse_rules(SHADOWED_ALL, rule_obj)
+		# Add some rules that are likely redundant
+		for source, dests in list(rule_obj.matrix_rules.items()):
+			for dest, types in list(dests.items()):
+				for request_type, action in list(types.items()):
+					rule_obj.set_rule("www." + source, dest, request_type, action)
+		minimized, _ = analysis.minimize(rule_obj, typed_only)
+		assert not analysis.analyze(minimized, typed_only)
+		requests = [("a.com", "http", "c.com", "http", request_type, fpdomain_fn) for request_type in request_types]
+		for _ in range(200):
+			requests.append((_random_host(rng), rng.choice(("http", "https")),
+							 _random_host(rng), rng.choice(("http", "https")),
+							 rng.choice(request_types), fpdomain_fn))
+		for args in requests:
+			assert interceptor.should_block(*args, minimized) == interceptor.should_block(*args, rule_obj), args
+
+def test_main(tmp_path, capsys):
+	rules_file = tmp_path / "rules"
+	rules_file.write_text("* * * block\na.com * * block\nmatrix-off: a.com false\n")
+	out = tmp_path / "out"
+	assert analysis.main([str(rules_file), "--minimize", str(out)]) == 0
+	assert out.read_text() == "* * * block\n"
+	assert len(capsys.readouterr().out.splitlines()) == 2
+
+
+def test_benchmark_analyze_stock(stock_rules, benchmark):
+	benchmark(analysis.analyze, _rules(stock_rules))
@@ -0,0 +1,145 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+import pytest
+
+from jmatrix import cache, interceptor
+from tests.test_fpdomain import PSL_SAMPLE
+from jmatrix.vendor.fpdomain import fpdomain
+
+
+POLICIES = tuple(cache.Policy)
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_cache_basic(policy):
+	c = cache.make_cache(4, policy)
+	assert c.get("a") is None
+	c["a"] = 1
+	assert c.get("a") == 1
+	for i in range(10):
+		c[str(i)] = i
+	assert len(c) == 4
+	assert c.cache_info() == cache.CacheInfo(1, 1, 4, 4)
+	c.resize(2)
+	assert len(c) == 2
+	assert c.cache_info().maxsize == 2
+	c.clear()
+	assert len(c) == 0
+	assert c.cache_info().hits == 1
+
+def test_lru_order():
+	c = cache.LRUCache(2)
+	c["a"] = 1
+	c["b"] = 2
+	c.get("a")
+	c["c"] = 3
+	assert c.get("a") == 1
+	assert c.get("b") is None
+
+def test_two_q_promotion():
+	c = cache.TwoQCache(8)
+	c["hot"] = 1
+	# Push hot out of the FIFO queue, it is still remembered
+	for i in range(8):
+		c[str(i)] = i
+	assert c.get("hot") is None
+	c["hot"] = 1
+	# Now in the main queue, which one-off keys don't touch
+	for i in range(100):
+		c["once{}".format(i)] = i
+	assert c.get("hot") == 1
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_cached(policy):
+	calls = []
+	def add(a, b):
+		"""Add things."""
+		calls.append((a, b))
+		return a + b
+	cached_add = cache.cached(add, 2, policy)
+	assert cached_add.__doc__ == "Add things."
+	assert cached_add.__wrapped__ is add
+	assert cached_add(1, 2) == 3
+	assert cached_add(1, 2) == 3
+	assert calls == [(1, 2)]
+	assert cached_add.cache_info() == cache.CacheInfo(1, 1, 2, 1)
+	cached_add.cache_clear()
+	assert cached_add.cache_info().currsize == 0
+
+def test_configure_host_caches():
+	fpdomain_fn = interceptor._get_first_party_domain
+	try:
+		interceptor.configure_host_caches(64, cache.Policy.TWO_Q)
+		assert interceptor.host_info.cache_info().maxsize == 64
+		assert interceptor._hostname_widen_list("a.b.com") == ("a.b.com", "b.com", "com", "*")
+		assert interceptor._hostname_widen_list.cache_info().currsize == 1
+		assert interceptor._get_first_party_domain("a.b.com") == "b.com"
+		# The same settings keep the warm caches
+		interceptor.configure_host_caches(64, cache.Policy.TWO_Q)
+		assert interceptor._hostname_widen_list.cache_info().currsize == 1
+	finally:
+		interceptor.configure_host_caches()
+	assert interceptor.host_info.cache_info().maxsize == interceptor.HOST_CACHE_SIZE
+	assert interceptor._get_first_party_domain.__wrapped__ is fpdomain_fn.__wrapped__
+
+def test_psl_cache():
+	psl = fpdomain.PSL(PSL_SAMPLE, snapshot=False, cache=cache.LRUCache(16))
+	other = fpdomain.PSL(PSL_SAMPLE, snapshot=False)
+	assert psl.fp_domain("www.google.com") == "google.com"
+	assert psl.fp_domain("www.google.com") == "google.com"
+	assert psl.cache.cache_info() == cache.CacheInfo(1, 1, 16, 1)
+	# Nothing is shared between instances
+	assert other.cache is None
+	assert other.fp_domain("www.google.com") == "google.com"
+	assert psl.cache.cache_info().currsize == 1
+
+
+# Hit rates on hosts seen on every page, mixed with a stream of hosts only
+# seen once (eg: trackers with random subdomains)
+
+def _polluted_keys(n, hot=256, seed=1337):
+	rng = random.Random(seed)
+	keys = []
+	for i in range(n):
+		if rng.random() < 0.5:
+			keys.append("hot{}.com".format(rng.randrange(hot)))
+		else:
+			keys.append("once{}.tracker.com".format(i))
+	return keys
+
+def _hit_rate(c, keys):
+	for key in keys:
+		if c.get(key) is None:
+			c[key] = key
+	info = c.cache_info()
+	return info.hits / (info.hits + info.misses)
+
+def test_two_q_scan_resistance():
+	keys = _polluted_keys(50000)
+	lru = _hit_rate(cache.LRUCache(256), keys)
+	two_q = _hit_rate(cache.TwoQCache(256), keys)
+	assert two_q > lru
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_benchmark_cached_hit(policy, benchmark):
+	fn = cache.cached(str.upper, 256, policy)
+	keys = _polluted_keys(1000)
+	def run():
+		for key in keys:
+			fn(key)
+	benchmark(run)
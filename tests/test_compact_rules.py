@@ -0,0 +1,112 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gc
+import tracemalloc
+
+import pytest
+
+from jmatrix import compact_rules, compiled, interceptor, rule, umatrix_parser
+from tests.test_interceptor import OVERALL_TESTS, psl, stock_rules  # noqa: F401
+
+
+def _large_rule_lines(n):
+	return ["site{0}.com cdn{1}.site{0}.com {2} {3}".format(
+		i % 1000, i // 2, ("script", "xhr", "*", "frame")[i % 4], ("allow", "block")[i % 3 == 0])
+			for i in range(n)]
+
+
+def test_compact_same_rules(stock_rules):
+	expected = rule.Rules()
+	umatrix_parser.parse_rules(stock_rules, expected)
+	rule_obj = compact_rules.CompactRules()
+	umatrix_parser.parse_rules(stock_rules, rule_obj)
+	assert rule_obj.matrix_rules == expected.matrix_rules
+	assert rule_obj.matrix_flags == expected.matrix_flags
+	assert (sorted(umatrix_parser.map_to_rules(rule_obj).splitlines()) ==
+			sorted(umatrix_parser.map_to_rules(expected).splitlines()))
+
+@pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
+def test_compact_overall(r_text, result, psl):
+	rule_obj = compact_rules.CompactRules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	compiled_obj = compiled.compile_rules(rule_obj)
+	for blocked_rule in result.get('block', []):
+		assert interceptor.should_block(*blocked_rule, psl, rule_obj)
+		assert compiled_obj.should_block(*blocked_rule, psl)
+	for passed_rule in result.get('allow', []):
+		assert not interceptor.should_block(*passed_rule, psl, rule_obj)
+		assert not compiled_obj.should_block(*passed_rule, psl)
+
+def test_compact_no_autovivification():
+	rule_obj = compact_rules.CompactRules()
+	assert rule_obj.matrix_rules["a.com"]["b.com"][rule.Type.CSS] == rule.Action.INHERIT
+	assert rule_obj.matrix_rules.get("a.com") is None
+	assert rule_obj.matrix_rules["a.com"].get("b.com") is None
+	assert "a.com" not in rule_obj.matrix_rules
+	assert rule_obj.cells == {}
+
+def test_compact_write_through():
+	rule_obj = compact_rules.CompactRules()
+	generation = rule_obj.generation
+	rule_obj.matrix_rules["a.com"]["b.com"][rule.Type.CSS] = rule.Action.ALLOW
+	rule_obj.matrix_rules["a.com"]["b.com"][rule.Type.XHR] = rule.Action.BLOCK
+	assert rule_obj.generation == generation + 2
+	assert rule_obj.matrix_rules == {"a.com": {"b.com": {
+		rule.Type.CSS: rule.Action.ALLOW, rule.Type.XHR: rule.Action.BLOCK}}}
+	del rule_obj.matrix_rules["a.com"]["b.com"][rule.Type.CSS]
+	rule_obj.remove_rule("a.com", "b.com", rule.Type.XHR)
+	assert rule_obj.cells == {}
+
+def test_compact_update_from(stock_rules):
+	rule_obj = compact_rules.CompactRules()
+	umatrix_parser.parse_rules(stock_rules, rule_obj)
+	new_obj = rule.Rules()
+	umatrix_parser.parse_rules(stock_rules[:-5] + ["a.com b.com css allow"], new_obj)
+	rule_obj.update_from(new_obj)
+	assert rule_obj.matrix_rules == new_obj.matrix_rules
+
+def test_compact_copy(stock_rules):
+	rule_obj = compact_rules.CompactRules()
+	umatrix_parser.parse_rules(stock_rules, rule_obj)
+	expected = dict(rule_obj.cells)
+	new_obj = rule_obj.copy()
+	new_obj.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.ALLOW)
+	new_obj.remove_rule("*", "*", rule.Type.ALL)
+	assert rule_obj.cells == expected
+	assert new_obj.matrix_rules["a.com"]["b.com"][rule.Type.CSS] == rule.Action.ALLOW
+	assert rule_obj.matrix_rules["a.com"]["b.com"][rule.Type.CSS] == rule.Action.INHERIT
+	assert rule_obj.matrix_rules["*"]["*"][rule.Type.ALL] == rule.Action.BLOCK
+	assert rule_obj.matrix_rules["*"]["*"] != new_obj.matrix_rules["*"]["*"]
+	assert rule.Type.ALL not in new_obj.matrix_rules["*"]["*"]
+
+
+def _measure(factory, lines):
+	gc.collect()
+	tracemalloc.start()
+	rule_obj = factory()
+	umatrix_parser.parse_rules(lines, rule_obj)
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return size
+
+def test_compact_memory():
+	"""CompactRules uses less than half the memory of Rules for 100k rules."""
+	lines = _large_rule_lines(100000)
+	# Make sure the hostnames are not shared with lines
+	lines = [line.encode('utf-8').decode('utf-8') for line in lines]
+	dict_size = _measure(rule.Rules, lines)
+	compact_size = _measure(compact_rules.CompactRules, lines)
+	assert compact_size < dict_size / 2
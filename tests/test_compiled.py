@@ -0,0 +1,131 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+import functools
+import random
+
+from jmatrix import compiled, interceptor, rule, umatrix_parser
+from tests.test_interceptor import OVERALL_TESTS, psl, stock_rules  # noqa: F401
+
+
+PACK_TESTS = [
+	{},
+	{rule.Type.ALL: rule.Action.BLOCK},
+	{rule.Type.CSS: rule.Action.ALLOW, rule.Type.OTHER: rule.Action.INHERIT},
+	{t: rule.Action.BLOCK for t in rule.Type},
+]
+
+@pytest.mark.parametrize('types', PACK_TESTS)
+def test_pack_roundtrip(types):
+	assert compiled.unpack_cell(compiled.pack_cell(types)) == types
+
+
+@pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
+def test_compiled_overall(r_text, result, psl):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	compiled_obj = compiled.compile_rules(rule_obj)
+	for blocked_rule in result.get('block', []):
+		assert compiled_obj.should_block(*blocked_rule, psl)
+	for passed_rule in result.get('allow', []):
+		assert not compiled_obj.should_block(*passed_rule, psl)
+
+
+# Randomized comparison against the reference implementation
+
+RANDOM_LABELS = ("a", "cdn", "www", "static", "ads")
+RANDOM_DOMAINS = ("gitlab.com", "github.com", "githubassets.com", "qutebrowser.org",
+				  "example.co.uk", "tracker.net", "192.168.1.1")
+
+
+def _random_host(rng: random.Random) -> str:
+	host = rng.choice(RANDOM_DOMAINS)
+	if host[0].isdigit():
+		return host
+	for _ in range(rng.randrange(3)):
+		host = rng.choice(RANDOM_LABELS) + "." + host
+	return host
+
+
+def _random_rules(rng: random.Random) -> rule.Rules:
+	rule_obj = rule.Rules()
+	lines = []
+	for _ in range(rng.randrange(1, 25)):
+		source = rng.choice(("*", "*", "com", _random_host(rng)))
+		dest = rng.choice(("*", "1st-party", "com", "org", _random_host(rng)))
+		lines.append("{} {} {} {}".format(
+			source, dest, str(rng.choice(tuple(rule.Type))),
+			str(rng.choice(tuple(rule.Action)))))
+	for _ in range(rng.randrange(3)):
+		lines.append("{}: {} {}".format(
+			str(rng.choice(tuple(rule.Flag))),
+			rng.choice(("http-scheme", "https-scheme", "com", _random_host(rng))),
+			rng.choice(("true", "false"))))
+	umatrix_parser.rules_to_map(lines, rule_obj)
+	return rule_obj
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_compiled_random(seed):
+	rng = random.Random(seed)
+	fpdomain_fn = interceptor._get_first_party_domain
+	for _ in range(10):
+		rule_obj = _random_rules(rng)
+		compiled_obj = compiled.compile_rules(rule_obj)
+		for _ in range(200):
+			args = (_random_host(rng), rng.choice(("http", "https")),
+					_random_host(rng), rng.choice(("http", "https")),
+					rng.choice(tuple(rule.Type)), fpdomain_fn)
+			assert compiled_obj.should_block(*args) == interceptor.should_block(*args, rule_obj), args
+
+
+def test_benchmark_compiled_complex_null_match(stock_rules, psl, benchmark):
+	"""Benchmarks the null match with lots of extra rules, compiled."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	compiled_obj = compiled.compile_rules(rule_obj)
+	benchmark(functools.partial(
+		compiled_obj.should_block,
+		"a.b.c.d.e.f.g", "http", "cdn.a.b.c.d.e.f.g", "http",
+		rule.Type.FRAME, psl))
+
+def test_benchmark_compiled_complex_block(stock_rules, psl, benchmark):
+	"""Benchmarks a particularly slow match, compiled."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	compiled_obj = compiled.compile_rules(rule_obj)
+	benchmark(functools.partial(
+		compiled_obj.should_block,
+		"www.redditstatic.com", "http", "www.reddit.com", "http",
+		rule.Type.OTHER, psl))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_decide_random(seed):
+	"""interceptor.decide must give the same verdicts as should_block, from a real rule."""
+	rng = random.Random(seed)
+	fpdomain_fn = interceptor._get_first_party_domain
+	for _ in range(10):
+		rule_obj = _random_rules(rng)
+		for _ in range(200):
+			args = (_random_host(rng), rng.choice(("http", "https")),
+					_random_host(rng), rng.choice(("http", "https")),
+					rng.choice(tuple(rule.Type)), fpdomain_fn, rule_obj)
+			decision = interceptor.decide(*args)
+			assert decision.blocked == interceptor.should_block(*args), args
+			if decision.dest is not None:
+				# The deciding rule is in the matrix, with the right action
+				action = rule_obj.matrix_rules[decision.source][decision.dest][decision.type]
+				assert action == (rule.Action.BLOCK if decision.blocked else rule.Action.ALLOW), args
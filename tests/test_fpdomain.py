@@ -0,0 +1,208 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pathlib
+import shutil
+import tempfile
+
+import pytest
+
+from jmatrix.vendor.fpdomain import fpdomain
+
+
+PSL_SAMPLE = pathlib.Path("tests/data/public_suffix_list.dat")
+
+FP_DOMAIN_TESTS = {
+	"www.google.com": "google.com",
+	"google.com": "google.com",
+	"com": "com",
+	"a.b.co.uk": "b.co.uk",
+	"co.uk": "co.uk",
+	"www.bbc.co.uk": "bbc.co.uk",
+	"foo.bar.ck": "bar.ck",
+	"www.ck": "www.ck",
+	"a.www.ck": "www.ck",
+	"x.city.kawasaki.jp": "city.kawasaki.jp",
+	"a.b.kawasaki.jp": "b.kawasaki.jp",
+	"user.github.io": "user.github.io",
+	"a.user.github.io": "user.github.io",
+	"www.example.公司.cn": "example.公司.cn",
+	"192.168.1.1": "192.168.1.1",
+	"[::1]": "[::1]",
+	"localhost": "localhost",
+	"a.b.unknown": "b.unknown",
+	"a..com": "com",
+	"a.com.": "com.",
+	".com": "com",
+	"": "",
+}
+
+# A realistic set of hosts seen while loading a few popular pages
+REALISTIC_HOSTS = (
+	"www.reddit.com", "www.redditstatic.com", "styles.redditmedia.com", "preview.redd.it",
+	"gateway.reddit.com", "www.google-analytics.com", "www.googletagmanager.com",
+	"securepubads.g.doubleclick.net", "pagead2.googlesyndication.com", "fonts.googleapis.com",
+	"fonts.gstatic.com", "ajax.googleapis.com", "cdn.jsdelivr.net", "cdnjs.cloudflare.com",
+	"d1a2b3c4d5e6f7.cloudfront.net", "s3.amazonaws.com", "ec2-1-2-3-4.compute-1.amazonaws.com",
+	"github.com", "avatars.githubusercontent.com", "user.github.io", "github.githubassets.com",
+	"www.bbc.co.uk", "static.bbci.co.uk", "ichef.bbci.co.uk", "www.gov.uk",
+	"assets.publishing.service.gov.uk", "www.theguardian.com", "i.guim.co.uk",
+	"connect.facebook.net", "www.facebook.com", "platform.twitter.com", "pbs.twimg.com",
+	"abs.twimg.com", "www.youtube.com", "i.ytimg.com", "static.doubleclick.net",
+	"en.wikipedia.org", "upload.wikimedia.org", "meta.wikimedia.org", "www.amazon.de",
+	"m.media-amazon.com", "images-eu.ssl-images-amazon.com", "www.lemonde.fr",
+	"www.abc.net.au", "www.smh.com.au", "www.city.kawasaki.jp", "news.yahoo.co.jp",
+	"s.yimg.jp", "www.baidu.com", "www.example.公司.cn", "myapp.herokuapp.com",
+	"myapp.appspot.com", "someblog.blogspot.com", "10.0.0.1", "192.168.1.1", "localhost",
+)
+
+
+def legacy_fp_domain(psl: frozenset, host: str) -> str:
+	"""The original frozenset based fp_domain, used as a reference."""
+	if fpdomain.PSL.IP_ADDR_NAIVE.search(host):
+		return host
+
+	tld, first_part = host, ''
+	while tld:
+		wildcard_tld, exception_tld = '*.' + tld, '!' + tld
+		if exception_tld in psl:
+			return tld
+		if tld in psl:
+			if first_part:
+				return first_part + '.' + tld
+			return tld
+		if wildcard_tld in psl:
+			if first_part:
+				return first_part + '.' + tld
+			return tld
+		first_part, _, tld = tld.partition('.')
+	return ".".join(host.rsplit('.', 2)[-2:])
+
+
+@pytest.fixture(scope="session")
+def sample_psl():
+	return fpdomain.PSL(PSL_SAMPLE, snapshot=False)
+
+@pytest.fixture(scope="session")
+def default_psl():
+	return fpdomain.PSL()
+
+@pytest.fixture(scope="session")
+def default_psl_rules(default_psl):
+	return frozenset(fpdomain.PSL._read_psl(pathlib.Path(tempfile.gettempdir()) / "python-psl"))
+
+
+@pytest.mark.parametrize(('host', 'result'), FP_DOMAIN_TESTS.items())
+def test_fp_domain(host, result, sample_psl):
+	assert sample_psl.fp_domain(host) == result
+
+@pytest.mark.parametrize('host', tuple(FP_DOMAIN_TESTS) + REALISTIC_HOSTS)
+def test_fp_domain_legacy(host, sample_psl):
+	psl = frozenset(fpdomain.PSL._read_psl(PSL_SAMPLE))
+	assert sample_psl.fp_domain(host) == legacy_fp_domain(psl, host)
+
+def test_fp_domain_legacy_full(default_psl, default_psl_rules):
+	"""Compare against the reference with every rule of the full PSL as a host."""
+	for psl_rule in default_psl_rules:
+		for host in (psl_rule, "a." + psl_rule, "a.b." + psl_rule, psl_rule.lstrip("!*.")):
+			assert default_psl.fp_domain(host) == legacy_fp_domain(default_psl_rules, host)
+
+
+def test_benchmark_fp_domain_legacy(default_psl_rules, benchmark):
+	"""Benchmarks the frozenset based lookup over the realistic hosts, uncached."""
+	def run():
+		for host in REALISTIC_HOSTS:
+			legacy_fp_domain(default_psl_rules, host)
+	benchmark(run)
+
+def test_benchmark_fp_domain_trie(default_psl, benchmark):
+	"""Benchmarks the trie based lookup over the realistic hosts, uncached."""
+	fp_domain = default_psl.fp_domain
+	def run():
+		for host in REALISTIC_HOSTS:
+			fp_domain(host)
+	benchmark(run)
+
+
+# Binary snapshots
+
+@pytest.fixture
+def psl_copy(tmp_path):
+	path = tmp_path / "psl"
+	shutil.copy(PSL_SAMPLE, path)
+	return path
+
+def test_snapshot_roundtrip(psl_copy):
+	parsed = fpdomain.PSL(psl_copy)
+	assert fpdomain.PSL.snapshot_path(psl_copy).exists()
+	loaded = fpdomain.PSL(psl_copy)
+	# Nothing is read out of the snapshot until the first lookup
+	assert isinstance(loaded.trie[1], fpdomain._SnapshotTable)
+	for host, result in FP_DOMAIN_TESTS.items():
+		assert loaded.fp_domain(host) == result
+		assert parsed.fp_domain(host) == result
+	assert isinstance(loaded.trie[1], dict)
+
+def test_snapshot_stale(psl_copy):
+	fpdomain.PSL(psl_copy)
+	with open(psl_copy, "a", encoding="utf-8") as f:
+		f.write("example.com\n")
+	psl = fpdomain.PSL(psl_copy)
+	assert isinstance(psl.trie[1], dict)
+	assert psl.fp_domain("a.b.example.com") == "b.example.com"
+	# The snapshot was rewritten for the new list
+	psl = fpdomain.PSL(psl_copy)
+	assert isinstance(psl.trie[1], fpdomain._SnapshotTable)
+	assert psl.fp_domain("a.b.example.com") == "b.example.com"
+
+@pytest.mark.parametrize('contents', [b'', b'garbage', b'FPDPSL\0\0' + b'\0' * 64])
+def test_snapshot_invalid(psl_copy, contents):
+	fpdomain.PSL.snapshot_path(psl_copy).write_bytes(contents)
+	psl = fpdomain.PSL(psl_copy)
+	assert isinstance(psl.trie[1], dict)
+	assert psl.fp_domain("www.bbc.co.uk") == "bbc.co.uk"
+
+def test_snapshot_disabled(psl_copy):
+	fpdomain.PSL(psl_copy, snapshot=False)
+	assert not fpdomain.PSL.snapshot_path(psl_copy).exists()
+
+
+def test_benchmark_psl_load_text(default_psl, benchmark):
+	"""Benchmarks loading the full PSL from text."""
+	path = pathlib.Path(tempfile.gettempdir()) / "python-psl"
+	benchmark(fpdomain.PSL, path, snapshot=False)
+
+def test_benchmark_psl_load_snapshot(default_psl, benchmark):
+	"""Benchmarks loading the full PSL from a snapshot, and doing a single lookup."""
+	path = pathlib.Path(tempfile.gettempdir()) / "python-psl"
+	benchmark(lambda: fpdomain.PSL(path).fp_domain("www.bbc.co.uk"))
+
+
+# Downloading
+
+def test_update_psl_url(tmp_path):
+	path = tmp_path / "psl"
+	psl = fpdomain.PSL(path, url=PSL_SAMPLE.resolve().as_uri())
+	assert path.read_bytes() == PSL_SAMPLE.read_bytes()
+	assert psl.fp_domain("www.bbc.co.uk") == "bbc.co.uk"
+	assert sorted(p.name for p in tmp_path.iterdir()) == ["psl", "psl.snapshot"]
+
+def test_update_url(psl_copy, tmp_path):
+	psl = fpdomain.PSL(psl_copy)
+	replacement = tmp_path / "replacement"
+	replacement.write_text("example.com\n", encoding="utf-8")
+	psl.update(psl_copy, replacement.as_uri())
+	assert psl.fp_domain("a.b.example.com") == "b.example.com"
+	assert psl.fp_domain("www.bbc.co.uk") == "co.uk"
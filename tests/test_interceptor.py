@@ -13,10 +13,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gc
 import pytest
 import functools
+import weakref
 
-from jmatrix import interceptor, rule, umatrix_parser
+from jmatrix import cache, interceptor, rule, umatrix_parser
 from jmatrix.vendor.fpdomain import fpdomain
 
 
@@ -37,6 +39,41 @@ def test_matrix_rule(r, result):
 def test_matrix_rule_benchmark(r, result, benchmark):
 	benchmark(functools.partial(interceptor._hostname_widen_list, r))
 
+def test_host_info():
+	fpdomain_fn = interceptor._get_first_party_domain
+	info = interceptor.host_info("a.b.com", fpdomain_fn)
+	assert info == interceptor.HostInfo("a.b.com", WIDEN_TESTS["a.b.com"], "b.com", False)
+	assert interceptor.host_info("a.b.com", fpdomain_fn) is info
+	assert interceptor.host_info("10.0.0.1", fpdomain_fn).fp_domain == "10.0.0.1"
+	assert interceptor.host_info("[::1]", fpdomain_fn).is_ip
+
+def test_suffix_index(psl):
+	assert interceptor._get_first_party_domain("www.bbc.co.uk") == "co.uk"
+	interceptor.set_suffix_index(psl)
+	try:
+		assert interceptor._get_first_party_domain("www.bbc.co.uk") == "bbc.co.uk"
+		assert interceptor._get_first_party_domain("10.0.0.1") == "10.0.0.1"
+		assert interceptor.host_info(
+			"www.bbc.co.uk", interceptor._get_first_party_domain).fp_domain == "bbc.co.uk"
+	finally:
+		interceptor.set_suffix_index(None)
+	assert interceptor._get_first_party_domain("www.bbc.co.uk") == "co.uk"
+
+def test_suffix_index_releases_psl():
+	"""Older PSLs are not kept alive by the cache of host_info."""
+	class FakePSL():
+		def fp_domain(self, host):
+			return host
+	psl = FakePSL()
+	ref = weakref.ref(psl)
+	interceptor.set_suffix_index(psl.fp_domain)
+	interceptor.host_info("a.com", psl.fp_domain)
+	del psl
+	interceptor.set_suffix_index(None)
+	gc.collect()
+	assert ref() is None
+
+
 
 # 'e2e' Tests for overall interceptor
 
@@ -172,7 +209,7 @@ PSL = None
 @pytest.fixture(scope="session")
 def psl():
 	global PSL
-	PSL = fpdomain.PSL()
+	PSL = fpdomain.PSL(cache=cache.LRUCache())
 	return PSL.fp_domain
 
 @pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
@@ -220,3 +257,228 @@ def test_benchmark_complex_block(stock_rules, psl, benchmark):
 		interceptor.should_block,
 		"www.redditstatic.com", "http", "www.reddit.com", "http",
 		rule.Type.OTHER, psl, rule_obj))
+
+
+# Prepared contexts
+
+def test_prepare_context():
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(["* * * block", "a.com * css allow"], rule_obj)
+	context = interceptor.prepare_context("www.a.com", "https", rule_obj)
+	assert context == interceptor._prepare_context("www.a.com", "https", rule_obj)
+	assert interceptor.prepare_context("www.a.com", "https", rule_obj) is context
+	assert interceptor.prepare_context("www.a.com", "http", rule_obj) is not context
+
+	rule_obj.set_flag("a.com", rule.Flag.MATRIX_OFF, True)
+	context = interceptor.prepare_context("www.a.com", "https", rule_obj)
+	assert context.matrix_off
+	assert not interceptor.should_block(
+		"www.a.com", "https", "b.com", "https", rule.Type.XHR,
+		interceptor._get_first_party_domain, rule_obj)
+
+	# Copies get their own contexts
+	new_obj = rule_obj.copy()
+	new_obj.set_rule("b.com", "*", rule.Type.CSS, rule.Action.ALLOW)
+	assert not interceptor.should_block(
+		"www.b.com", "https", "c.com", "https", rule.Type.CSS,
+		interceptor._get_first_party_domain, new_obj)
+	assert interceptor.should_block(
+		"www.b.com", "https", "c.com", "https", rule.Type.CSS,
+		interceptor._get_first_party_domain, rule_obj)
+
+def test_prepare_context_eviction(monkeypatch):
+	monkeypatch.setattr(interceptor, "MAX_CONTEXTS", 4)
+	rule_obj = rule.Rules()
+	for i in range(10):
+		interceptor.prepare_context("{}.com".format(i), "https", rule_obj)
+	assert len(rule_obj.contexts) <= 4
+
+def test_benchmark_page_load(stock_rules, psl, benchmark):
+	"""Benchmarks the subresources of a single page, which share a prepared context."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	requests = [
+		("www.reddit.com", "https", host, "https", request_type)
+		for host in ("www.reddit.com", "www.redditstatic.com", "styles.redditmedia.com",
+					 "cdn.example.com", "tracker.example.net")
+		for request_type in (rule.Type.SCRIPT, rule.Type.IMAGE, rule.Type.XHR, rule.Type.CSS)]
+	def run():
+		for request in requests:
+			interceptor.should_block(*request, psl, rule_obj)
+	benchmark(run)
+
+
+# Verdict cache
+
+@pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
+def test_verdict_cache_overall(r_text, result, psl):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	cache = interceptor.VerdictCache()
+	# Run twice, so the second pass is served from the cache
+	for _ in range(2):
+		for blocked_rule in result.get('block', []):
+			assert cache.should_block(*blocked_rule, psl, rule_obj)
+		for passed_rule in result.get('allow', []):
+			assert not cache.should_block(*passed_rule, psl, rule_obj)
+	info = cache.cache_info()
+	assert info.hits >= info.misses
+
+def test_verdict_cache_generation():
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(["* * * block"], rule_obj)
+	fpdomain_fn = interceptor._get_first_party_domain
+	args = ("gitlab.com", "http", "gitlab.com", "http", rule.Type.CSS, fpdomain_fn, rule_obj)
+	cache = interceptor.VerdictCache()
+	assert cache.should_block(*args)
+	assert cache.should_block(*args)
+	assert cache.cache_info()[:2] == (1, 1)
+
+	rule_obj.set_rule("gitlab.com", "gitlab.com", rule.Type.CSS, rule.Action.ALLOW)
+	assert not cache.should_block(*args)
+	assert cache.cache_info()[:2] == (1, 2)
+
+	# A fresh rules object (eg: a config reload) is never served stale verdicts
+	new_rules = rule.Rules()
+	umatrix_parser.rules_to_map(["* * * block"], new_rules)
+	assert cache.should_block(*args[:-1], new_rules)
+
+def test_verdict_cache_eviction():
+	rule_obj = rule.Rules()
+	cache = interceptor.VerdictCache(maxsize=4)
+	fpdomain_fn = interceptor._get_first_party_domain
+	for i in range(10):
+		cache.should_block("a.com", "http", "{}.com".format(i), "http",
+						   rule.Type.CSS, fpdomain_fn, rule_obj)
+	assert cache.cache_info() == interceptor.CacheInfo(0, 10, 4, 4)
+	# The most recent entries are kept
+	cache.should_block("a.com", "http", "9.com", "http",
+					   rule.Type.CSS, fpdomain_fn, rule_obj)
+	assert cache.cache_info().hits == 1
+
+def test_benchmark_verdict_cache_hit(stock_rules, psl, benchmark):
+	"""Benchmarks a verdict cache hit."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	cache = interceptor.VerdictCache()
+	benchmark(functools.partial(
+		cache.should_block,
+		"www.redditstatic.com", "http", "www.reddit.com", "http",
+		rule.Type.OTHER, psl, rule_obj))
+
+
+# Batch evaluation
+
+@pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
+def test_should_block_many_overall(r_text, result, psl):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	requests = result.get('block', []) + result.get('allow', [])
+	expected = [1] * len(result.get('block', [])) + [0] * len(result.get('allow', []))
+	assert list(interceptor.should_block_many(requests, psl, rule_obj)) == expected
+	assert list(interceptor.should_block_columns(*zip(*requests), psl, rule_obj)) == expected
+
+def test_should_block_columns_lengths(psl):
+	rule_obj = rule.Rules()
+	columns = (["a.com"], ["http"], ["b.com"], ["http"], [rule.Type.CSS])
+	assert list(interceptor.should_block_columns(*map(iter, columns), psl, rule_obj)) == [1]
+	with pytest.raises(ValueError):
+		interceptor.should_block_columns(["a.com"], ["http"], ["b.com", "c.com"], ["http"], [rule.Type.CSS],
+										 psl, rule_obj)
+	with pytest.raises(ValueError):
+		interceptor.should_block_columns(iter(["a.com"]), ["http"], [], ["http"], [rule.Type.CSS],
+										 psl, rule_obj)
+
+def test_benchmark_should_block_many(stock_rules, psl, benchmark):
+	"""Benchmarks a batch of requests sharing a few contexts."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	requests = [
+		(context, "https", "{}.cdn{}.example.com".format(context, i % 7), "https", request_type)
+		for context in ("www.reddit.com", "github.com", "a.b.c.d.e.f.g")
+		for i in range(30)
+		for request_type in (rule.Type.SCRIPT, rule.Type.IMAGE, rule.Type.XHR)]
+	benchmark(interceptor.should_block_many, requests, psl, rule_obj)
+
+
+# Decisions
+
+Step = interceptor.Step
+Decision = interceptor.Decision
+
+DECIDE_TESTS = [
+	(("matrix-off: gitlab.com true",), ("gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(False, Step.MATRIX_OFF, "gitlab.com", None, None)),
+	(("https-strict: https-scheme true",), ("www.gitlab.com", "https", "a.com", "http", rule.Type.CSS),
+	 Decision(True, Step.HTTPS_STRICT, "https-scheme", None, None)),
+	(("* * * allow", "gitlab.com a.com css block"), ("www.gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(True, Step.EXACT, "gitlab.com", "a.com", rule.Type.CSS)),
+	(("* * * block", "* a.com * allow"), ("gitlab.com", "http", "cdn.a.com", "http", rule.Type.CSS),
+	 Decision(False, Step.ANCESTOR, "*", "a.com", rule.Type.ALL)),
+	(("* * * block", "* 1st-party css allow"), ("gitlab.com", "http", "www.gitlab.com", "http", rule.Type.CSS),
+	 Decision(False, Step.FIRST_PARTY, "*", "1st-party", rule.Type.CSS)),
+	(("* * css allow",), ("gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(False, Step.ANY_HOST, "*", "*", rule.Type.CSS)),
+	# A type * allow on the host beats a type allow on *, but not a type block
+	(("* * css block", "* a.com * allow"), ("gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(True, Step.ANY_HOST, "*", "*", rule.Type.CSS)),
+	(("* * css allow", "com a.com * allow"), ("gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(False, Step.EXACT, "com", "a.com", rule.Type.ALL)),
+	# Inherit stops the search through the sources, but not through the dests
+	(("* a.com css block", "gitlab.com a.com css inherit", "* com css allow"),
+	 ("gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(False, Step.ANCESTOR, "*", "com", rule.Type.CSS)),
+	((), ("gitlab.com", "http", "a.com", "http", rule.Type.CSS),
+	 Decision(True, Step.DEFAULT, None, None, None)),
+]
+
+@pytest.mark.parametrize(('r_text', 'args', 'decision'), DECIDE_TESTS)
+def test_decide(r_text, args, decision):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	fpdomain_fn = interceptor._get_first_party_domain
+	assert interceptor.decide(*args, fpdomain_fn, rule_obj) == decision
+
+FORMAT_TESTS = [
+	(Decision(False, Step.MATRIX_OFF, "gitlab.com", None, None), "allowed by matrix-off: gitlab.com true"),
+	(Decision(True, Step.ANCESTOR, "*", "a.com", rule.Type.ALL), "blocked by * a.com * block (ancestor)"),
+	(Decision(True, Step.DEFAULT, None, None, None), "blocked as no rule matched"),
+]
+
+@pytest.mark.parametrize(('decision', 'text'), FORMAT_TESTS)
+def test_format_decision(decision, text):
+	assert interceptor.format_decision(decision) == text
+
+@pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
+def test_decide_overall(r_text, result, psl):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	for blocked_rule in result.get('block', []):
+		assert interceptor.decide(*blocked_rule, psl, rule_obj).blocked
+	for passed_rule in result.get('allow', []):
+		assert not interceptor.decide(*passed_rule, psl, rule_obj).blocked
+
+def test_benchmark_decide_complex_block(stock_rules, psl, benchmark):
+	"""Benchmarks test_benchmark_complex_block, explaining the verdict."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	benchmark(functools.partial(
+		interceptor.decide,
+		"www.redditstatic.com", "http", "www.reddit.com", "http",
+		rule.Type.OTHER, psl, rule_obj))
+
+def test_verdict_cache_stats():
+	from jmatrix import stats
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(["* * * block", "* * css allow"], rule_obj)
+	cache = interceptor.VerdictCache()
+	cache.stats = stats.Stats(cache)
+	fpdomain_fn = interceptor._get_first_party_domain
+	for _ in range(2):
+		cache.should_block("gitlab.com", "http", "a.com", "http", rule.Type.CSS, fpdomain_fn, rule_obj)
+		cache.should_block("gitlab.com", "http", "a.com", "http", rule.Type.XHR, fpdomain_fn, rule_obj)
+	snapshot = cache.stats.snapshot()
+	# Only misses are decided
+	assert snapshot.steps[interceptor.Step.ANY_HOST] == 2
+	assert sum(snapshot.steps.values()) == 2
+	assert snapshot.cache == cache.cache_info()
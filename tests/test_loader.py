@@ -0,0 +1,99 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import threading
+
+from jmatrix import loader, rule
+from tests.test_fpdomain import PSL_SAMPLE
+
+
+def test_load(tmp_path):
+	rules_path = tmp_path / "rules"
+	rules_path.write_text("* * * block\nfoo\n")
+	psl_path = tmp_path / "psl"
+	loaded = loader.load(rules_path, tmp_path / "rules.cache", psl_path, PSL_SAMPLE.resolve().as_uri())
+	assert loaded.rules.matrix_rules["*"]["*"][rule.Type.ALL] == rule.Action.BLOCK
+	assert len(loaded.errors) == 1
+	# The PSL was fetched from the stand-in url
+	assert psl_path.exists()
+	assert loaded.psl.fp_domain("www.bbc.co.uk") == "bbc.co.uk"
+
+
+def test_load_psl_error(tmp_path):
+	"""The rules are loaded even if the PSL can't be."""
+	rules_path = tmp_path / "rules"
+	rules_path.write_text("* * * block\n")
+	loaded = loader.load(rules_path, None, tmp_path / "psl", (tmp_path / "missing").as_uri())
+	assert loaded.rules.matrix_rules["*"]["*"][rule.Type.ALL] == rule.Action.BLOCK
+	assert loaded.psl is None
+	assert isinstance(loaded.psl_error, Exception)
+
+
+def test_background_loader():
+	release = threading.Event()
+	published = []
+	def load():
+		release.wait(5)
+		return 1
+	bg = loader.BackgroundLoader(lambda e: None)
+	assert not bg.loading
+	bg.start(load, published.append)
+	assert bg.loading
+	assert not bg.wait(0.01)
+	assert published == []
+	release.set()
+	assert bg.wait(5)
+	assert not bg.loading
+	assert published == [1]
+
+def test_background_loader_error():
+	errors = []
+	def load():
+		raise OSError("missing")
+	bg = loader.BackgroundLoader(errors.append)
+	bg.start(load, lambda x: None)
+	assert bg.wait(5)
+	assert [str(e) for e in errors] == ["missing"]
+
+def test_background_loader_order():
+	"""Loads are published in the order they were started, even if a later one is quicker."""
+	entered, release = threading.Event(), threading.Event()
+	published = []
+	def slow():
+		entered.set()
+		release.wait(5)
+		return "full"
+	bg = loader.BackgroundLoader(lambda e: None)
+	bg.start(slow, published.append)
+	assert entered.wait(5)
+	bg.start(lambda: "changes", lambda result: published.append(result + " applied"))
+	release.set()
+	assert bg.wait(5)
+	assert published == ["full", "changes applied"]
+
+def test_background_loader_dispatch():
+	"""Results are handed to dispatch, not published on the worker."""
+	dispatched = queue.Queue()
+	published = []
+	bg = loader.BackgroundLoader(published.append, dispatched.put)
+	bg.start(lambda: 1, published.append)
+	bg.start(lambda: 1 / 0, published.append)
+	for _ in range(2):
+		dispatched.get(timeout=5)()
+	assert bg.wait(5)
+	assert published[0] == 1
+	assert isinstance(published[1], ZeroDivisionError)
+	assert [thread.name for thread in threading.enumerate()].count("jmatrix-loader") <= 1
@@ -13,6 +13,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
+
 import pytest
 
 from jmatrix import umatrix_parser, rule
@@ -71,3 +74,235 @@ def test_matrix_error():
 	with pytest.raises(umatrix_parser.JMatrixParserError):
 		umatrix_parser.rules_to_map(["foo.org foo.org * * * *"], rule_obj)
 	assert len(tuple(umatrix_parser.rules_to_map(["foo.org foo.org * * * *"], rule_obj, collate_errors=True))) > 0
+
+
+# The streaming parser
+
+PARSE_EQUIVALENCE_TESTS = [
+	"* * * block",
+	"rule: * * * block",
+	"RULE: a.com b.com XHR Allow",
+	"a.com b.com plugin block # comment",
+	"a.com b.com ſcript block",
+	"# only a comment",
+	"   ",
+	":",
+	": a b",
+	"noscript-spoof: * true",
+	"Matrix-Off: a.com TRUE",
+	"https-strict:\ta.com\tfalse",
+	"matrix-off:",
+	"matrix-off: a.com b.com true",
+	"a.com",
+	"a.com b.com * allow extra",
+	"a.com b.com * maybe",
+	"a.com b.com nope",
+	"rule: a.com",
+]
+
+def test_parse_rules_equivalence(stock_lines):
+	lines = stock_lines + PARSE_EQUIVALENCE_TESTS
+	expected = rule.Rules()
+	expected_errors = umatrix_parser.rules_to_map(lines, expected, collate_errors=True)
+	for source in (lines, "\n".join(lines).encode('utf-8'), iter(line.encode('utf-8') for line in lines)):
+		rule_obj = rule.Rules()
+		errors = umatrix_parser.parse_rules(source, rule_obj, collate_errors=True)
+		assert [str(e) for e in errors] == [str(e) for e in expected_errors]
+		assert rule_obj.matrix_rules == expected.matrix_rules
+		assert rule_obj.matrix_flags == expected.matrix_flags
+
+def test_parse_rules_file(tmp_path):
+	path = tmp_path / "rules"
+	path.write_text("\n".join(PARSE_EQUIVALENCE_TESTS), encoding="utf-8")
+	expected = rule.Rules()
+	umatrix_parser.rules_to_map(PARSE_EQUIVALENCE_TESTS, expected, collate_errors=True)
+	for mode in ("r", "rb"):
+		rule_obj = rule.Rules()
+		with open(path, mode) as f:
+			assert len(umatrix_parser.parse_rules(f, rule_obj, collate_errors=True)) == 7
+		assert rule_obj.matrix_rules == expected.matrix_rules
+
+def test_parse_rules_error():
+	rule_obj = rule.Rules()
+	with pytest.raises(umatrix_parser.JMatrixParserError):
+		umatrix_parser.parse_rules(["foo.org foo.org * * * *"], rule_obj)
+
+def test_parse_rules_error_lines():
+	lines = ["* * * block", "", "a.com b.com nope", "# comment", "matrix-off: a.com"]
+	for parse in (umatrix_parser.rules_to_map, umatrix_parser.parse_rules):
+		errors = list(parse(lines, rule.Rules(), collate_errors=True))
+		assert [e.line for e in errors] == [3, 5]
+		assert str(errors[0]).startswith("line 3: ")
+		with pytest.raises(umatrix_parser.JMatrixParserError) as e:
+			parse(lines, rule.Rules())
+		assert e.value.line == 3
+	errors = umatrix_parser.parse_rules(lines, rule.Rules(), collate_errors=True, first_line=11)
+	assert [e.line for e in errors] == [13, 15]
+
+
+# Parallel parsing
+
+@pytest.mark.parametrize('chunks', [1, 2, 3, 7, 100])
+def test_chunk_bounds(chunks):
+	data = b"a\nbb\n\nccc\ndddd"
+	bounds = umatrix_parser._chunk_bounds(data, chunks)
+	assert len(bounds) <= chunks
+	assert b"".join(data[start:end] for start, end in bounds) == data
+	assert all(data[end - 1:end] == b"\n" for _, end in bounds[:-1])
+
+def _conflicting_lines(stock_lines):
+	# Rules which are overridden later on, and errors all over the file
+	lines = []
+	for i, line in enumerate(stock_lines):
+		lines.append(line)
+		if i % 50 == 0:
+			lines.append("* * * {}".format(("allow", "block")[i % 100 == 0]))
+			lines.append("matrix-off: a.com {}".format(("true", "false")[i % 100 == 0]))
+			lines.append("a.com b.com nope")
+	return lines
+
+@pytest.mark.parametrize('jobs', [1, 2, 3])
+def test_parse_rules_parallel(stock_lines, jobs):
+	lines = _conflicting_lines(stock_lines)
+	data = "\n".join(lines).encode('utf-8')
+	expected = rule.Rules()
+	expected_errors = umatrix_parser.parse_rules(data, expected, collate_errors=True)
+	rule_obj = rule.Rules()
+	errors = umatrix_parser.parse_rules_parallel(data, rule_obj, jobs=jobs, collate_errors=True)
+	assert rule_obj.matrix_rules == expected.matrix_rules
+	assert rule_obj.matrix_flags == expected.matrix_flags
+	assert [str(e) for e in errors] == [str(e) for e in expected_errors]
+	assert errors[-1].line == expected_errors[-1].line
+
+def test_parse_rules_parallel_existing(stock_lines):
+	"""Rules which already have entries are added to with set_rule."""
+	lines = _conflicting_lines(stock_lines)
+	data = "\n".join(lines).encode('utf-8')
+	expected = rule.Rules()
+	expected.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.BLOCK)
+	umatrix_parser.parse_rules(data, expected, collate_errors=True)
+	rule_obj = rule.Rules()
+	rule_obj.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.BLOCK)
+	umatrix_parser.parse_rules_parallel(data, rule_obj, jobs=2, collate_errors=True)
+	assert rule_obj.matrix_rules == expected.matrix_rules
+	assert rule_obj.matrix_flags == expected.matrix_flags
+
+def test_parse_rules_parallel_error(stock_lines):
+	lines = stock_lines + ["a.com b.com nope"] + stock_lines[:10] + ["c.com d.com css allow"]
+	data = "\n".join(lines).encode('utf-8')
+	expected = rule.Rules()
+	with pytest.raises(umatrix_parser.JMatrixParserError) as expected_error:
+		umatrix_parser.parse_rules(data, expected)
+	rule_obj = rule.Rules()
+	with pytest.raises(umatrix_parser.JMatrixParserError) as error:
+		umatrix_parser.parse_rules_parallel(data, rule_obj, jobs=2, chunks_per_job=8)
+	assert error.value.line == expected_error.value.line == len(stock_lines) + 1
+	# Everything before the error was applied, and nothing after it
+	assert rule_obj.matrix_rules == expected.matrix_rules
+	assert "c.com" not in rule_obj.matrix_rules
+
+
+@pytest.fixture(scope="session")
+def stock_lines():
+	with open("tests/data/stock-rules", encoding="utf-8") as f:
+		return f.read().splitlines()
+
+@pytest.fixture(scope="session")
+def large_rules_text(stock_lines):
+	"""A multi-megabyte rule list."""
+	lines = list(stock_lines)
+	for i in range(50000):
+		lines.append("site{0}.com cdn{1}.site{0}.com {2} {3}  # imported".format(
+			i % 1000, i, ("script", "xhr", "*", "frame")[i % 4], ("allow", "block")[i % 3 == 0]))
+	return "\n".join(lines)
+
+def test_benchmark_rules_to_map_throughput(large_rules_text, benchmark):
+	"""Benchmarks the original parser on a large rule list."""
+	lines = large_rules_text.splitlines()
+	benchmark.extra_info['lines'] = len(lines)
+	benchmark(lambda: umatrix_parser.rules_to_map(lines, rule.Rules()))
+
+def test_benchmark_parse_rules_throughput(large_rules_text, benchmark):
+	"""Benchmarks the streaming parser on a large rule list."""
+	lines = large_rules_text.splitlines()
+	benchmark.extra_info['lines'] = len(lines)
+	benchmark(lambda: umatrix_parser.parse_rules(lines, rule.Rules()))
+
+def test_benchmark_parse_rules_bytes_throughput(large_rules_text, benchmark):
+	"""Benchmarks the streaming parser on a large, undecoded rule list."""
+	data = large_rules_text.encode('utf-8')
+	benchmark.extra_info['lines'] = data.count(b'\n') + 1
+	benchmark(lambda: umatrix_parser.parse_rules(data, rule.Rules()))
+
+@pytest.mark.parametrize('jobs', [1, 2, 4, 8])
+def test_benchmark_parse_rules_parallel_scaling(large_rules_text, jobs, benchmark):
+	"""Benchmarks parsing a large rule list with 1 to 8 worker processes."""
+	data = large_rules_text.encode('utf-8')
+	benchmark.extra_info['lines'] = data.count(b'\n') + 1
+	benchmark.extra_info['cpus'] = os.cpu_count()
+	benchmark.pedantic(lambda: umatrix_parser.parse_rules_parallel(data, rule.Rules(), jobs=jobs), rounds=5)
+
+
+# Writing
+
+def test_map_to_rules_sorted():
+	lines = ["b.com a.com xhr block", "a.com b.com css allow", "matrix-off: b.com true",
+			 "a.com b.com * block", "https-strict: a.com true", "matrix-off: a.com false"]
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(lines, rule_obj)
+	reversed_obj = rule.Rules()
+	umatrix_parser.parse_rules(reversed(lines), reversed_obj)
+	assert umatrix_parser.map_to_rules(rule_obj).splitlines() == [
+		"matrix-off: a.com false", "https-strict: a.com true", "matrix-off: b.com true",
+		"a.com b.com * block", "a.com b.com css allow", "b.com a.com xhr block"]
+	assert umatrix_parser.map_to_rules(rule_obj) == umatrix_parser.map_to_rules(reversed_obj)
+
+def test_write_rules(stock_lines):
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(stock_lines, rule_obj)
+	f = io.StringIO()
+	umatrix_parser.write_rules(rule_obj, f)
+	assert f.getvalue() == umatrix_parser.map_to_rules(rule_obj) + "\n"
+
+def test_save_rules(tmp_path, stock_lines):
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(stock_lines, rule_obj)
+	path = tmp_path / "rules"
+	umatrix_parser.save_rules(rule_obj, path, "# header\n")
+	text = path.read_text(encoding="utf-8")
+	assert text == "# header\n" + umatrix_parser.map_to_rules(rule_obj) + "\n"
+	assert [p.name for p in tmp_path.iterdir()] == ["rules"]
+
+def test_save_rules_symlink(tmp_path):
+	"""Symlinked rule files (eg: from a dotfile manager) stay links."""
+	dotfiles = tmp_path / "dotfiles"
+	dotfiles.mkdir()
+	target = dotfiles / "jmatrix-rules"
+	target.write_text("* * * allow\n")
+	link = tmp_path / "jmatrix-rules"
+	link.symlink_to(target)
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(["* * * block"], rule_obj)
+	umatrix_parser.save_rules(rule_obj, link)
+	assert link.is_symlink()
+	assert target.read_text() == "* * * block\n"
+	assert [p.name for p in dotfiles.iterdir()] == ["jmatrix-rules"]
+
+def test_save_rules_error(tmp_path, monkeypatch):
+	path = tmp_path / "rules"
+	path.write_text("* * * block\n")
+	def broken_rules(rules):
+		yield "* * * allow"
+		raise RuntimeError
+	monkeypatch.setattr(umatrix_parser, "iter_rules", broken_rules)
+	with pytest.raises(RuntimeError):
+		umatrix_parser.save_rules(rule.Rules(), path)
+	# The old file is left alone, without anything left behind
+	assert path.read_text() == "* * * block\n"
+	assert [p.name for p in tmp_path.iterdir()] == ["rules"]
+
+def test_benchmark_save_rules_throughput(large_rules_text, tmp_path, benchmark):
+	"""Benchmarks writing out a large rule list."""
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(large_rules_text.splitlines(), rule_obj)
+	benchmark(umatrix_parser.save_rules, rule_obj, tmp_path / "rules")
@@ -0,0 +1,152 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""End to end benchmarks of the hot paths, on synthetic page loads.
+
+Everything here is generated from fixed seeds, so runs are comparable. Use
+`make bench-save` to record a baseline, and `make bench-compare` to compare
+against it (failing on regressions)."""
+
+import random
+import typing
+
+import pytest
+
+from jmatrix import cache, compiled, interceptor, rule, umatrix_parser
+from jmatrix.vendor.fpdomain import fpdomain
+
+
+TRACE_SEED = 1337
+TRACE_PAGES = 20
+TRACE_SUBRESOURCES = 300
+
+PAGE_HOSTS = ("www.reddit.com", "github.com", "www.bbc.co.uk", "en.wikipedia.org",
+			  "soundcloud.com", "www.youtube.com", "news.yahoo.co.jp", "myapp.herokuapp.com")
+CDN_HOSTS = ("cdnjs.cloudflare.com", "cdn.jsdelivr.net", "fonts.gstatic.com",
+			 "fonts.googleapis.com", "d1a2b3c4d5e6f7.cloudfront.net", "a-v2.sndcdn.com",
+			 "i.ytimg.com", "upload.wikimedia.org", "static.bbci.co.uk", "s.yimg.jp")
+TRACKER_HOSTS = ("www.google-analytics.com", "www.googletagmanager.com",
+				 "securepubads.g.doubleclick.net", "pagead2.googlesyndication.com",
+				 "connect.facebook.net", "platform.twitter.com", "static.doubleclick.net")
+
+TRACE_TYPE = typing.List[interceptor.REQUEST_TUPLE]
+
+
+def page_load_trace(rng: random.Random, page: str, subresources: int) -> TRACE_TYPE:
+	"""The requests made while loading page: mostly first party, then CDNs and trackers."""
+	scheme = rng.choice(("http", "https"))
+	trace = []  # type: TRACE_TYPE
+	for _ in range(subresources):
+		kind = rng.random()
+		if kind < 0.4:
+			host = rng.choice((page, "static." + page, "img." + page))
+		elif kind < 0.8:
+			host = rng.choice(CDN_HOSTS)
+		else:
+			host = rng.choice(TRACKER_HOSTS)
+		trace.append((page, scheme, host, rng.choice(("http", "https", scheme)),
+					  rng.choice(tuple(rule.Type))))
+	return trace
+
+
+@pytest.fixture(scope="session")
+def stock_text():
+	with open("tests/data/stock-rules", "rb") as f:
+		return f.read()
+
+@pytest.fixture(scope="session")
+def stock_rule_obj(stock_text):
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(stock_text, rule_obj)
+	return rule_obj
+
+@pytest.fixture(scope="session")
+def trace():
+	rng = random.Random(TRACE_SEED)
+	requests = []  # type: TRACE_TYPE
+	for _ in range(TRACE_PAGES):
+		requests.extend(page_load_trace(rng, rng.choice(PAGE_HOSTS), TRACE_SUBRESOURCES))
+	return requests
+
+@pytest.fixture(scope="session")
+def psl_obj():
+	return fpdomain.PSL(cache=cache.LRUCache())
+
+
+def test_trace_deterministic(trace):
+	rng = random.Random(TRACE_SEED)
+	assert page_load_trace(rng, rng.choice(PAGE_HOSTS), TRACE_SUBRESOURCES) == trace[:TRACE_SUBRESOURCES]
+
+
+# Parsing and serialization
+
+def test_perf_parse_stock_rules(stock_text, benchmark):
+	benchmark(lambda: umatrix_parser.parse_rules(stock_text, rule.Rules()))
+
+def test_perf_rules_to_map_stock_rules(stock_text, benchmark):
+	lines = stock_text.decode("utf-8").splitlines()
+	benchmark(lambda: umatrix_parser.rules_to_map(lines, rule.Rules()))
+
+def test_perf_map_to_rules(stock_rule_obj, benchmark):
+	benchmark(umatrix_parser.map_to_rules, stock_rule_obj)
+
+
+# Matching
+
+def test_perf_should_block_trace(stock_rule_obj, psl_obj, trace, benchmark):
+	fp_domain = psl_obj.fp_domain
+	def run():
+		for request in trace:
+			interceptor.should_block(*request, fp_domain, stock_rule_obj)
+	benchmark(run)
+
+def test_perf_should_block_many_trace(stock_rule_obj, psl_obj, trace, benchmark):
+	benchmark(interceptor.should_block_many, trace, psl_obj.fp_domain, stock_rule_obj)
+
+def test_perf_verdict_cache_trace(stock_rule_obj, psl_obj, trace, benchmark):
+	cache = interceptor.VerdictCache()
+	fp_domain = psl_obj.fp_domain
+	def run():
+		for request in trace:
+			cache.should_block(*request, fp_domain, stock_rule_obj)
+	benchmark(run)
+
+def test_perf_compiled_trace(stock_rule_obj, psl_obj, trace, benchmark):
+	compiled_obj = compiled.compile_rules(stock_rule_obj)
+	fp_domain = psl_obj.fp_domain
+	def run():
+		for request in trace:
+			compiled_obj.should_block(*request, fp_domain)
+	benchmark(run)
+
+
+# First party domains
+
+def test_perf_fp_domain_cold(psl_obj, trace, benchmark):
+	hosts = [request[2] for request in trace]
+	fp_domain = psl_obj.fp_domain
+	def run():
+		for host in hosts:
+			fp_domain(host)
+	benchmark.pedantic(run, setup=psl_obj.cache.clear, rounds=50)
+
+def test_perf_fp_domain_warm(psl_obj, trace, benchmark):
+	hosts = [request[2] for request in trace]
+	fp_domain = psl_obj.fp_domain
+	def run():
+		for host in hosts:
+			fp_domain(host)
+	run()
+	benchmark(run)
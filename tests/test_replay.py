@@ -0,0 +1,190 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import random
+import shutil
+
+import pytest
+
+from jmatrix import interceptor, replay, request_log, rule, umatrix_parser
+from jmatrix.vendor.fpdomain import fpdomain
+from tests.test_fpdomain import PSL_SAMPLE
+from tests.test_perf import PAGE_HOSTS, page_load_trace
+
+
+TSV_LOG = """# context\trequest\ttype
+https://a.com/page\thttps://cdn.a.com/style.css\tcss
+https://a.com/page\thttp://tracker.com/t.js\tscript
+
+https://a.com/page\tdata:image/png;base64,AAAA\timage
+https://a.com/page\thttps://b.com/\tnot-a-type
+"""
+
+def _har_entry(url, resource_type=None, referer=None, mime_type=""):
+	entry = {
+		"request": {"method": "GET", "url": url,
+					"headers": [{"name": "Referer", "value": referer}] if referer else []},
+		"response": {"status": 200, "content": {"size": 0, "mimeType": mime_type}},
+	}
+	if resource_type is not None:
+		entry["_resourceType"] = resource_type
+	return entry
+
+HAR_ENTRIES = [
+	_har_entry("https://a.com/", "document"),
+	_har_entry("https://cdn.a.com/style.css", "stylesheet", referer="https://a.com/"),
+	_har_entry("http://tracker.com/t.js", referer="https://a.com/", mime_type="text/javascript"),
+	_har_entry("https://a.com/api", "fetch", referer="https://a.com/"),
+	_har_entry("https://a.com/font.woff", "font", referer="https://a.com/"),
+]
+
+def _har(entries):
+	# Something looking like entries before the array, and big strings in entries
+	return json.dumps({"log": {"version": "1.2", "creator": {"name": "test", "comment": "no entries here"},
+							   "pages": [{"id": "page_1", "title": "https://a.com/"}],
+							   "entries": entries}}, indent=1)
+
+
+def test_iter_tsv():
+	assert list(replay.iter_tsv(io.StringIO(TSV_LOG))) == [
+		("a.com", "https", "cdn.a.com", "https", rule.Type.CSS),
+		("a.com", "https", "tracker.com", "http", rule.Type.SCRIPT),
+		None,
+		None,
+	]
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 2**16])
+def test_iter_har(chunk_size):
+	text = _har(HAR_ENTRIES)
+	assert list(replay._iter_json_array(io.StringIO(text), "entries", chunk_size)) == HAR_ENTRIES
+	assert list(replay.iter_har(io.StringIO(text))) == [
+		None,
+		("a.com", "https", "cdn.a.com", "https", rule.Type.CSS),
+		("a.com", "https", "tracker.com", "http", rule.Type.SCRIPT),
+		("a.com", "https", "a.com", "https", rule.Type.XHR),
+		("a.com", "https", "a.com", "https", rule.Type.OTHER),
+	]
+
+def test_iter_har_truncated():
+	text = _har(HAR_ENTRIES)
+	with pytest.raises(ValueError):
+		list(replay._iter_json_array(io.StringIO(text[:len(text) // 2]), "entries", 64))
+	assert list(replay._iter_json_array(io.StringIO('{"log": {}}'), "entries")) == []
+
+def test_iter_har_malformed():
+	"""A malformed entry is reported where it is, not read past to the end."""
+	text = _har(HAR_ENTRIES)
+	bad = text.rindex("{", 0, text.index('"request"', text.index('"request"') + 1)) + 1
+	text = text[:bad] + "nope, " + text[bad:] + " " * 2**20
+	with pytest.raises(ValueError, match="offset {}:".format(bad)):
+		list(replay._iter_json_array(io.StringIO(text), "entries", 64))
+
+
+# Replaying
+
+RULES = "* * * block\n* * css allow\na.com a.com * allow\n"
+NEW_RULES = RULES + "a.com tracker.com script allow\n"
+
+@pytest.fixture()
+def files(tmp_path):
+	paths = {}
+	for name, text in (("rules", RULES), ("new", NEW_RULES), ("log.tsv", TSV_LOG),
+					   ("log.har", _har(HAR_ENTRIES))):
+		paths[name] = tmp_path / name
+		paths[name].write_text(text)
+	# A copy, as replay_log writes a snapshot of the PSL next to it
+	paths["psl"] = tmp_path / "psl"
+	shutil.copy(PSL_SAMPLE, paths["psl"])
+	return paths
+
+def _rules(text):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(text.splitlines(), rule_obj)
+	return rule_obj
+
+def _load(path):
+	return replay.load_rules(path)[0]
+
+def test_replay_matches_should_block():
+	fpdomain_fn = interceptor._get_first_party_domain
+	rng = random.Random(1337)
+	records = []
+	for _ in range(20):
+		records.extend(page_load_trace(rng, rng.choice(PAGE_HOSTS), 50))
+	rules, new_rules = _rules(RULES), _rules(NEW_RULES)
+	summary = replay.replay(records + [None], fpdomain_fn, new_rules, rules)
+	blocked = [r for r in records if interceptor.should_block(*r, fpdomain_fn, new_rules)]
+	changed = [r for r in records if interceptor.should_block(*r, fpdomain_fn, rules) != (r in blocked)]
+	assert summary.requests == len(records)
+	assert summary.skipped == 1
+	assert summary.blocked == len(blocked)
+	assert sum(summary.changes.values()) == len(changed)
+
+def test_replay_log(files):
+	summary = replay.replay_log(files["log.tsv"], files["psl"], _load(files["new"]), _load(files["rules"]))
+	assert (summary.requests, summary.skipped, summary.blocked) == (2, 2, 0)
+	assert summary.changes == {("a.com", "tracker.com", rule.Type.SCRIPT, False): 1}
+	summary = replay.replay_log(files["log.har"], files["psl"], _load(files["rules"]))
+	assert (summary.requests, summary.skipped, summary.blocked) == (4, 1, 1)
+	assert summary.blocked_by_type == {rule.Type.SCRIPT: 1}
+
+def test_replay_binary_log(files, tmp_path):
+	path = tmp_path / "log.jmlog"
+	log = request_log.RequestLog(open(path, "ab"), flush_interval=None)
+	log.record("a.com", "https", "cdn.a.com", "https", rule.Type.CSS, False)
+	log.record("a.com", "https", "tracker.com", "http", rule.Type.SCRIPT, True)
+	log.close()
+	assert replay.Format.from_path(path) == replay.Format.BINARY
+	summary = replay.replay_log(path, files["psl"], _load(files["new"]), _load(files["rules"]))
+	assert (summary.requests, summary.skipped, summary.blocked) == (2, 0, 0)
+	assert summary.changes == {("a.com", "tracker.com", rule.Type.SCRIPT, False): 1}
+
+def test_replay_log_jobs(files, monkeypatch):
+	lines = "".join(TSV_LOG.splitlines(keepends=True)[1:3]) * 500
+	files["log.tsv"].write_text(lines)
+	monkeypatch.setattr(replay, "BATCH_SIZE", 64)
+	expected = replay.replay_log(files["log.tsv"], files["psl"], _load(files["new"]), _load(files["rules"]))
+	summary = replay.replay_log(files["log.tsv"], files["psl"], _load(files["new"]), _load(files["rules"]), jobs=2)
+	assert expected.requests == summary.requests == 1000
+	assert summary.by_type == expected.by_type
+	assert summary.changes == expected.changes
+
+def test_replay_no_psl(files, tmp_path):
+	with pytest.raises(FileNotFoundError):
+		replay.replay_log(files["log.tsv"], tmp_path / "missing", _load(files["rules"]))
+
+def test_main(files, capsys):
+	assert replay.main([str(files["log.har"]), str(files["new"]), "--psl", str(files["psl"]),
+						"--compare", str(files["rules"])]) == 0
+	out = capsys.readouterr().out
+	assert "requests: 4 (1 skipped)" in out
+	assert "changed: 1 (now blocked 0, now allowed 1)" in out
+	assert "allow a.com tracker.com script (1)" in out
+
+
+def test_benchmark_replay_trace(benchmark):
+	"""Benchmarks replaying a TSV log of 100 page loads."""
+	rng = random.Random(1337)
+	lines = []
+	for _ in range(100):
+		for context, context_scheme, request, request_scheme, request_type in page_load_trace(
+				rng, rng.choice(PAGE_HOSTS), 50):
+			lines.append("{}://{}/\t{}://{}/x\t{}\n".format(
+				context_scheme, context, request_scheme, request, str(request_type)))
+	psl = fpdomain.PSL(PSL_SAMPLE, snapshot=False)
+	rules = _rules(RULES)
+	benchmark(lambda: replay.replay(replay.iter_tsv(lines), psl.fp_domain, rules))
@@ -0,0 +1,169 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import time
+
+import pytest
+
+from jmatrix import request_log, rule
+from tests.test_perf import PAGE_HOSTS, page_load_trace
+
+
+def _requests(n, seed=1337):
+	"""n (context host, context scheme, request host, request scheme, type, blocked) of page loads."""
+	rng = random.Random(seed)
+	requests = []
+	while len(requests) < n:
+		requests.extend(
+			request + (rng.random() < 0.3,)
+			for request in page_load_trace(rng, rng.choice(PAGE_HOSTS), 50))
+	return requests[:n]
+
+def _write(path, requests, mode="ab", **kwargs):
+	kwargs.setdefault('flush_interval', None)
+	log = request_log.RequestLog(open(path, mode), **kwargs)
+	for request in requests:
+		log.record(*request)
+	log.close()
+	return log
+
+def _read(path):
+	with open(path, "rb") as f:
+		return [record[1:] for record in request_log.iter_records(f)]
+
+
+def test_roundtrip(tmp_path):
+	path = tmp_path / "log.jmlog"
+	requests = _requests(1000)
+	start = time.time()
+	# Small buffers, to write many blocks
+	_write(path, requests, buffer_records=64)
+	with open(path, "rb") as f:
+		records = list(request_log.iter_records(f))
+	assert [record[1:] for record in records] == requests
+	assert all(start <= record.time <= time.time() for record in records)
+
+def test_sessions(tmp_path):
+	"""Logs appended to by many writers read back in order."""
+	path = tmp_path / "log.jmlog"
+	first = [("a.com", "https", "b.com", "http", rule.Type.CSS, True)]
+	second = [("c.com", "http", "a.com", "https", rule.Type.XHR, False),
+			  ("a.com", "https", "b.com", "http", rule.Type.CSS, False)]
+	_write(path, first)
+	_write(path, [])
+	_write(path, second)
+	assert _read(path) == first + second
+
+def test_truncated(tmp_path):
+	"""A log cut short reads back up to the last whole block."""
+	path = tmp_path / "log.jmlog"
+	requests = _requests(100)
+	_write(path, requests[:60], buffer_records=20)
+	size = path.stat().st_size
+	_write(path, requests[60:], buffer_records=20)
+	data = path.read_bytes()
+	for cut in range(size, len(data)):
+		path.write_bytes(data[:cut])
+		records = _read(path)
+		assert records == requests[:len(records)]
+		assert len(records) >= 60
+
+def test_truncated_append(tmp_path):
+	"""A session appended to a log cut short doesn't read as part of its last block."""
+	path = tmp_path / "log.jmlog"
+	requests = _requests(100)
+	_write(path, requests[:60], buffer_records=20)
+	size = path.stat().st_size
+	_write(path, requests[60:90], buffer_records=20)
+	data = path.read_bytes()
+	for cut in range(size, len(data)):
+		path.write_bytes(data[:cut])
+		_write(path, requests[90:], mode="a+b")
+		records = _read(path)
+		kept = len(records) - 10
+		assert kept >= 60
+		assert records == requests[:kept] + requests[90:]
+
+def test_not_a_log(tmp_path):
+	path = tmp_path / "log.jmlog"
+	path.write_bytes(b"# context\trequest\ttype\n" * 4)
+	with pytest.raises(ValueError):
+		_read(path)
+
+def test_dropped(tmp_path):
+	"""Records are dropped rather than waiting when writes can't keep up."""
+	path = tmp_path / "log.jmlog"
+	requests = _requests(100)
+	log = _write(path, requests, buffer_records=10, max_pending=3)
+	# 3 full buffers waiting, and the current one
+	assert log.dropped == 60
+	assert _read(path) == requests[:40]
+
+def test_background_flush(tmp_path):
+	path = tmp_path / "log.jmlog"
+	requests = _requests(100)
+	log = request_log.RequestLog(open(path, "ab"), buffer_records=16, flush_interval=0.01)
+	for request in requests[:50]:
+		log.record(*request)
+	deadline = time.time() + 10
+	while len(_read(path)) < 50 and time.time() < deadline:
+		time.sleep(0.01)
+	assert _read(path) == requests[:50]
+	for request in requests[50:]:
+		log.record(*request)
+	log.close()
+	assert log.dropped == 0
+	assert _read(path) == requests
+
+def test_columns(tmp_path):
+	numpy = pytest.importorskip("numpy")
+	path = tmp_path / "log.jmlog"
+	requests = _requests(500)
+	_write(path, requests[:200], buffer_records=64)
+	_write(path, requests[200:], buffer_records=64)
+	with open(path, "rb") as f:
+		columns = request_log.read_columns(f)
+	strings = numpy.array(columns.strings, dtype=object)
+	assert list(zip(
+		strings[columns.context_host], strings[columns.context_scheme],
+		strings[columns.request_host], strings[columns.request_scheme],
+		map(rule.Type, columns.request_type.tolist()), columns.blocked.tolist())) == requests
+	assert numpy.all(numpy.diff(columns.time) >= 0)
+
+	path.write_bytes(b"")
+	with open(path, "rb") as f:
+		assert len(request_log.read_columns(f).time) == 0
+
+
+def test_benchmark_record(tmp_path, benchmark):
+	"""Benchmarks logging a page worth of requests."""
+	requests = _requests(200)
+	log = request_log.RequestLog(open(tmp_path / "log.jmlog", "ab"))
+	def run():
+		for request in requests:
+			log.record(*request)
+	benchmark(run)
+	log.close()
+	assert log.dropped == 0
+
+def test_benchmark_iter_records(tmp_path, benchmark):
+	"""Benchmarks reading 100k records."""
+	path = tmp_path / "log.jmlog"
+	_write(path, _requests(100000), max_pending=2**10)
+	def run():
+		with open(path, "rb") as f:
+			return sum(1 for _ in request_log.iter_records(f))
+	assert benchmark(run) == 100000
@@ -0,0 +1,303 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import copy
+import itertools
+import random
+import threading
+
+import pytest
+
+from jmatrix import compact_rules, interceptor, rule, umatrix_parser
+from tests.test_interceptor import stock_rules  # noqa: F401
+
+
+def _rules(lines):
+	rule_obj = rule.Rules()
+	umatrix_parser.parse_rules(lines, rule_obj)
+	return rule_obj
+
+
+def test_remove_rule():
+	rule_obj = _rules(["* * * block", "a.com b.com css allow", "a.com b.com xhr allow"])
+	generation = rule_obj.generation
+	rule_obj.remove_rule("a.com", "b.com", rule.Type.CSS)
+	assert rule_obj.matrix_rules == {"*": {"*": {rule.Type.ALL: rule.Action.BLOCK}},
+									 "a.com": {"b.com": {rule.Type.XHR: rule.Action.ALLOW}}}
+	rule_obj.remove_rule("a.com", "b.com", rule.Type.XHR)
+	assert rule_obj.matrix_rules == {"*": {"*": {rule.Type.ALL: rule.Action.BLOCK}}}
+	assert rule_obj.generation == generation + 2
+	# Removing something missing is a no-op
+	rule_obj.remove_rule("a.com", "b.com", rule.Type.XHR)
+	assert rule_obj.generation == generation + 2
+	assert "a.com" not in rule_obj.matrix_rules
+
+def test_remove_flag():
+	rule_obj = _rules(["matrix-off: a.com true", "https-strict: a.com true"])
+	rule_obj.remove_flag("a.com", rule.Flag.MATRIX_OFF)
+	assert rule_obj.matrix_flags == {"a.com": {rule.Flag.HTTPS_STRICT: True}}
+	rule_obj.remove_flag("a.com", rule.Flag.HTTPS_STRICT)
+	assert rule_obj.matrix_flags == {}
+
+
+UPDATE_TESTS = [
+	# old, new, (added, removed, changed)
+	([], ["* * * block"], (1, 0, 0)),
+	(["* * * block"], [], (0, 1, 0)),
+	(["* * * block"], ["* * * allow"], (0, 0, 1)),
+	(["* * * block", "a.com b.com css allow", "matrix-off: a.com true"],
+	 ["* * * block", "a.com b.com css block", "a.com c.com css block", "matrix-off: a.com false"],
+	 (1, 0, 2)),
+	(["a.com b.com css allow", "a.com b.com xhr allow", "https-strict: b.com true"],
+	 ["a.com b.com xhr allow"],
+	 (0, 2, 0)),
+]
+
+@pytest.mark.parametrize(('old', 'new', 'diff'), UPDATE_TESTS)
+def test_update_from(old, new, diff):
+	rule_obj = _rules(old)
+	new_obj = _rules(new)
+	generation = rule_obj.generation
+	assert rule_obj.update_from(new_obj) == diff
+	assert rule_obj.matrix_rules == new_obj.matrix_rules
+	assert rule_obj.matrix_flags == new_obj.matrix_flags
+	assert rule_obj.generation == generation + sum(diff)
+	assert rule_obj.update_from(new_obj) == (0, 0, 0)
+
+def test_update_from_stock():
+	with open("tests/data/stock-rules", encoding="utf-8") as f:
+		lines = f.read().splitlines()
+	rule_obj = _rules(lines)
+	new_obj = _rules(lines[:-5] + ["a.com b.com css allow"])
+	rule_obj.update_from(new_obj)
+	assert rule_obj.matrix_rules == new_obj.matrix_rules
+	assert rule_obj.matrix_flags == new_obj.matrix_flags
+
+
+# Copy-on-write snapshots
+
+def test_copy():
+	rule_obj = _rules(["* * * block", "a.com b.com css allow", "matrix-off: a.com true"])
+	expected_rules = copy.deepcopy(dict(rule_obj.matrix_rules))
+	new_obj = rule_obj.copy()
+	new_obj.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.BLOCK)
+	new_obj.set_rule("a.com", "c.com", rule.Type.CSS, rule.Action.BLOCK)
+	new_obj.remove_rule("*", "*", rule.Type.ALL)
+	new_obj.set_flag("a.com", rule.Flag.HTTPS_STRICT, True)
+	new_obj.remove_flag("a.com", rule.Flag.MATRIX_OFF)
+	# The original is left alone
+	assert rule_obj.matrix_rules == expected_rules
+	assert rule_obj.matrix_flags == {"a.com": {rule.Flag.MATRIX_OFF: True}}
+	assert new_obj.matrix_rules == {"a.com": {"b.com": {rule.Type.CSS: rule.Action.BLOCK},
+											  "c.com": {rule.Type.CSS: rule.Action.BLOCK}}}
+	assert new_obj.matrix_flags == {"a.com": {rule.Flag.HTTPS_STRICT: True}}
+
+def test_copy_shares():
+	rule_obj = _rules(["a.com b.com css allow", "c.com d.com css allow"])
+	new_obj = rule_obj.copy()
+	new_obj.set_rule("a.com", "b.com", rule.Type.XHR, rule.Action.ALLOW)
+	# Only what changed was copied
+	assert new_obj.matrix_rules["c.com"] is rule_obj.matrix_rules["c.com"]
+	assert new_obj.matrix_rules["a.com"] is not rule_obj.matrix_rules["a.com"]
+	# Changing the copy again does not copy again
+	a_rules = new_obj.matrix_rules["a.com"]
+	new_obj.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.BLOCK)
+	assert new_obj.matrix_rules["a.com"] is a_rules
+
+def test_rules_ref_edit():
+	ref = rule.RulesRef(_rules(["* * * block"]))
+	old = ref.rules
+	with ref.edit() as rules:
+		rules.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.ALLOW)
+		assert ref.rules is old
+	assert ref.rules is rules
+	assert "a.com" not in old.matrix_rules
+	# Nothing changed, so nothing is published
+	with ref.edit() as rules:
+		pass
+	assert ref.rules is not rules
+
+	current = ref.rules
+	with pytest.raises(RuntimeError):
+		with ref.edit() as rules:
+			rules.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.BLOCK)
+			raise RuntimeError
+	assert ref.rules is current
+
+
+# Merged rows
+
+WWW_A = interceptor._hostname_widen_list("www.a.com")
+
+def test_merged_row():
+	rule_obj = _rules(["* b.com * block", "a.com b.com css allow", "www.a.com b.com css inherit",
+					   "com c.com xhr allow"])
+	row = rule_obj.merged_row(WWW_A)
+	assert rule_obj.merged_row(WWW_A) is row
+	assert row["b.com"] == {rule.Type.ALL: rule.Action.BLOCK, rule.Type.CSS: rule.Action.INHERIT}
+	assert row["c.com"] == {rule.Type.XHR: rule.Action.ALLOW}
+	assert row["d.com"] == {}
+	assert "d.com" not in rule_obj.matrix_rules["*"]
+
+	# Only the changed cells are merged again
+	c_cell = row["c.com"]
+	rule_obj.set_rule("a.com", "b.com", rule.Type.XHR, rule.Action.ALLOW)
+	rule_obj.set_rule("org", "c.com", rule.Type.CSS, rule.Action.ALLOW)
+	assert row["b.com"][rule.Type.XHR] == rule.Action.ALLOW
+	assert row["c.com"] is c_cell
+	rule_obj.remove_rule("www.a.com", "b.com", rule.Type.CSS)
+	assert row["b.com"][rule.Type.CSS] == rule.Action.ALLOW
+
+	rule_obj.touch()
+	assert rule_obj.merged_row(WWW_A) is not row
+
+def test_merged_row_copy():
+	rule_obj = _rules(["a.com b.com css allow", "c.com d.com css allow"])
+	row = rule_obj.merged_row(WWW_A)
+	other_row = rule_obj.merged_row(("c.com", "*"))
+	assert row["b.com"] == {rule.Type.CSS: rule.Action.ALLOW}
+	new_obj = rule_obj.copy()
+	new_obj.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.BLOCK)
+	# Not merged in the original yet, it must not see the copy's cell
+	new_obj.set_rule("a.com", "e.com", rule.Type.CSS, rule.Action.BLOCK)
+	new_row = new_obj.merged_row(WWW_A)
+	assert new_row is not row
+	assert new_row["b.com"] == new_row["e.com"] == {rule.Type.CSS: rule.Action.BLOCK}
+	assert row["b.com"] == {rule.Type.CSS: rule.Action.ALLOW}
+	assert row["e.com"] == {}
+	# Rows the changes don't apply to are shared
+	assert new_obj.merged_row(("c.com", "*")) is other_row
+
+def test_merged_row_full(monkeypatch):
+	"""Full rows are replaced, not cleared under copies which share them."""
+	monkeypatch.setattr(rule, "MAX_MERGED_CELLS", 2)
+	rule_obj = _rules(["a.com b.com css allow"])
+	row = rule_obj.merged_row(WWW_A)
+	new_obj = rule_obj.copy()
+	assert new_obj.merged_row(WWW_A) is row
+	for dest in ("c.com", "d.com", "b.com"):
+		row[dest]
+	assert row["b.com"] == {rule.Type.CSS: rule.Action.ALLOW}
+	assert sorted(row) == ["c.com", "d.com"]
+	new_row = new_obj.merged_row(WWW_A)
+	assert new_row is not row
+	assert sorted(row) == ["c.com", "d.com"]
+	assert new_row["b.com"] == {rule.Type.CSS: rule.Action.ALLOW}
+
+@pytest.mark.parametrize('copy_rules', [False, True])
+@pytest.mark.parametrize('rules_class', [rule.Rules, compact_rules.CompactRules])
+def test_merged_rows_random_edits(rules_class, copy_rules):
+	"""Rules changed after their merged rows were used give the same verdicts as new rules."""
+	rng = random.Random(1337)
+	hosts = ["a.com", "www.a.com", "b.com", "cdn.b.com", "com", "*", "1st-party"]
+	types = [rule.Type.ALL, rule.Type.CSS, rule.Type.XHR]
+	actions = [rule.Action.ALLOW, rule.Action.BLOCK, rule.Action.INHERIT]
+	fpdomain_fn = interceptor._get_first_party_domain
+	requests = [(context, "https", dest, "https", request_type)
+				for context in hosts[:4] for dest in hosts[:4] for request_type in types[1:]]
+	rule_obj = rules_class()
+	for _ in range(200):
+		if copy_rules:
+			rule_obj = rule_obj.copy()
+		source, dest = rng.choice(hosts[:-1]), rng.choice(hosts)
+		if rng.random() < 0.3:
+			rule_obj.remove_rule(source, dest, rng.choice(types))
+		else:
+			rule_obj.set_rule(source, dest, rng.choice(types), rng.choice(actions))
+		expected = rule.Rules()
+		expected.update_from(rule_obj)
+		for request in rng.sample(requests, 8):
+			assert (interceptor.should_block(*request, fpdomain_fn, rule_obj) ==
+					interceptor.should_block(*request, fpdomain_fn, expected))
+
+
+# Stress benchmarks: readers check two cells which writers always flip
+# together, while a writer thread keeps flipping them. Between the two, every
+# write changes as many other cells as a small reload would, so that readers
+# of rules changed in place can see half of a write.
+
+STRESS_ARGS = ("a.com", "http", "b.com", "http")
+STRESS_FILLER = tuple("c{}.com".format(i) for i in range(200))
+
+def _stress_write(rules, action):
+	rules.set_rule("a.com", "b.com", rule.Type.CSS, action)
+	for source in STRESS_FILLER:
+		rules.set_rule(source, "d.com", rule.Type.IMAGE, action)
+	rules.set_rule("a.com", "b.com", rule.Type.XHR, action)
+
+def _stress(benchmark, read, write):
+	"""Benchmark read under writes, recording how many reads saw half of a write."""
+	fpdomain_fn = interceptor._get_first_party_domain
+	stop = threading.Event()
+	inconsistent = [0]
+	def writer():
+		actions = itertools.cycle((rule.Action.ALLOW, rule.Action.BLOCK))
+		# Toggles happen far less often than requests
+		while not stop.wait(0.0001):
+			write(next(actions))
+	def run():
+		for _ in range(500):
+			with read() as rules:
+				css = interceptor.should_block(*STRESS_ARGS, rule.Type.CSS, fpdomain_fn, rules)
+				xhr = interceptor.should_block(*STRESS_ARGS, rule.Type.XHR, fpdomain_fn, rules)
+			inconsistent[0] += css != xhr
+	write(rule.Action.BLOCK)
+	thread = threading.Thread(target=writer)
+	thread.start()
+	try:
+		benchmark(run)
+	finally:
+		stop.set()
+		thread.join()
+	benchmark.extra_info['inconsistent_reads'] = inconsistent[0]
+	return inconsistent[0]
+
+def test_benchmark_stress_snapshot(stock_rules, benchmark):
+	"""Benchmarks readers taking a snapshot, while the rules change."""
+	ref = rule.RulesRef(_rules(stock_rules))
+	@contextlib.contextmanager
+	def read():
+		yield ref.rules
+	def write(action):
+		with ref.edit() as rules:
+			_stress_write(rules, action)
+	assert _stress(benchmark, read, write) == 0
+
+def test_benchmark_stress_locked(stock_rules, benchmark):
+	"""Benchmarks readers locking the rules, while the rules change in place."""
+	rule_obj = _rules(stock_rules)
+	lock = threading.Lock()
+	@contextlib.contextmanager
+	def read():
+		with lock:
+			yield rule_obj
+	def write(action):
+		with lock:
+			_stress_write(rule_obj, action)
+	assert _stress(benchmark, read, write) == 0
+
+def test_benchmark_stress_unsynchronized(stock_rules, benchmark):
+	"""Benchmarks readers of rules changed in place without a lock, as before RulesRef.
+
+	Some reads see half of a write: how many is in the inconsistent_reads
+	extra info, it depends on thread scheduling."""
+	rule_obj = _rules(stock_rules)
+	@contextlib.contextmanager
+	def read():
+		yield rule_obj
+	def write(action):
+		_stress_write(rule_obj, action)
+	_stress(benchmark, read, write)
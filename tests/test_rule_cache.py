@@ -0,0 +1,103 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+
+import pytest
+
+from jmatrix import rule, rule_cache, umatrix_parser
+
+
+def _parse(path):
+	rules = rule.Rules()
+	with open(path, encoding="utf-8") as f:
+		errors = umatrix_parser.rules_to_map(f, rules, collate_errors=True)
+	return rules, errors
+
+def _assert_same(a, b):
+	assert a.matrix_flags == b.matrix_flags
+	assert a.matrix_rules == b.matrix_rules
+
+@pytest.fixture
+def rules_file(tmp_path):
+	path = tmp_path / "jmatrix-rules"
+	shutil.copy("tests/data/stock-rules", path)
+	return path
+
+@pytest.fixture
+def large_rules_file(tmp_path):
+	"""A rules file with tens of thousands of lines."""
+	path = tmp_path / "jmatrix-rules-large"
+	with open("tests/data/stock-rules", encoding="utf-8") as f:
+		stock = f.read()
+	with open(path, "w", encoding="utf-8") as f:
+		f.write(stock)
+		for i in range(20000):
+			f.write("site{0}.com cdn{1}.site{0}.com {2} {3}\n".format(
+				i % 1000, i, ("script", "xhr", "*", "frame")[i % 4], ("allow", "block")[i % 3 == 0]))
+	return path
+
+
+def test_load_rules(rules_file):
+	expected, _ = _parse(rules_file)
+	rules, errors = rule_cache.load_rules(rules_file)
+	assert rule_cache.cache_path(rules_file).exists()
+	assert not errors
+	_assert_same(rules, expected)
+
+	cached, errors = rule_cache.load_rules(rules_file)
+	assert not errors
+	_assert_same(cached, expected)
+	# The cached rules can still be modified
+	cached.set_rule("a.com", "b.com", rule.Type.CSS, rule.Action.ALLOW)
+	assert cached.matrix_rules["a.com"]["b.com"][rule.Type.CSS] == rule.Action.ALLOW
+
+def test_load_rules_stale(rules_file):
+	rule_cache.load_rules(rules_file)
+	with open(rules_file, "a", encoding="utf-8") as f:
+		f.write("\nfoo.org bar.org xhr allow\n")
+	rules, _ = rule_cache.load_rules(rules_file)
+	assert rules.matrix_rules["foo.org"]["bar.org"] == {rule.Type.XHR: rule.Action.ALLOW}
+
+	# Same size and contents, but touched
+	stat = rules_file.stat()
+	os.utime(rules_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	rules, _ = rule_cache.load_rules(rules_file)
+	_assert_same(rules, _parse(rules_file)[0])
+
+def test_load_rules_errors(rules_file):
+	with open(rules_file, "a", encoding="utf-8") as f:
+		f.write("\nfoo.org foo.org * * * *\n")
+	for _ in range(2):
+		rules, errors = rule_cache.load_rules(rules_file)
+		assert [str(e) for e in errors] == [str(e) for e in _parse(rules_file)[1]]
+		assert all(isinstance(e, umatrix_parser.JMatrixParserError) for e in errors)
+
+@pytest.mark.parametrize('contents', [b'', b'garbage', rule_cache.CACHE_MAGIC + b'\x01\x04\xff'])
+def test_load_rules_corrupt(rules_file, contents):
+	rule_cache.cache_path(rules_file).write_bytes(contents)
+	rules, _ = rule_cache.load_rules(rules_file)
+	_assert_same(rules, _parse(rules_file)[0])
+
+
+def test_benchmark_parse_large(large_rules_file, benchmark):
+	"""Benchmarks parsing a large rules file from text."""
+	benchmark(_parse, large_rules_file)
+
+def test_benchmark_load_large_cached(large_rules_file, benchmark):
+	"""Benchmarks loading a large rules file through the cache."""
+	rule_cache.load_rules(large_rules_file)
+	benchmark(rule_cache.load_rules, large_rules_file)
@@ -0,0 +1,131 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import sys
+import threading
+import tracemalloc
+
+from jmatrix import rule
+from jmatrix.seen_requests import SeenRequests
+
+
+def test_record_entries():
+	seen = SeenRequests()
+	seen.record("a.com", "cdn.a.com", rule.Type.CSS, rule.Action.ALLOW)
+	seen.record("a.com", "cdn.a.com", rule.Type.SCRIPT, rule.Action.BLOCK)
+	seen.record("a.com", "b.com", rule.Type.XHR, rule.Action.BLOCK)
+	# Later actions replace earlier ones
+	seen.record("a.com", "cdn.a.com", rule.Type.CSS, rule.Action.BLOCK)
+	assert len(seen) == 2
+	assert set(seen.entries("a.com")) == {
+		("cdn.a.com", rule.Type.CSS, rule.Action.BLOCK),
+		("cdn.a.com", rule.Type.SCRIPT, rule.Action.BLOCK),
+		("b.com", rule.Type.XHR, rule.Action.BLOCK),
+	}
+	assert seen.entries("b.com") == []
+	assert "b.com" not in seen
+	seen.clear()
+	assert len(seen) == 0
+	assert seen.entries("a.com") == []
+
+def test_matches_rules():
+	"""The entries are the same as recording everything into a rule.Rules."""
+	rng = random.Random(0)
+	seen = SeenRequests()
+	rule_obj = rule.Rules()
+	for _ in range(2000):
+		args = (rng.choice(("a.com", "b.com", "c.com")), "{}.com".format(rng.randrange(50)),
+				rng.choice(tuple(rule.Type)), rng.choice((rule.Action.ALLOW, rule.Action.BLOCK)))
+		seen.record(*args)
+		rule_obj.set_rule(*args)
+	for host in ("a.com", "b.com", "c.com"):
+		entries = seen.entries(host)
+		assert len(entries) == len(set(entries))
+		assert set(entries) == {
+			(dest, res_type, action) for dest, types in rule_obj.matrix_rules[host].items()
+			for res_type, action in types.items()}
+
+def test_max_per_host():
+	seen = SeenRequests(max_per_host=3)
+	for i in range(5):
+		seen.record("a.com", "{}.com".format(i), rule.Type.CSS, rule.Action.ALLOW)
+	# Using 2.com makes 3.com the least recently used
+	seen.record("a.com", "2.com", rule.Type.CSS, rule.Action.BLOCK)
+	seen.record("a.com", "5.com", rule.Type.CSS, rule.Action.ALLOW)
+	assert len(seen) == 3
+	assert sorted(dest for dest, _, _ in seen.entries("a.com")) == ["2.com", "4.com", "5.com"]
+
+def test_max_entries():
+	seen = SeenRequests(max_entries=4)
+	for host in ("a.com", "b.com", "c.com"):
+		seen.record(host, "x.com", rule.Type.CSS, rule.Action.ALLOW)
+		seen.record(host, "y.com", rule.Type.CSS, rule.Action.ALLOW)
+		# Keep a.com in use
+		seen.record("a.com", "x.com", rule.Type.CSS, rule.Action.ALLOW)
+	assert "a.com" in seen
+	assert "b.com" not in seen
+	assert "c.com" in seen
+	assert len(seen) == 4
+
+def test_threads():
+	"""Clearing while another thread records doesn't break record, or the size."""
+	seen = SeenRequests(max_entries=64, max_per_host=8)
+	stop = threading.Event()
+	errors = []
+	def clear():
+		while not stop.is_set():
+			seen.clear()
+	def record():
+		try:
+			for i in range(20000):
+				seen.record("{}.com".format(i % 16), "{}.com".format(i % 13), rule.Type.CSS, rule.Action.ALLOW)
+		except Exception as e:
+			errors.append(e)
+	interval = sys.getswitchinterval()
+	sys.setswitchinterval(1e-6)
+	try:
+		clearer = threading.Thread(target=clear)
+		clearer.start()
+		record()
+		stop.set()
+		clearer.join()
+	finally:
+		sys.setswitchinterval(interval)
+	assert errors == []
+	assert len(seen) == sum(map(len, seen._hosts.values()))
+
+def test_memory():
+	"""A full store stays within a reasonable amount of memory."""
+	tracemalloc.start()
+	seen = SeenRequests(max_entries=2**14)
+	for i in range(2**16):
+		seen.record("{}.com".format(i % 512), "cdn{}.example.com".format(i), rule.Type.CSS, rule.Action.ALLOW)
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	assert len(seen) <= 2**14
+	assert size < 8 * 2**20
+
+
+def test_benchmark_record(benchmark):
+	"""Benchmarks recording a page worth of requests."""
+	seen = SeenRequests()
+	types = tuple(rule.Type)
+	requests = [("www.reddit.com", "host{}.com".format(i % 40), types[i % len(types)], rule.Action.ALLOW)
+				for i in range(200)]
+	def run():
+		for args in requests:
+			seen.record(*args)
+	benchmark(run)
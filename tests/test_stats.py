@@ -0,0 +1,51 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from jmatrix import interceptor, rule, stats
+
+
+def test_snapshot():
+	stats_obj = stats.Stats()
+	stats_obj.record_request(rule.Type.CSS, 500)
+	stats_obj.record_request(rule.Type.CSS, 3000, 2)
+	stats_obj.record_request(rule.Type.XHR, 10**9, 1)
+	stats_obj.record_step(interceptor.Step.EXACT)
+	snapshot = stats_obj.snapshot()
+	assert snapshot.requests == 3
+	assert snapshot.block_growth == 3
+	assert set(snapshot.latency) == {rule.Type.CSS, rule.Type.XHR}
+	assert snapshot.latency[rule.Type.CSS][:3] == (1, 0, 1)
+	assert snapshot.latency[rule.Type.XHR][-1] == 1
+	assert snapshot.latency_total_ns[rule.Type.CSS] == 3500
+	assert snapshot.steps[interceptor.Step.EXACT] == 1
+	assert snapshot.steps[interceptor.Step.DEFAULT] == 0
+	assert snapshot.cache is None
+
+	text = stats.format_snapshot(snapshot)
+	assert "3 requests" in text
+	assert "css" in text
+
+	stats_obj.reset()
+	assert stats_obj.snapshot().requests == 0
+	assert stats_obj.snapshot().latency == {}
+
+def test_format_cache():
+	cache = interceptor.VerdictCache()
+	assert "cache: 0.0% hits" in stats.format_snapshot(stats.Stats(cache).snapshot())
+
+
+def test_benchmark_record_request(benchmark):
+	stats_obj = stats.Stats()
+	benchmark(stats_obj.record_request, rule.Type.CSS, 4000, 1)
@@ -0,0 +1,109 @@
+# Copyright (C) 2019  Jay Kamat <jaygkamat@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+import pytest
+
+from jmatrix import interceptor, rule, umatrix_parser, vectorized
+from tests.test_compiled import _random_host, _random_rules
+from tests.test_interceptor import OVERALL_TESTS, psl, stock_rules  # noqa: F401
+from tests.test_perf import PAGE_HOSTS, page_load_trace
+
+
+needs_numpy = pytest.mark.skipif(not vectorized.HAVE_NUMPY, reason="NumPy is not installed")
+
+
+@needs_numpy
+@pytest.mark.parametrize(('r_text', 'result'), OVERALL_TESTS.items())
+def test_vectorized_overall(r_text, result, psl):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(r_text, rule_obj)
+	requests = result.get('block', []) + result.get('allow', [])
+	expected = [True] * len(result.get('block', [])) + [False] * len(result.get('allow', []))
+	assert list(vectorized.should_block_columns(*zip(*requests), psl, rule_obj)) == expected
+
+@needs_numpy
+@pytest.mark.parametrize('seed', range(20))
+def test_vectorized_random(seed):
+	rng = random.Random(seed)
+	fpdomain_fn = interceptor._get_first_party_domain
+	for _ in range(5):
+		rule_obj = _random_rules(rng)
+		checker = vectorized.BulkChecker(rule_obj, fpdomain_fn)
+		# Checked in two batches, to reuse what the checker knows about hosts
+		for _ in range(2):
+			requests = [
+				(_random_host(rng), rng.choice(("http", "https")),
+				 _random_host(rng), rng.choice(("http", "https")),
+				 rng.choice(tuple(rule.Type)))
+				for _ in range(200)]
+			expected = [interceptor.should_block(*request, fpdomain_fn, rule_obj) for request in requests]
+			assert list(checker.should_block_columns(*zip(*requests))) == expected
+
+@needs_numpy
+def test_vectorized_stock(stock_rules, psl):
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	rng = random.Random(1337)
+	requests = []
+	for _ in range(50):
+		requests.extend(page_load_trace(rng, rng.choice(PAGE_HOSTS), 50))
+	expected = [interceptor.should_block(*request, psl, rule_obj) for request in requests]
+	assert list(vectorized.should_block_columns(*zip(*requests), psl, rule_obj)) == expected
+
+@needs_numpy
+def test_vectorized_empty():
+	rule_obj = rule.Rules()
+	checker = vectorized.BulkChecker(rule_obj, interceptor._get_first_party_domain)
+	assert len(checker.should_block_columns([], [], [], [], [])) == 0
+	assert list(checker.should_block_columns(["a.com"], ["http"], ["b.com"], ["http"], [rule.Type.CSS])) == [True]
+	with pytest.raises(ValueError):
+		checker.should_block_columns(["a.com"], ["http"], [], [], [])
+
+def test_vectorized_fallback(monkeypatch, psl):
+	monkeypatch.setattr(vectorized, "numpy", None)
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(["* * * block", "* * css allow"], rule_obj)
+	requests = [("a.com", "http", "b.com", "http", rule.Type.CSS),
+				("a.com", "http", "b.com", "http", rule.Type.XHR)]
+	assert list(vectorized.should_block_columns(*zip(*requests), psl, rule_obj)) == [0, 1]
+	with pytest.raises(ImportError):
+		vectorized.BulkChecker(rule_obj, psl)
+
+
+def _audit_columns(n, seed=1337):
+	"""n requests of page loads, as columns."""
+	rng = random.Random(seed)
+	requests = []
+	while len(requests) < n:
+		requests.extend(page_load_trace(rng, rng.choice(PAGE_HOSTS), 50))
+	return list(zip(*requests[:n]))
+
+@needs_numpy
+def test_benchmark_vectorized_audit(stock_rules, psl, benchmark):
+	"""Benchmarks checking 100k requests with a BulkChecker."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	columns = _audit_columns(100000)
+	checker = vectorized.BulkChecker(rule_obj, psl)
+	benchmark(checker.should_block_columns, *columns)
+
+def test_benchmark_scalar_audit(stock_rules, psl, benchmark):
+	"""Benchmarks checking the same 100k requests with interceptor.should_block_columns."""
+	rule_obj = rule.Rules()
+	umatrix_parser.rules_to_map(stock_rules, rule_obj)
+	columns = _audit_columns(100000)
+	benchmark(interceptor.should_block_columns, *columns, psl, rule_obj)